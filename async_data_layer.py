@@ -0,0 +1,151 @@
+from twisted.internet import reactor as global_reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class AsyncDataLayer:
+    """
+    Wraps a DataLayer so that its blocking SQLite calls run off the reactor
+    thread. Every method returns a Deferred firing with the result of the
+    corresponding DataLayer method.
+
+    Reads run on a bounded pool of threads. Writes all go through a single
+    dedicated writer thread, so they are applied in the order they were
+    issued and never contend with each other for SQLite's write lock.
+    """
+
+    def __init__(self, data_layer, read_threads=4, reactor=global_reactor):
+        """
+            :param data_layer: the DataLayer doing the actual work. Its
+            connection pool should allow at least 'read_threads' + 1
+            connections.
+            :param read_threads: maximum number of concurrent reads
+            :param reactor: the reactor the Deferreds fire in
+        """
+        self.data_layer = data_layer
+        self.reactor = reactor
+        self.read_pool = ThreadPool(
+            minthreads=0, maxthreads=read_threads, name="data-layer-read"
+        )
+        self.write_pool = ThreadPool(
+            minthreads=1, maxthreads=1, name="data-layer-write"
+        )
+        self.shutdown_trigger = None
+
+    def start(self):
+        """
+        Starts the reader and writer threads. They are stopped again when the
+        reactor shuts down.
+        """
+        self.read_pool.start()
+        self.write_pool.start()
+        self.shutdown_trigger = self.reactor.addSystemEventTrigger(
+            "during", "shutdown", self._reactorShutdown
+        )
+
+    def _reactorShutdown(self):
+        self.shutdown_trigger = None
+        self.stop()
+
+    def stop(self):
+        """
+        Stops the threads after letting them finish any queued work.
+        """
+        if self.shutdown_trigger is not None:
+            self.reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.shutdown_trigger = None
+        self.read_pool.stop()
+        self.write_pool.stop()
+
+    def _read(self, f, *args):
+        return deferToThreadPool(self.reactor, self.read_pool, f, *args)
+
+    def _write(self, f, *args):
+        return deferToThreadPool(self.reactor, self.write_pool, f, *args)
+
+    def set_value(self, key, value, flags, exptime=0):
+        return self._write(
+            self.data_layer.set_value, key, value, flags, exptime
+        )
+
+    def add_value(self, key, value, flags, exptime=0):
+        return self._write(
+            self.data_layer.add_value, key, value, flags, exptime
+        )
+
+    def replace_value(self, key, value, flags, exptime=0):
+        return self._write(
+            self.data_layer.replace_value, key, value, flags, exptime
+        )
+
+    def cas_value(self, key, value, flags, exptime, cas):
+        return self._write(
+            self.data_layer.cas_value, key, value, flags, exptime, cas
+        )
+
+    def append_value(self, key, value):
+        return self._write(self.data_layer.append_value, key, value)
+
+    def prepend_value(self, key, value):
+        return self._write(self.data_layer.prepend_value, key, value)
+
+    def incr_value(self, key, delta):
+        return self._write(self.data_layer.incr_value, key, delta)
+
+    def touch_value(self, key, exptime):
+        return self._write(self.data_layer.touch_value, key, exptime)
+
+    def apply_batch(self, writes):
+        return self._write(self.data_layer.apply_batch, writes)
+
+    def get_values(self, keys, with_cas=False):
+        return self._read(self.data_layer.get_values, keys, with_cas)
+
+    def get_all_values(self):
+        return self._read(
+            lambda: list(self.data_layer.get_all_values())
+        )
+
+    def delete_value(self, key):
+        return self._write(self.data_layer.delete_value, key)
+
+    def delete_expired(self, limit):
+        return self._write(self.data_layer.delete_expired, limit)
+
+    def note_accesses(self, keys):
+        # Only updates memory, so there's no need for a thread
+        self.data_layer.note_accesses(keys)
+
+    def record_accesses(self):
+        return self._write(self.data_layer.record_accesses)
+
+    def usage(self):
+        return self._read(self.data_layer.usage)
+
+    def evict(self, max_items=None, max_bytes=None, limit=500):
+        return self._write(
+            self.data_layer.evict, max_items, max_bytes, limit
+        )
+
+    def log_position(self):
+        return self._read(self.data_layer.log_position)
+
+    def changes(self, after, limit):
+        return self._read(self.data_layer.changes, after, limit)
+
+    def dump_items(self, after=None, limit=1000):
+        return self._read(self.data_layer.dump_items, after, limit)
+
+    def scan_keys(self, after=None, limit=1000):
+        return self._read(self.data_layer.scan_keys, after, limit)
+
+    def replica_state(self):
+        return self._read(self.data_layer.replica_state)
+
+    def reset_replica(self):
+        return self._write(self.data_layer.reset_replica)
+
+    def apply_changes(self, writes, log_id=None, position=None):
+        return self._write(
+            self.data_layer.apply_changes, writes, log_id, position
+        )
@@ -0,0 +1,149 @@
+from memcache_receiver import MemcacheCommands, MemcacheFactory
+import asyncio
+
+
+class AsyncioMemcacheReceiver(MemcacheCommands, asyncio.Protocol):
+    """
+    Serves the memcache protocol on an asyncio transport.
+
+    Received data is appended to a single buffer, in which command lines and
+    payloads are found by offset. Lines are decoded straight from the
+    buffer and payloads are copied out of it once, into the bytearray that
+    is stored; the buffer is only trimmed once all complete commands in it
+    have been handled.
+    """
+    # Longest command line accepted, as for LineReceiver
+    MAX_LENGTH = 16384
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transport = None
+        self.received = bytearray()
+        # Whether the buffer is parsed for a command line rather than the
+        # payload of a storage command
+        self.line_mode = True
+        # Bytes of a too large payload still to be skipped
+        self.skipping = 0
+        self.reading_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # The transport calls pause_writing once it holds more than this
+        transport.set_write_buffer_limits(high=self.high_water)
+        self.connectionMade()
+
+    def connection_lost(self, exc):
+        self.connectionLost(exc)
+
+    def pause_writing(self):
+        self.pauseResponses()
+
+    def resume_writing(self):
+        self.resumeResponses()
+
+    def pauseReading(self):
+        self.reading_paused = True
+        self.transport.pause_reading()
+
+    def resumeReading(self):
+        self.reading_paused = False
+        self.transport.resume_reading()
+        # Handle the commands left in the buffer when reading was paused
+        self.data_received(b"")
+
+    def data_received(self, data):
+        """
+        Processes every complete command in the received data and then
+        writes out all the responses that are ready in one go.
+        """
+        self.stats.incr("bytes_read", len(data))
+        self.received += data
+        self.output = []
+        try:
+            with memoryview(self.received) as view:
+                parsed = self.parse(view)
+            del self.received[:parsed]
+            self.flushGets()
+        finally:
+            output, self.output = self.output, None
+            if output:
+                self.transport.writelines(output)
+
+    def parse(self, view):
+        """
+        Handles the complete command lines and payloads at the start of
+        'view', a view of the receive buffer.
+
+        :return: the number of bytes handled
+        """
+        buffer = self.received
+        end = len(buffer)
+        pos = 0
+        while pos < end and not self.reading_paused and \
+                not self.transport.is_closing():
+            if self.line_mode:
+                eol = buffer.find(self.delimiter, pos)
+                if eol < 0:
+                    if end - pos >= self.MAX_LENGTH + len(self.delimiter):
+                        self.lineLengthExceeded()
+                        return end
+                    break
+                if eol - pos > self.MAX_LENGTH:
+                    self.lineLengthExceeded()
+                    return end
+                with view[pos:eol] as line:
+                    pos = eol + len(self.delimiter)
+                    self.lineReceived(line)
+            elif self.skipping:
+                skipped = min(self.skipping, end - pos)
+                self.skipping -= skipped
+                pos += skipped
+                if not self.skipping:
+                    self.line_mode = True
+                    self.payloadReceived(None)
+            else:
+                size = self.bytes + len(self.delimiter)
+                if end - pos < size:
+                    break
+                payload = buffer[pos:pos + size]
+                pos += size
+                self.line_mode = True
+                self.payloadReceived(payload)
+        return pos
+
+    def lineLengthExceeded(self):
+        self.transport.close()
+
+    def readPayload(self):
+        # Too large payloads are skipped as they arrive instead of being
+        # buffered
+        if self.bytes > self.max_item_size:
+            self.skipping = self.bytes + len(self.delimiter)
+        self.line_mode = False
+
+    def writeToTransport(self, data):
+        self.transport.writelines(data)
+
+
+class AsyncioMemcacheFactory(MemcacheFactory):
+    """
+    Creates the protocols of an asyncio server, e.g. with
+    loop.create_server(factory).
+    """
+    protocol = AsyncioMemcacheReceiver
+
+    def __call__(self):
+        return self.buildProtocol(None)
+
+
+def install_reactor():
+    """
+    Installs Twisted's asyncio reactor on a new event loop, so that the data
+    layers, which use Deferreds, threads and timers of the reactor, run on
+    the same loop as the asyncio server. Has to be called before anything
+    imports the reactor.
+    """
+    from twisted.internet import asyncioreactor
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
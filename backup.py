@@ -0,0 +1,206 @@
+from contextlib import closing
+from memcache_receiver import AdminError
+from schema import (
+    LEGACY_VERSION, SCHEMA_VERSION, check_schema_version, create_schema,
+    schema_version
+)
+from twisted.internet import defer, threads
+import os
+import sqlite3
+import time
+
+# Pages copied per step of a snapshot, and seconds paused after each step.
+# Steps are short enough for the copy not to hog the disk, and the pause
+# leaves room for the requests served meanwhile.
+DEFAULT_STEP_PAGES = 256
+DEFAULT_STEP_PAUSE = 0.001
+
+
+def _remove(name):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(name + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def _copy(source, target, step_pages, step_pause, progress=None):
+    """
+    Copies the database open on 'source' to the file 'target', going
+    through a temporary file so that 'target' only ever appears complete.
+
+    :return: the number of pages copied
+    """
+    partial = target + ".partial"
+    _remove(partial)
+
+    def step(status, remaining, total):
+        if progress is not None:
+            progress(total - remaining, total)
+        if step_pause:
+            time.sleep(step_pause)
+
+    with closing(sqlite3.connect(partial)) as dest:
+        # An interrupted copy is thrown away, so the temporary file is
+        # written without journaling or syncing, and synced once complete
+        dest.execute("PRAGMA journal_mode = OFF")
+        dest.execute("PRAGMA synchronous = OFF")
+        source.backup(dest, pages=step_pages, progress=step)
+        # The copy is a single file rather than a database in WAL mode
+        dest.execute("PRAGMA journal_mode = DELETE")
+        pages, = dest.execute("PRAGMA page_count").fetchone()
+    with open(partial, "rb") as f:
+        os.fsync(f.fileno())
+    _remove(target)
+    os.replace(partial, target)
+    return pages
+
+
+def snapshot(db, target, step_pages=DEFAULT_STEP_PAGES,
+             step_pause=DEFAULT_STEP_PAUSE, progress=None):
+    """
+    Copies the database 'db', which servers may be using, to the file
+    'target' with SQLite's online backup API, 'step_pages' pages at a time.
+
+    The connection the pages are copied from holds a read transaction for
+    the whole copy. With WAL journaling that pins the database as it was
+    when the copy started: writes made meanwhile neither wait for the copy
+    nor make it start over, which they would otherwise do at every step.
+
+    :param step_pages: number of pages copied per step
+    :param step_pause: seconds paused after every step
+    :param progress: called with the number of pages copied so far and the
+    total after every step, if given
+    :return: the number of pages copied
+    """
+    with closing(sqlite3.connect(db, isolation_level=None)) as source:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        try:
+            return _copy(source, target, step_pages, step_pause, progress)
+        finally:
+            source.execute("COMMIT")
+
+
+def restore(snapshot_file, db, force=False):
+    """
+    Turns a snapshot into the database 'db', ready to be served.
+
+    The snapshot is checked for damage and for a schema this code can use,
+    older versions included, which are upgraded or, for the first one,
+    have to be migrated. Its change
+    log, if it has one, gets a new id, so that replicas of the database the
+    snapshot was taken from copy the restored one anew rather than apply
+    its changes on top of theirs.
+
+    :param force: whether to replace an existing database
+    :return: nothing
+    :raises FileExistsError: if 'db' exists and 'force' is false
+    :raises ValueError: if the snapshot is damaged
+    :raises schema.SchemaVersionError: if its schema is not one this code
+    can use
+    """
+    if not force and os.path.exists(db):
+        raise FileExistsError("{} already exists".format(db))
+    with closing(sqlite3.connect(snapshot_file)) as source:
+        result, = source.execute("PRAGMA quick_check").fetchone()
+        if result != "ok":
+            raise ValueError("{} is damaged: {}".format(snapshot_file, result))
+        version = schema_version(source)
+        if not LEGACY_VERSION <= version < SCHEMA_VERSION:
+            check_schema_version(source)
+        partial = db + ".restoring"
+        _remove(partial)
+        _copy(source, partial, DEFAULT_STEP_PAGES, 0)
+
+    with closing(sqlite3.connect(partial)) as con:
+        with con:
+            if con.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'CHANGE_LOG_INFO'"
+            ).fetchone():
+                con.execute(
+                    "UPDATE CHANGE_LOG_INFO SET LOG_ID = "
+                    "LOWER(HEX(RANDOMBLOB(8)))"
+                )
+    create_schema(partial)
+    # A write-ahead log left by the database replaced would be applied to
+    # the restored one
+    _remove(db)
+    os.replace(partial, db)
+
+
+class Snapshotter:
+    """
+    Takes snapshots of the database files of a running server into a
+    directory, for the 'snapshot <name>' admin command. The copies are made
+    on a thread, so the reactor keeps serving requests, one snapshot at a
+    time.
+    """
+
+    def __init__(self, dbs, directory, step_pages=DEFAULT_STEP_PAGES,
+                 step_pause=DEFAULT_STEP_PAUSE):
+        """
+            :param dbs: a list of (database file, suffix) pairs, the suffix
+            being added to the snapshot's name for the copy of the file
+            :param directory: directory the snapshots are written to
+            :param step_pages: number of pages copied per step
+            :param step_pause: seconds paused after every step
+        """
+        self.dbs = dbs
+        self.directory = directory
+        self.step_pages = step_pages
+        self.step_pause = step_pause
+        self.running = False
+        self.completed = 0
+        self.pages = 0
+
+    def snapshot(self, name):
+        """
+        Copies every database file to the snapshot directory.
+
+        :return: a Deferred firing with the names of the copies
+        """
+        if self.running:
+            raise AdminError("a snapshot is being taken already")
+        self.running = True
+
+        def copy():
+            targets = []
+            for db, suffix in self.dbs:
+                target = os.path.join(self.directory, name + suffix)
+                self.pages += snapshot(
+                    db, target, self.step_pages, self.step_pause
+                )
+                targets.append(target)
+            return targets
+
+        def copied(targets):
+            self.completed += 1
+            return targets
+
+        def done(result):
+            self.running = False
+            return result
+
+        d = threads.deferToThread(copy)
+        d.addCallback(copied)
+        return d.addBoth(done)
+
+    def command(self, args):
+        """
+        'snapshot <name>' writes a snapshot of the databases under 'name'
+        in the snapshot directory and answers OK once it is complete.
+        """
+        if len(args) != 1 or not args[0] or \
+                os.path.basename(args[0]) != args[0] or \
+                args[0].startswith("."):
+            raise AdminError("expected snapshot <file name>")
+        d = defer.maybeDeferred(self.snapshot, args[0])
+        return d.addCallback(lambda targets: [b"OK"])
+
+    def stats(self):
+        return {
+            "in_progress": int(self.running),
+            "completed": self.completed,
+            "pages": self.pages,
+        }
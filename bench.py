@@ -0,0 +1,372 @@
+from collections import deque
+from stats import Histogram
+from time import perf_counter
+from twisted.internet import defer, protocol
+from twisted.internet import reactor as global_reactor
+from twisted.protocols.basic import LineReceiver
+import bisect
+import itertools
+import os
+import random
+import socket
+import time
+
+CMD_GET = "get"
+CMD_SET = "set"
+
+
+class Workload:
+    """
+    Describes the requests of a benchmark: how many distinct keys there are,
+    how popular each of them is, how large the values are and which fraction
+    of the requests are gets.
+    """
+
+    def __init__(self, keys=10000, read_ratio=0.9, zipf=0.99,
+                 value_size=(100, 100), seed=None):
+        """
+            :param keys: number of distinct keys
+            :param read_ratio: fraction of requests which are gets, the others
+            are sets
+            :param zipf: exponent of the Zipfian key popularity, the key of
+            rank r being picked with a probability proportional to
+            1 / r ** zipf. 0 picks all keys equally often.
+            :param value_size: (smallest, largest) size in bytes of the
+            values, picked uniformly in between
+            :param seed: seed of the random choices, for repeatable runs
+        """
+        self.keys = keys
+        self.read_ratio = read_ratio
+        self.zipf = zipf
+        self.value_size = value_size
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.cum_weights = list(itertools.accumulate(
+            1.0 / rank ** zipf for rank in range(1, keys + 1)
+        ))
+        # Values are slices of a single random buffer
+        self.data = os.urandom(value_size[1])
+
+    def describe(self):
+        return {
+            "keys": self.keys,
+            "read_ratio": self.read_ratio,
+            "zipf": self.zipf,
+            "value_size": list(self.value_size),
+            "seed": self.seed,
+        }
+
+    @staticmethod
+    def key_name(rank):
+        return "key:{}".format(rank)
+
+    def key(self):
+        point = self.random.random() * self.cum_weights[-1]
+        rank = min(bisect.bisect(self.cum_weights, point), self.keys - 1)
+        return self.key_name(rank)
+
+    def value(self):
+        return self.data[:self.random.randint(*self.value_size)]
+
+    def request(self):
+        """
+        :return: the (command, key, value) of the next request, value being
+        None for gets
+        """
+        if self.random.random() < self.read_ratio:
+            return CMD_GET, self.key(), None
+        return CMD_SET, self.key(), self.value()
+
+    def rows(self):
+        """
+        :return: an iterator over the (key, row) writes storing a value for
+        every key, as accepted by apply_batch
+        """
+        for rank in range(self.keys):
+            yield self.key_name(rank), (self.value(), 0, 0)
+
+
+def preload(data_layer, workload, batch_size=1000):
+    """
+    Stores a value for every key of 'workload', so that gets hit.
+    """
+    rows = workload.rows()
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        data_layer.apply_batch(batch)
+
+
+class LoadClient(LineReceiver):
+    """
+    Connection of the load generator, which keeps 'pipeline' requests in
+    flight and records the latency of each from the moment it was written
+    until its response has been received.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        # Command and send time of the requests awaiting a response
+        self.in_flight = deque()
+        self.found = False
+        self.skip = 0
+
+    def connectionMade(self):
+        self.run.clients.append(self)
+        for _ in range(self.run.pipeline):
+            self.sendRequest()
+
+    def sendRequest(self):
+        command, key, value = self.run.workload.request()
+        key = key.encode("ascii")
+        if command == CMD_GET:
+            self.transport.write(b"get %s\r\n" % key)
+        else:
+            self.transport.writeSequence([
+                b"set %s 0 0 %d\r\n" % (key, len(value)), value, b"\r\n"
+            ])
+        self.in_flight.append((command, perf_counter()))
+
+    def lineReceived(self, line):
+        if line.startswith(b"VALUE "):
+            self.found = True
+            self.skip = int(line.split()[3]) + 2
+            self.setRawMode()
+            return
+
+        command, sent = self.in_flight.popleft()
+        self.run.completed(command, perf_counter() - sent, line, self.found)
+        self.found = False
+        if not self.run.finished:
+            self.sendRequest()
+
+    def rawDataReceived(self, data):
+        used = min(self.skip, len(data))
+        self.skip -= used
+        if not self.skip:
+            self.setLineMode(data[used:])
+
+
+class LoadClientFactory(protocol.ClientFactory):
+    def __init__(self, run):
+        self.run = run
+
+    def buildProtocol(self, addr):
+        return LoadClient(self.run)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.run.failed(reason)
+
+
+class LoadRun:
+    """
+    Sends the requests of a workload to a server over several connections
+    for a fixed time and collects throughput and latency percentiles.
+    """
+
+    RESPONSES = {CMD_GET: b"END", CMD_SET: b"STORED"}
+
+    def __init__(self, workload, connections=4, pipeline=1, duration=10.0,
+                 reactor=global_reactor):
+        """
+            :param workload: the Workload generating the requests
+            :param connections: number of concurrent connections
+            :param pipeline: number of requests each connection keeps in
+            flight
+            :param duration: seconds to send requests for
+            :param reactor: the reactor used to connect and for timing
+        """
+        self.workload = workload
+        self.connections = connections
+        self.pipeline = pipeline
+        self.duration = duration
+        self.reactor = reactor
+        self.clients = []
+        self.histograms = {
+            name: Histogram() for name in (CMD_GET, CMD_SET, "all")
+        }
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.finished = False
+        self.started = None
+        self.elapsed = None
+        self.done = None
+
+    def start(self, host, port):
+        """
+        Connects to the server and starts sending requests.
+
+        :return: a Deferred firing with the results once 'duration' seconds
+        have passed
+        """
+        self.done = defer.Deferred()
+        factory = LoadClientFactory(self)
+        for _ in range(self.connections):
+            self.reactor.connectTCP(host, port, factory)
+        self.started = perf_counter()
+        self.timer = self.reactor.callLater(self.duration, self.stop)
+        return self.done
+
+    def completed(self, command, seconds, response, found):
+        if self.finished:
+            return
+        if response != self.RESPONSES[command]:
+            self.errors += 1
+            return
+        if command == CMD_GET:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.histograms[command].record(seconds)
+        self.histograms["all"].record(seconds)
+
+    def failed(self, reason):
+        if not self.finished:
+            self.finished = True
+            self.timer.cancel()
+            self.done.errback(reason)
+
+    def stop(self):
+        self.finished = True
+        self.elapsed = perf_counter() - self.started
+        for client in self.clients:
+            client.transport.loseConnection()
+        self.done.callback(self.results())
+
+    def results(self):
+        operations = self.histograms["all"].count
+        return {
+            "connections": self.connections,
+            "pipeline": self.pipeline,
+            "seconds": round(self.elapsed, 3),
+            "operations": operations,
+            "ops_per_sec": round(operations / self.elapsed, 1),
+            "get_hits": self.hits,
+            "get_misses": self.misses,
+            "errors": self.errors,
+            "latency": {
+                name: dict(histogram.summary())
+                for name, histogram in self.histograms.items()
+                if histogram.count
+            },
+        }
+
+
+def bench_data_layer(data_layer, workload, operations=10000, batch_size=100):
+    """
+    Times the data layer operations on their own, without the server and the
+    network in between. Single-key operations are each called 'operations'
+    times, the batched ones with 'batch_size' keys per call as many times as
+    needed to cover 'operations' keys.
+
+    :return: a dictionary mapping the name of each benchmark to its calls
+    per second, keys per call and latency summary
+    """
+    def keys(count):
+        return [workload.key() for _ in range(count)]
+
+    batches = max(operations // batch_size, 1)
+    benchmarks = [
+        ("set_value", data_layer.set_value, 1, [
+            (key, workload.value(), 0) for key in keys(operations)
+        ]),
+        ("get_values", data_layer.get_values, 1, [
+            ([key],) for key in keys(operations)
+        ]),
+        ("get_values_batch", data_layer.get_values, batch_size, [
+            (keys(batch_size),) for _ in range(batches)
+        ]),
+        ("apply_batch", data_layer.apply_batch, batch_size, [
+            ([(key, (workload.value(), 0, 0)) for key in keys(batch_size)],)
+            for _ in range(batches)
+        ]),
+        ("delete_value", data_layer.delete_value, 1, [
+            (key,) for key in keys(operations)
+        ]),
+    ]
+
+    results = {}
+    for name, method, keys_per_call, calls in benchmarks:
+        histogram = Histogram()
+        started = perf_counter()
+        for args in calls:
+            start = perf_counter()
+            method(*args)
+            histogram.record(perf_counter() - start)
+        elapsed = perf_counter() - started
+        results[name] = {
+            "calls_per_sec": round(len(calls) / elapsed, 1),
+            "keys_per_call": keys_per_call,
+            "latency": dict(histogram.summary()),
+        }
+    return results
+
+
+def free_port():
+    """
+    :return: a TCP port on the loopback interface nobody is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port, process, timeout=10.0):
+    """
+    Waits until the server started as 'process' accepts connections on
+    'port'.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    "Server exited with status {}".format(process.returncode)
+                )
+            if time.monotonic() > deadline:
+                raise RuntimeError("Server did not start listening")
+            time.sleep(0.05)
+
+
+def compare(baseline, results):
+    """
+    :return: lines comparing the throughput and 99th percentile latencies of
+    'results' with those of an earlier run, 'baseline'
+    """
+    def change(name, old, new):
+        if not old:
+            return "{}: {} -> {}".format(name, old, new)
+        return "{}: {} -> {} ({:+.1f}%)".format(
+            name, old, new, (new - old) * 100.0 / old
+        )
+
+    lines = []
+    old_server = baseline.get("server") or {}
+    new_server = results.get("server") or {}
+    if old_server and new_server:
+        lines.append(change(
+            "server ops_per_sec",
+            old_server["ops_per_sec"], new_server["ops_per_sec"]
+        ))
+        for name, latency in sorted(new_server["latency"].items()):
+            old = old_server["latency"].get(name)
+            if old:
+                lines.append(change(
+                    "server {} p99_us".format(name),
+                    old["p99_us"], latency["p99_us"]
+                ))
+    old_data_layer = baseline.get("data_layer") or {}
+    for name, result in sorted((results.get("data_layer") or {}).items()):
+        old = old_data_layer.get(name)
+        if old:
+            lines.append(change(
+                "{} calls_per_sec".format(name),
+                old["calls_per_sec"], result["calls_per_sec"]
+            ))
+    return lines
@@ -0,0 +1,175 @@
+from compression import decompress_row
+from contextlib import closing
+from data_layer import SCAN_VALUES, decode_key, encode_key, expires_at
+import itertools
+import sqlite3
+import struct
+import time
+
+# Files written by export start with this line
+MAGIC = b"TENANTBASE-KV 1\n"
+# Every record starts with the key length, flags, expiration time and value
+# length, followed by the key and the value themselves
+RECORD_HEADER = struct.Struct(">HqqI")
+
+FORMAT_COMPACT = "compact"
+FORMAT_MEMCACHED = "memcached"
+
+# Number of arguments of the memcached storage commands, not counting
+# 'noreply', which are all followed by a data block
+STORAGE_ARGS = {
+    b"set": 4, b"add": 4, b"replace": 4, b"append": 4, b"prepend": 4,
+    b"cas": 5,
+}
+
+
+def write_compact(rows, out):
+    """
+    Writes 'rows', dictionaries as returned by DataLayer.scan, to the binary
+    file 'out' in the compact format.
+
+    :return: the number of items written
+    """
+    out.write(MAGIC)
+    count = 0
+    for row in rows:
+        key = encode_key(row["key"])
+        value = row["value"]
+        out.write(RECORD_HEADER.pack(
+            len(key), row["flags"], row["expires_at"], len(value)
+        ))
+        out.write(key)
+        out.write(value)
+        count += 1
+    return count
+
+
+def write_memcached(rows, out):
+    """
+    Writes 'rows' to the binary file 'out' as a stream of memcached 'set'
+    commands, which can be replayed against any memcached server.
+
+    :return: the number of items written
+    """
+    count = 0
+    for row in rows:
+        # Stored expiration times are unix times, which memcached also takes
+        # as absolute times
+        out.write(b"set %s %d %d %d\r\n" % (
+            encode_key(row["key"]), row["flags"], row["expires_at"],
+            len(row["value"])
+        ))
+        out.write(row["value"])
+        out.write(b"\r\n")
+        count += 1
+    return count
+
+
+WRITERS = {
+    FORMAT_COMPACT: write_compact,
+    FORMAT_MEMCACHED: write_memcached,
+}
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated record")
+    return data
+
+
+def read_compact(f):
+    """
+    :return: an iterator over the (key, row) writes stored in the compact
+    file 'f', positioned after the MAGIC line
+    """
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) != RECORD_HEADER.size:
+            raise ValueError("Truncated record")
+        key_size, flags, expiry, value_size = RECORD_HEADER.unpack(header)
+        key = decode_key(_read_exactly(f, key_size))
+        yield key, (_read_exactly(f, value_size), flags, expiry)
+
+
+def read_memcached(f, now=None):
+    """
+    :return: an iterator over the (key, row) writes made by the 'set' and
+    'delete' commands of the memcached protocol stream 'f'. Other commands
+    are skipped, along with the data block of other storage commands, whose
+    effect depends on what was stored.
+    """
+    if now is None:
+        now = int(time.time())
+    for line in f:
+        parts = line.split()
+        if not parts:
+            continue
+        num_args = STORAGE_ARGS.get(parts[0])
+        if num_args is not None:
+            # The data block has to be read past even if the command is
+            # skipped, so that it is not taken for commands
+            if len(parts) - 1 not in (num_args, num_args + 1):
+                raise ValueError("Bad command line {!r}".format(line))
+            key = decode_key(parts[1])
+            flags, exptime, size = (int(part) for part in parts[2:5])
+            data = _read_exactly(f, size + 2)
+            if data[size:] != b"\r\n":
+                raise ValueError("Bad data chunk for key {!r}".format(key))
+            if parts[0] == b"set":
+                yield key, (data[:size], flags, expires_at(exptime, now))
+        elif parts[0] == b"delete" and len(parts) in (2, 3):
+            yield decode_key(parts[1]), None
+
+
+def read_records(f):
+    """
+    :return: an iterator over the (key, row) writes stored in the buffered
+    binary file 'f', either in the compact format or as a memcached
+    protocol stream
+    """
+    if f.peek(len(MAGIC))[:len(MAGIC)] == MAGIC:
+        f.read(len(MAGIC))
+        return read_compact(f)
+    return read_memcached(f)
+
+
+def export_items(data_layer, out, fmt=FORMAT_COMPACT):
+    """
+    Writes every item that has not expired to 'out', with compressed values
+    decompressed. Items are read a page at a time, so memory use does not
+    grow with the size of the database.
+
+    :return: the number of items written
+    """
+    rows = map(decompress_row, data_layer.scan(fields=SCAN_VALUES))
+    return WRITERS[fmt](rows, out)
+
+
+def import_items(data_layer, f, batch_size=10000):
+    """
+    Loads the items read from 'f' with read_records, 'batch_size' of them per
+    transaction. Only one batch is held in memory at a time.
+
+    :return: the number of writes read
+    """
+    records = read_records(f)
+    count = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return count
+        data_layer.load(batch)
+        count += len(batch)
+
+
+def checkpoint(db):
+    """
+    Moves the write-ahead log of 'db' into the database file and syncs it,
+    making a load done with relaxed durability settings durable.
+    """
+    with closing(sqlite3.connect(db)) as con:
+        con.execute("PRAGMA synchronous = FULL")
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
@@ -0,0 +1,88 @@
+from time import perf_counter
+import zlib
+
+
+class Compressor:
+    """
+    Compresses values of at least 'threshold' bytes with zlib before they are
+    stored, and keeps count of how much that saves and costs.
+
+    Values that do not get smaller are stored as they are. The zlib format is
+    the one memcached client libraries use for their own compression, so
+    stored values can be handed to clients which decompress them themselves.
+    """
+
+    def __init__(self, threshold=None, level=6):
+        """
+            :param threshold: size in bytes from which values are compressed,
+            None to never compress them
+            :param level: zlib compression level, from 1 (fastest) to 9
+            (smallest)
+        """
+        self.threshold = threshold
+        self.level = level
+        self.compressed = 0
+        self.incompressible = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def compress(self, value):
+        """
+        :return: a (value, compressed) pair, 'value' being the data to store
+        and 'compressed' true if it was compressed
+        """
+        if self.threshold is None or len(value) < self.threshold:
+            return value, False
+
+        start = perf_counter()
+        data = zlib.compress(value, self.level)
+        self.compress_seconds += perf_counter() - start
+        if len(data) >= len(value):
+            self.incompressible += 1
+            return value, False
+
+        self.compressed += 1
+        self.bytes_in += len(value)
+        self.bytes_out += len(data)
+        return data, True
+
+    def decompress(self, value):
+        start = perf_counter()
+        value = zlib.decompress(value)
+        self.decompress_seconds += perf_counter() - start
+        self.decompressed += 1
+        return value
+
+    def stats(self):
+        """
+        :return: a dictionary with the compressor's counters. 'ratio' is the
+        size of the values compressed divided by their compressed size.
+        """
+        return {
+            "threshold": self.threshold or 0,
+            "values": self.compressed,
+            "incompressible": self.incompressible,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": round(self.bytes_in / self.bytes_out, 3)
+            if self.bytes_out else 0,
+            "compress_us": int(self.compress_seconds * 1000000),
+            "decompressed": self.decompressed,
+            "decompress_us": int(self.decompress_seconds * 1000000),
+        }
+
+
+def decompress_row(row):
+    """
+    :return: 'row', a dictionary as returned by the data layers, with its
+    value decompressed if it was stored compressed. Rows without a value are
+    returned as they are.
+    """
+    if not row.get("compressed") or "value" not in row:
+        return row
+    row = dict(row, value=zlib.decompress(row["value"]))
+    del row["compressed"]
+    return row
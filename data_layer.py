@@ -1,5 +1,296 @@
-from contextlib import closing
+from contextlib import contextmanager
+from schema import (
+    DEFAULT_LOG_RETENTION, check_schema_version, check_sqlite_version,
+    create_change_log, create_replica_state
+)
+import functools
+import queue
 import sqlite3
+import threading
+import time
+import zlib
+
+
+# Named PRAGMA profiles for the connections held by the DataLayer. Every
+# profile uses WAL journaling so readers never block the writer; they differ
+# in how hard SQLite works to make each commit durable and in how much memory
+# is traded for fewer disk reads.
+TUNING_SAFE = "safe"
+TUNING_DEFAULT = "default"
+TUNING_FAST = "fast"
+TUNING_PROFILES = {
+    TUNING_SAFE: {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "mmap_size": 0,
+        "cache_size": -2000,
+        "busy_timeout": 5000,
+    },
+    TUNING_DEFAULT: {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+    },
+    TUNING_FAST: {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "mmap_size": 1024 * 1024 * 1024,
+        "cache_size": -256 * 1024,
+        "busy_timeout": 5000,
+    },
+}
+
+# Number of prepared statements each connection keeps around
+CACHED_STATEMENTS = 256
+
+# Like memcached, expiration times of up to 30 days are taken to be relative
+# to the current time and larger ones to be absolute unix times.
+MAX_RELATIVE_EXPTIME = 60 * 60 * 24 * 30
+# Stored as the expiration time of items that never expire
+NEVER_EXPIRES = 0
+
+# Memcached flags are 32-bit numbers. The bits above them are reserved for
+# the storage and never shown to clients; this one marks compressed values.
+CLIENT_FLAGS = (1 << 32) - 1
+COMPRESSED_FLAG = 1 << 32
+
+# Accesses are recorded with this resolution in seconds: keys accessed
+# within the same interval count as equally recent, which saves rewriting
+# the access time of keys read over and over
+ACCESS_RESOLUTION = 60
+
+# incr and decr work on unsigned 64-bit numbers, like memcached's
+MAX_COUNTER = (1 << 64) - 1
+
+# Keys are text to the data layers and stored as bytes. Bytes which are not
+# valid UTF-8 are decoded to lone surrogates, so any key read off the wire
+# is stored as it was sent and read back the same.
+KEY_ENCODING = "utf-8"
+KEY_ERRORS = "surrogateescape"
+
+# What DataLayer.scan returns for each item: only the key, the key and the
+# item's flags, expiration time and size, or all of those and the value
+SCAN_KEYS = "keys"
+SCAN_METADATA = "metadata"
+SCAN_VALUES = "values"
+
+
+def expires_at(exptime, now=None):
+    """
+    Converts a memcached expiration time into the absolute unix time stored
+    in the database.
+
+    :param exptime: 0 for items that never expire, a number of seconds of up
+    to 30 days from now or an absolute unix time. Negative values expire the
+    item immediately.
+    :param now: the current unix time, defaults to time.time()
+    :return: the unix time at which the item expires, or NEVER_EXPIRES
+    """
+    if exptime == 0:
+        return NEVER_EXPIRES
+    if now is None:
+        now = int(time.time())
+    if exptime < 0:
+        return now
+    if exptime <= MAX_RELATIVE_EXPTIME:
+        return now + exptime
+    return exptime
+
+
+def storage_flags(row):
+    """
+    :return: the flags to store for 'row', a dictionary as returned by the
+    data layers, so that it reads back the same
+    """
+    if row.get("compressed"):
+        return row["flags"] | COMPRESSED_FLAG
+    return row["flags"]
+
+
+def encode_key(key):
+    """
+    :return: the bytes stored for the text 'key'
+    """
+    return key.encode(KEY_ENCODING, KEY_ERRORS)
+
+
+def decode_key(data):
+    """
+    :return: the text key stored as the bytes-like 'data'
+    """
+    return str(data, KEY_ENCODING, KEY_ERRORS)
+
+
+def access_bucket(now=None):
+    """
+    :return: the access time recorded for keys accessed at unix time 'now',
+    defaulting to time.time()
+    """
+    if now is None:
+        now = time.time()
+    return int(now) // ACCESS_RESOLUTION
+
+
+def is_expired(row, now=None):
+    """
+    :return: true if the item in 'row' has expired
+    """
+    expiry = row.get("expires_at", NEVER_EXPIRES)
+    if expiry == NEVER_EXPIRES:
+        return False
+    if now is None:
+        now = int(time.time())
+    return expiry <= now
+
+
+def prefix_range(prefix):
+    """
+    :return: the (start, end) key range holding exactly the keys starting
+    with 'prefix', 'end' being exclusive or None if there is no upper bound
+    """
+    # Keys are compared by their stored bytes, so the bound is worked out
+    # on them: the bytes of keys which are not valid UTF-8 may sort between
+    # those of a character and the next one, which can be a surrogate that
+    # can't be stored. Any bytes decode to a key which is stored as them.
+    end = encode_key(prefix).rstrip(b"\xff")
+    if not end:
+        return prefix, None
+    return prefix, decode_key(end[:-1] + bytes([end[-1] + 1]))
+
+
+def incremented(value, delta):
+    """
+    Computes the result of incr and decr. Incrementing wraps around at
+    MAX_COUNTER and decrementing stops at 0, as with memcached.
+
+    :param value: the stored value, the decimal digits of a number of at most
+    MAX_COUNTER
+    :param delta: the number to add, negative to decrement
+    :return: the new value as decimal digits, or None if 'value' is not a
+    number
+    """
+    if not value.isdigit() or len(value) > len(str(MAX_COUNTER)):
+        return None
+    number = int(value)
+    if number > MAX_COUNTER:
+        return None
+    number = max(number + delta, 0) & MAX_COUNTER
+    return str(number).encode("ascii")
+
+
+# Python functions made available to the SQL statements of every connection,
+# by name: (number of arguments, function)
+SQL_FUNCTIONS = {
+    "DECOMPRESS": (1, zlib.decompress),
+    "INCREMENTED": (2, incremented),
+}
+
+
+class NonNumericValue(ValueError):
+    """
+    Raised by incr_value for keys whose value is not a number.
+    """
+
+
+def tuning_pragmas(tuning=TUNING_DEFAULT, **overrides):
+    """
+    Resolves a tuning profile into the PRAGMA settings to apply.
+
+    :param tuning: name of one of the TUNING_PROFILES
+    :param overrides: individual PRAGMA values replacing the profile's ones.
+    A value of None keeps the profile's setting.
+    :return: a dictionary mapping PRAGMA names to their values
+    """
+    if tuning not in TUNING_PROFILES:
+        raise ValueError("Unknown tuning profile: {}".format(tuning))
+    pragmas = dict(TUNING_PROFILES[tuning])
+    pragmas.update(
+        (name, value) for name, value in overrides.items()
+        if value is not None
+    )
+    return pragmas
+
+
+class ConnectionPool:
+    """
+    A pool of long-lived SQLite connections to one database.
+
+    Connections are opened lazily, tuned once when they are opened and then
+    reused. At most 'max_size' connections are ever open; threads asking for
+    a connection while all of them are in use wait for one to be released.
+    """
+
+    def __init__(self, db, pragmas, max_size=8,
+                 cached_statements=CACHED_STATEMENTS, functions=None):
+        """
+            :param db: name of the SQLite database
+            :param pragmas: PRAGMA settings applied to every new connection
+            :param max_size: maximum number of open connections
+            :param cached_statements: prepared statement cache size of each
+            connection
+            :param functions: SQL functions registered on every new
+            connection, as a dictionary like SQL_FUNCTIONS
+        """
+        self.db = db
+        self.pragmas = pragmas
+        self.max_size = max_size
+        self.cached_statements = cached_statements
+        self.functions = functions or {}
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        con = sqlite3.connect(
+            self.db,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        # journal_mode has to be set first, the rest can go in any order
+        for name in sorted(self.pragmas, key=lambda n: n != "journal_mode"):
+            con.execute("PRAGMA {} = {}".format(name, self.pragmas[name]))
+        for name, (num_args, function) in self.functions.items():
+            con.create_function(name, num_args, function, deterministic=True)
+        return con
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._all) < self.max_size:
+                con = self._open()
+                self._all.append(con)
+                return con
+
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of a with block.
+        """
+        con = self._acquire()
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            self._idle.put(con)
+
+    def close(self):
+        """
+        Closes every connection opened by the pool.
+        """
+        with self._lock:
+            for con in self._all:
+                con.close()
+            self._all = []
+            self._idle = queue.LifoQueue()
 
 
 class DataLayer:
@@ -7,13 +298,198 @@ class DataLayer:
     Data abstraction layer for interacting with key value pairs
     """
 
-    def __init__(self, db):
+    # Every write gives the key a CAS value larger than any given before,
+    # deleted keys' included, so that a stale cas never matches. The
+    # triggers on ITEMS raise CAS_SEQUENCE to it within the write's
+    # statement, which keeps it unique when several processes write to the
+    # database.
+    NEXT_CAS = "(SELECT VALUE + 1 FROM CAS_SEQUENCE)"
+    # Writes count as accesses
+    ACCESS_NOW = "(CAST(strftime('%s', 'now') AS INTEGER) / {})".format(
+        ACCESS_RESOLUTION
+    )
+    # Assignments made by every write of an existing key
+    WRITTEN = "CAS = " + NEXT_CAS + ", LAST_ACCESS = " + ACCESS_NOW
+    # Sets are not an upsert like LOAD_VALUE, since apply_batch has to tell
+    # whether each key existed: a WriteBatcher answers the deletes collapsed
+    # into a set of the same key with it. So first try to update the key if
+    # it exists...
+    UPDATE_VALUE = """
+        UPDATE ITEMS
+        SET VALUE = ?, FLAGS = ?, EXPIRES_AT = ?, """ + WRITTEN + """
+        WHERE KEY = ?
+    """
+    # ...and if the key did not exist, then insert a row for it.
+    INSERT_COLUMNS = "(KEY, VALUE, FLAGS, EXPIRES_AT, CAS, LAST_ACCESS)"
+    INSERT_VALUES = "VALUES (?, ?, ?, ?, " + NEXT_CAS + ", " + ACCESS_NOW + ")"
+    INSERT_VALUE = \
+        "INSERT INTO ITEMS " + INSERT_COLUMNS + " " + INSERT_VALUES
+    # Expired rows are left in place until the reaper gets to them, so every
+    # read has to skip them
+    NOT_EXPIRED = "(EXPIRES_AT = 0 OR EXPIRES_AT > ?)"
+    # Multi-key reads are split into queries of at most this many keys, well
+    # below SQLite's limit on the number of parameters of a statement
+    MAX_KEYS_PER_QUERY = 256
+    SELECT_VALUES = """
+        SELECT KEY, VALUE, FLAGS, EXPIRES_AT{} FROM ITEMS
+        WHERE KEY IN ({}) AND
+    """ + NOT_EXPIRED
+    SELECT_ALL_VALUES = """
+        SELECT KEY, VALUE, FLAGS, EXPIRES_AT FROM ITEMS
+        WHERE
+    """ + NOT_EXPIRED
+    # Columns read by scan. The size is a column of its own, so the
+    # metadata modes never read the values.
+    SCAN_COLUMNS = {
+        SCAN_KEYS: "KEY",
+        SCAN_METADATA: "KEY, FLAGS, EXPIRES_AT, SIZE",
+        SCAN_VALUES: "KEY, FLAGS, EXPIRES_AT, SIZE, VALUE",
+    }
+    SCAN_FIELDS = {
+        SCAN_KEYS: ("key",),
+        SCAN_METADATA: ("key", "flags", "expires_at", "size"),
+        SCAN_VALUES: ("key", "flags", "expires_at", "size", "value"),
+    }
+    # Number of rows scan reads per query
+    SCAN_PAGE_SIZE = 1000
+    # Expired rows are left to the reaper, so that deleting an expired key
+    # reports it as not found
+    DELETE_VALUE = \
+        "DELETE FROM ITEMS WHERE KEY = ? AND " + NOT_EXPIRED
+    # The 'EXPIRES_AT > 0' term lets SQLite use the partial index on
+    # EXPIRES_AT, which only holds rows that can expire
+    DELETE_EXPIRED = """
+        DELETE FROM ITEMS WHERE KEY IN (
+            SELECT KEY FROM ITEMS
+            WHERE EXPIRES_AT > 0 AND EXPIRES_AT <= ?
+            LIMIT ?
+        )
+    """
+
+    # Used by load, which only needs the end result of each batch. This is
+    # an upsert rather than INSERT OR REPLACE, whose implicit deletes would
+    # not fire the triggers keeping STORE_USAGE up to date.
+    LOAD_VALUE = INSERT_VALUE + """
+        ON CONFLICT (KEY) DO UPDATE SET
+            VALUE = excluded.VALUE, FLAGS = excluded.FLAGS,
+            EXPIRES_AT = excluded.EXPIRES_AT, CAS = excluded.CAS,
+            LAST_ACCESS = excluded.LAST_ACCESS
+    """
+    DELETE_KEY = "DELETE FROM ITEMS WHERE KEY = ?"
+
+    # The conditional writes of the memcached protocol. Each is a single
+    # statement, so the check and the write happen atomically inside SQLite
+    # without a round trip through Python in between. Expired rows count as
+    # missing: add overwrites them, the others leave them alone.
+    ADD_VALUE = LOAD_VALUE + " WHERE NOT " + NOT_EXPIRED
+    REPLACE_VALUE = """
+        UPDATE ITEMS
+        SET VALUE = ?, FLAGS = ?, EXPIRES_AT = ?, """ + WRITTEN + """
+        WHERE KEY = ? AND """ + NOT_EXPIRED
+    # cas only stores the value if the key's CAS value is still the one the
+    # client read with gets; if it is not, CAS_EXISTS finds out whether the
+    # key is there at all
+    CAS_VALUE = REPLACE_VALUE + " AND CAS = ?"
+    CAS_EXISTS = "SELECT 1 FROM ITEMS WHERE KEY = ? AND " + \
+        NOT_EXPIRED
+    # Appending to a compressed value decompresses it; the result is stored
+    # uncompressed. Concatenation yields text, which is cast back to bytes.
+    PLAIN_VALUE = "CASE WHEN FLAGS & {} THEN DECOMPRESS(VALUE) " \
+        "ELSE VALUE END".format(COMPRESSED_FLAG)
+    CONCAT_VALUE = """
+        UPDATE ITEMS
+        SET VALUE = CAST({} AS BLOB), FLAGS = FLAGS & {},
+            """ + WRITTEN + """
+        WHERE KEY = ? AND """ + NOT_EXPIRED
+    APPEND_VALUE = CONCAT_VALUE.format(PLAIN_VALUE + " || ?", CLIENT_FLAGS)
+    PREPEND_VALUE = CONCAT_VALUE.format("? || " + PLAIN_VALUE, CLIENT_FLAGS)
+    # Non-numeric values are left as they are and returned, to tell them
+    # apart from missing keys
+    INCR_VALUE = """
+        UPDATE ITEMS
+        SET VALUE = IFNULL(INCREMENTED(VALUE, ?), VALUE),
+            """ + WRITTEN + """
+        WHERE KEY = ? AND """ + NOT_EXPIRED + """
+        RETURNING VALUE
+    """
+    TOUCH_VALUE = """
+        UPDATE ITEMS
+        SET EXPIRES_AT = ?, LAST_ACCESS = """ + ACCESS_NOW + """
+        WHERE KEY = ? AND """ + NOT_EXPIRED
+
+    # Keys read are remembered and their access time written out in batches
+    # by record_accesses. Keys already marked as accessed in the current
+    # interval are not written again.
+    RECORD_ACCESS = """
+        UPDATE ITEMS SET LAST_ACCESS = ?
+        WHERE KEY = ? AND LAST_ACCESS < ?
+    """
+    # Upper limit for the number of keys remembered between two calls to
+    # record_accesses; further keys read are not recorded
+    MAX_TRACKED_ACCESSES = 100000
+    SELECT_USAGE = "SELECT ITEMS, BYTES FROM STORE_USAGE"
+    # Walks the index on LAST_ACCESS from the least recently used key
+    SELECT_LEAST_RECENT = """
+        SELECT KEY, LENGTH(KEY) + SIZE FROM ITEMS
+        ORDER BY LAST_ACCESS LIMIT ?
+    """
+
+    # Replication (see replication.py). The change log lists the keys
+    # written; readers of it get the rows as they are now, so that a key
+    # written several times is sent once.
+    SELECT_LOG_ID = "SELECT LOG_ID FROM CHANGE_LOG_INFO"
+    SELECT_LOG_HEAD = \
+        "SELECT seq FROM sqlite_sequence WHERE name = 'CHANGE_LOG'"
+    SELECT_LOG_START = "SELECT MIN(SEQ) FROM CHANGE_LOG"
+    SELECT_CHANGES = """
+        SELECT SEQ, KEY FROM CHANGE_LOG WHERE SEQ > ? ORDER BY SEQ LIMIT ?
+    """
+    # Rows are sent as they are stored, expired ones included, so that
+    # replicas store them the same
+    SELECT_STORED = """
+        SELECT KEY, VALUE, FLAGS, EXPIRES_AT FROM ITEMS WHERE KEY IN ({})
+    """
+    SELECT_REPLICA_STATE = """
+        SELECT LOG_ID, POSITION FROM REPLICA_STATE
+    """
+    UPDATE_REPLICA_STATE = """
+        UPDATE REPLICA_STATE SET LOG_ID = ?, POSITION = ?
+    """
+
+    def __init__(self, db, tuning=TUNING_DEFAULT, pool_size=8,
+                 compressor=None, track_access=False, **pragmas):
         """
-            :param db: name of the SQLite database
+            :param db: name of the SQLite database, which has to have the
+            current version of the schema
+            :param tuning: name of the PRAGMA profile to open connections with
+            :param pool_size: maximum number of connections kept open
+            :param compressor: a Compressor applied to the values written, or
+            None to store them as they are
+            :param track_access: whether to remember the keys read, for
+            record_accesses
+            :param pragmas: individual PRAGMA values (synchronous, mmap_size,
+            cache_size, busy_timeout) overriding the profile
         """
+        check_sqlite_version()
         self.db = db
+        self.compressor = compressor
+        self.track_access = track_access
+        # Keys read since the last call to record_accesses
+        self.accessed = set()
+        self.pool = ConnectionPool(
+            db, tuning_pragmas(tuning, **pragmas), max_size=pool_size,
+            functions=SQL_FUNCTIONS
+        )
+        with self.pool.connection() as con:
+            check_schema_version(con)
+
+    def close(self):
+        """
+        Closes all database connections held by this data layer.
+        """
+        self.pool.close()
 
-    def set_value(self, key, value, flags):
+    def set_value(self, key, value, flags, exptime=0):
         """
         Sets or replaces 'key' with 'value' and also stores the associated
         'flags' value.
@@ -21,73 +497,356 @@ class DataLayer:
         :param key: The key to be stored (text)
         :param value: The value (binary) to be stored for this key
         :param flags: The flags (integer) to be stored for this key
+        :param exptime: The expiration time of the key, in memcached's
+        format (see expires_at)
         :return: nothing
         """
-        with closing(sqlite3.connect(self.db)) as con:
+        self.apply_batch([(key, (value, flags, expires_at(exptime)))])
+
+    def apply_batch(self, writes):
+        """
+        Applies a batch of sets and deletes in a single transaction.
+
+        :param writes: an iterable of (key, row) pairs. 'row' is a
+        (value, flags, expires_at) tuple for keys to be set, with the absolute
+        expiration time returned by expires_at, and None for keys to be
+        deleted.
+        :return: a dictionary mapping each key to true if a row for it
+        existed before the batch was applied, false otherwise.
+        """
+        existed = {}
+        now = int(time.time())
+        with self.pool.connection() as con:
+            with con:
+                for key, row in writes:
+                    stored_key = encode_key(key)
+                    if row is None:
+                        cur = con.execute(
+                            self.DELETE_VALUE, (stored_key, now)
+                        )
+                        existed[key] = cur.rowcount > 0
+                        continue
+
+                    value, flags, expiry = self._encode(row)
+                    cur = con.execute(
+                        self.UPDATE_VALUE, (value, flags, expiry, stored_key)
+                    )
+                    existed[key] = cur.rowcount > 0
+                    if not existed[key]:
+                        con.execute(
+                            self.INSERT_VALUE,
+                            (stored_key, value, flags, expiry)
+                        )
+        return existed
+
+    def _execute(self, statement, params):
+        """
+        Runs a single write statement in its own transaction.
+
+        :return: true if it changed a row
+        """
+        with self.pool.connection() as con:
+            with con:
+                return con.execute(statement, params).rowcount > 0
+
+    def add_value(self, key, value, flags, exptime=0):
+        """
+        Stores 'value' for 'key' only if the key does not exist yet.
+
+        :return: true if the value was stored
+        """
+        value, flags, expiry = self._encode(
+            (value, flags, expires_at(exptime))
+        )
+        return self._execute(
+            self.ADD_VALUE,
+            (encode_key(key), value, flags, expiry, int(time.time()))
+        )
+
+    def replace_value(self, key, value, flags, exptime=0):
+        """
+        Stores 'value' for 'key' only if the key already exists.
+
+        :return: true if the value was stored
+        """
+        value, flags, expiry = self._encode(
+            (value, flags, expires_at(exptime))
+        )
+        return self._execute(
+            self.REPLACE_VALUE,
+            (value, flags, expiry, encode_key(key), int(time.time()))
+        )
+
+    def cas_value(self, key, value, flags, exptime, cas):
+        """
+        Stores 'value' for 'key' only if nobody has written the key since its
+        CAS value was read.
+
+        :param cas: the CAS value of the key as returned by get_values
+        :return: true if the value was stored, false if the key has been
+        written since, None if it does not exist
+        """
+        value, flags, expiry = self._encode(
+            (value, flags, expires_at(exptime))
+        )
+        key = encode_key(key)
+        now = int(time.time())
+        with self.pool.connection() as con:
             with con:
-                # With newer versions of SQLite this can be handled more
-                # elegantly in one statement using ON CONFLICT, but
-                # unfortunately, Python 3.7 is bound to an older version of
-                # SQLite.
-
-                # First try to update the key if it exists
-                con.execute("""
-                    UPDATE KEY_VALUE_PAIRS
-                    SET VALUE = ?, FLAGS = ?
-                    WHERE KEY = ?
-                """, (value, flags, key)
-                            )
-
-                # If they key did not exist, then insert a row for it
-                con.execute("""
-                    INSERT INTO KEY_VALUE_PAIRS (KEY, VALUE, FLAGS)
-                    SELECT ?, ?, ?
-                    WHERE (SELECT CHANGES() = 0)
-                """, (key, value, flags))
-
-    def get_values(self, keys):
+                if con.execute(
+                    self.CAS_VALUE, (value, flags, expiry, key, now, cas)
+                ).rowcount > 0:
+                    return True
+                if con.execute(self.CAS_EXISTS, (key, now)).fetchone():
+                    return False
+                return None
+
+    def append_value(self, key, value):
+        """
+        Adds 'value' at the end of the existing value of 'key', keeping its
+        flags and expiration time.
+
+        :return: true if the key existed
+        """
+        return self._execute(
+            self.APPEND_VALUE, (value, encode_key(key), int(time.time()))
+        )
+
+    def prepend_value(self, key, value):
+        """
+        Adds 'value' at the start of the existing value of 'key', keeping its
+        flags and expiration time.
+
+        :return: true if the key existed
+        """
+        return self._execute(
+            self.PREPEND_VALUE, (value, encode_key(key), int(time.time()))
+        )
+
+    def incr_value(self, key, delta):
+        """
+        Adds 'delta' to the number stored for 'key', see incremented.
+
+        :param delta: the number to add, negative to decrement
+        :return: the new number, or None if the key does not exist
+        :raises NonNumericValue: if the value of 'key' is not a number
+        """
+        with self.pool.connection() as con:
+            with con:
+                rows = con.execute(
+                    self.INCR_VALUE,
+                    (delta, encode_key(key), int(time.time()))
+                ).fetchall()
+        if not rows:
+            return None
+        value = rows[0][0]
+        # Numbers are stored without leading zeros, so anything that does not
+        # read back the same is a value that was left alone
+        if incremented(value, 0) != value:
+            raise NonNumericValue(key)
+        return int(value)
+
+    def touch_value(self, key, exptime):
+        """
+        Changes the expiration time of 'key' without touching its value.
+
+        :return: true if the key existed
+        """
+        return self._execute(
+            self.TOUCH_VALUE,
+            (expires_at(exptime), encode_key(key), int(time.time()))
+        )
+
+    def load(self, writes):
+        """
+        Applies a batch of sets and deletes in a single transaction like
+        apply_batch, but with one executemany per kind of write and without
+        finding out which keys existed, for bulk loading.
+
+        :param writes: an iterable of (key, row) pairs as taken by
+        apply_batch. Only the last write of each key is applied.
+        :return: the number of keys written
+        """
+        latest = dict(writes)
+        with self.pool.connection() as con:
+            with con:
+                self._load(con, latest, self._encode)
+        return len(latest)
+
+    def _load(self, con, latest, encode):
+        """
+        Applies the writes of 'latest', a dictionary mapping keys to rows as
+        taken by apply_batch, with 'encode' turning each row into the
+        (value, flags, expires_at) to store.
+        """
+        con.executemany(self.DELETE_KEY, (
+            (encode_key(key),)
+            for key, row in latest.items() if row is None
+        ))
+        con.executemany(self.LOAD_VALUE, (
+            (encode_key(key),) + encode(row)
+            for key, row in latest.items() if row is not None
+        ))
+
+    def _encode(self, row):
+        """
+        :return: the (value, flags, expires_at) to store for 'row'
+        """
+        value, flags, expiry = row
+        if self.compressor is not None:
+            value, compressed = self.compressor.compress(value)
+            if compressed:
+                flags |= COMPRESSED_FLAG
+        return value, flags, expiry
+
+    def get_values(self, keys, with_cas=False):
         """
         Fetches data for the requested keys.
 
         :param keys: a list of keys to fetch data for.
-        :return: a generator which iterates over each key/value pair returning
-        a dictionary containing mapping the key, value and flags to
-        their values in each iteration.
+        :param with_cas: whether to return the CAS values of the keys too
+        :return: a list with a dictionary mapping the key, value, flags and
+        expires_at, and 'cas' if requested, to their values for each key that
+        was found and has not expired. Values stored compressed are returned
+        compressed, with 'compressed' set to true.
         """
-        with closing(sqlite3.connect(self.db)) as con:
-            con.row_factory = sqlite3.Row
-            with con:
-                key_placeholders = ",".join("?" * len(keys))
-                query = \
-                    "SELECT * FROM KEY_VALUE_PAIRS WHERE KEY IN ({})".format(
-                        key_placeholders
+        keys = [encode_key(key) for key in dict.fromkeys(keys)]
+        now = int(time.time())
+        values = []
+        with self.pool.connection() as con:
+            for start in range(0, len(keys), self.MAX_KEYS_PER_QUERY):
+                chunk = keys[start:start + self.MAX_KEYS_PER_QUERY]
+                # Pad the chunk to a power of two by repeating its last key,
+                # so that only a handful of distinct queries are ever
+                # prepared and they all stay in the statement cache
+                size = 1
+                while size < len(chunk):
+                    size *= 2
+                chunk.extend(chunk[-1:] * (size - len(chunk)))
+                chunk.append(now)
+                values.extend(
+                    DataLayer._row_to_dict(row)
+                    for row in con.execute(
+                        self._select_values(size, with_cas), chunk
                     )
+                )
+        if self.track_access:
+            self.note_accesses(row["key"] for row in values)
+        return values
 
-                for row in con.execute(query, keys):
-                    yield DataLayer._row_to_dict(row)
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _select_values(num_keys, with_cas=False):
+        return DataLayer.SELECT_VALUES.format(
+            ", CAS" if with_cas else "", ",".join("?" * num_keys)
+        )
 
     def get_all_values(self):
         """
-        Fetch all key/value pairs from the database.
+        Fetch all key/value pairs that have not expired from the database.
 
         :return: a generator which iterates over each key/value pair returning
-        a dictionary containing mapping the key, value and flags to
-        their values in each iteration.
+        a dictionary containing mapping the key, value, flags and expires_at
+        to their values in each iteration.
         """
-        with closing(sqlite3.connect(self.db)) as con:
-            con.row_factory = sqlite3.Row
-            with con:
-                query = "SELECT * FROM KEY_VALUE_PAIRS"
-                for row in con.execute(query):
-                    yield DataLayer._row_to_dict(row)
+        with self.pool.connection() as con:
+            now = int(time.time())
+            for row in con.execute(self.SELECT_ALL_VALUES, (now,)):
+                yield DataLayer._row_to_dict(row)
+
+    def scan(self, start=None, end=None, after=None, limit=None,
+             fields=SCAN_VALUES):
+        """
+        Iterates in key order over the items that have not expired, using the
+        primary key index to find the ones in the requested range.
+
+        Items are read a page of SCAN_PAGE_SIZE at a time, each page with its
+        own query continuing after the last key of the previous one, so that
+        memory use is bounded and no read transaction stays open while the
+        caller consumes the items.
+
+        :param start: smallest key to return
+        :param end: only return keys smaller than this
+        :param after: only return keys larger than this, to continue a scan
+        which stopped at that key
+        :param limit: maximum number of items to return
+        :param fields: SCAN_KEYS, SCAN_METADATA or SCAN_VALUES
+        :return: a generator of dictionaries mapping 'key', and depending on
+        'fields', 'flags', 'expires_at', 'size' and 'value' to their values
+        """
+        names = self.SCAN_FIELDS[fields]
+        lower = start
+        inclusive = True
+        if after is not None and (start is None or after >= start):
+            lower = after
+            inclusive = False
+        if lower is not None:
+            lower = encode_key(lower)
+        if end is not None:
+            end = encode_key(end)
+
+        while limit is None or limit > 0:
+            page_size = self.SCAN_PAGE_SIZE
+            if limit is not None:
+                page_size = min(page_size, limit)
+            params = [bound for bound in (lower, end) if bound is not None]
+            params.extend([int(time.time()), page_size])
+            query = self._scan_query(
+                fields, lower is not None, inclusive, end is not None
+            )
+            with self.pool.connection() as con:
+                rows = con.execute(query, params).fetchall()
+
+            for row in rows:
+                row = dict(zip(names, row))
+                row["key"] = decode_key(row["key"])
+                yield self._decode_flags(row)
+            if len(rows) < page_size:
+                return
+            if limit is not None:
+                limit -= len(rows)
+            lower = rows[-1][0]
+            inclusive = False
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _scan_query(fields, has_lower, inclusive, has_end):
+        conditions = []
+        if has_lower:
+            conditions.append("KEY >= ?" if inclusive else "KEY > ?")
+        if has_end:
+            conditions.append("KEY < ?")
+        conditions.append(DataLayer.NOT_EXPIRED)
+        return "SELECT {} FROM ITEMS WHERE {} " \
+            "ORDER BY KEY LIMIT ?".format(
+                DataLayer.SCAN_COLUMNS[fields], " AND ".join(conditions)
+            )
 
     @staticmethod
     def _row_to_dict(row):
-        return {
-            "key": row["key"],
-            "value": row["value"],
-            "flags": row["flags"],
+        key, value, flags, expiry = row[:4]
+        row_dict = {
+            "key": decode_key(key),
+            "value": value,
+            "flags": flags,
+            "expires_at": expiry,
         }
+        if len(row) > 4:
+            row_dict["cas"] = row[4]
+        return DataLayer._decode_flags(row_dict)
+
+    @staticmethod
+    def _decode_flags(row):
+        """
+        Splits the stored flags of 'row' into the client's flags and, for
+        compressed values, 'compressed' set to true. Compressed values are
+        returned as they are stored.
+        """
+        flags = row.get("flags")
+        if flags is not None and flags & COMPRESSED_FLAG:
+            row["flags"] = flags & CLIENT_FLAGS
+            row["compressed"] = True
+        return row
 
     def delete_value(self, key):
         """
@@ -97,11 +856,244 @@ class DataLayer:
         :return: true if the requested key was found and deleted,
         false otherwise.
         """
-        with closing(sqlite3.connect(self.db)) as con:
+        with self.pool.connection() as con:
             with con:
-                con.execute(
-                    "DELETE FROM KEY_VALUE_PAIRS WHERE KEY = ?", (key,)
+                cur = con.execute(
+                    self.DELETE_VALUE, (encode_key(key), int(time.time()))
                 )
-                cur = con.execute("SELECT CHANGES()")
-                changes = cur.fetchone()[0]
-                return changes > 0
+                return cur.rowcount > 0
+
+    def note_accesses(self, keys):
+        """
+        Remembers that 'keys' have been read, for the next call to
+        record_accesses. Does nothing unless access tracking is on.
+        """
+        # Called from several threads. Adding to a set is atomic, and the
+        # odd key lost while record_accesses swaps the set does not matter.
+        if self.track_access and \
+                len(self.accessed) < self.MAX_TRACKED_ACCESSES:
+            self.accessed.update(keys)
+
+    def record_accesses(self, now=None):
+        """
+        Writes out the access time of the keys read since the last call, all
+        in one transaction.
+
+        :param now: the current unix time, defaults to time.time()
+        :return: the number of keys whose access time changed
+        """
+        accessed, self.accessed = self.accessed, set()
+        if not accessed:
+            return 0
+        bucket = access_bucket(now)
+        with self.pool.connection() as con:
+            with con:
+                cur = con.executemany(
+                    self.RECORD_ACCESS,
+                    ((bucket, encode_key(key), bucket) for key in accessed)
+                )
+                return cur.rowcount
+
+    def usage(self):
+        """
+        :return: a dictionary with the number of keys stored, 'items', and
+        their total size in bytes, 'bytes', expired keys included
+        """
+        with self.pool.connection() as con:
+            items, size = con.execute(self.SELECT_USAGE).fetchone()
+        return {"items": items, "bytes": size}
+
+    def evict(self, max_items=None, max_bytes=None, limit=500):
+        """
+        Deletes up to 'limit' of the least recently used keys, as many as it
+        takes to bring the store within 'max_items' keys and 'max_bytes'
+        bytes.
+
+        :param max_items: maximum number of keys, None for no limit
+        :param max_bytes: maximum total size of the keys, None for no limit
+        :param limit: maximum number of keys deleted
+        :return: a dictionary with the number of keys deleted, 'evicted',
+        their size, 'evicted_bytes', and the usage left afterwards, as
+        returned by usage
+        """
+        with self.pool.connection() as con:
+            with con:
+                items, size = con.execute(self.SELECT_USAGE).fetchone()
+                excess_items = items - max_items if max_items else 0
+                excess_bytes = size - max_bytes if max_bytes else 0
+                victims = []
+                freed = 0
+                if (excess_items > 0 or excess_bytes > 0) and limit > 0:
+                    rows = con.execute(
+                        self.SELECT_LEAST_RECENT, (limit,)
+                    ).fetchall()
+                    for key, item_size in rows:
+                        if len(victims) >= excess_items and \
+                                freed >= excess_bytes:
+                            break
+                        victims.append((key,))
+                        freed += item_size
+                    con.executemany(self.DELETE_KEY, victims)
+        return {
+            "evicted": len(victims),
+            "evicted_bytes": freed,
+            "items": items - len(victims),
+            "bytes": size - freed,
+        }
+
+    def delete_expired(self, limit, now=None):
+        """
+        Deletes up to 'limit' expired rows.
+
+        :param limit: maximum number of rows to delete
+        :param now: the current unix time, defaults to time.time()
+        :return: the number of rows deleted
+        """
+        if now is None:
+            now = int(time.time())
+        with self.pool.connection() as con:
+            with con:
+                return con.execute(self.DELETE_EXPIRED, (now, limit)).rowcount
+
+    def enable_change_log(self, retention=DEFAULT_LOG_RETENTION):
+        """
+        Starts recording the keys written in the change log, keeping the
+        last 'retention' changes (see schema.create_change_log).
+        """
+        with self.pool.connection() as con:
+            with con:
+                con.execute("BEGIN IMMEDIATE")
+                create_change_log(con, retention)
+
+    def log_position(self):
+        """
+        :return: the id of the change log and the sequence number of the
+        last change recorded in it, 0 if there is none
+        """
+        with self.pool.connection() as con:
+            with con:
+                # Both come from the same read transaction
+                con.execute("BEGIN")
+                log_id, = con.execute(self.SELECT_LOG_ID).fetchone()
+                head = con.execute(self.SELECT_LOG_HEAD).fetchone()
+        return log_id, head[0] if head else 0
+
+    def changes(self, after, limit):
+        """
+        Reads the changes recorded after position 'after' of the change log.
+
+        :param after: the sequence number of the last change already read
+        :param limit: maximum number of log entries read
+        :return: a dictionary with the writes, a list of (key, row) pairs as
+        taken by apply_changes with one write per key giving its current
+        state, the 'position' of the last entry read and the 'head' of the
+        log. None if the log no longer holds all the entries after 'after'.
+        """
+        with self.pool.connection() as con:
+            with con:
+                con.execute("BEGIN")
+                head = con.execute(self.SELECT_LOG_HEAD).fetchone()
+                head = head[0] if head else 0
+                start, = con.execute(self.SELECT_LOG_START).fetchone()
+                if after > head or after < (head if start is None
+                                            else start - 1):
+                    return None
+                entries = con.execute(
+                    self.SELECT_CHANGES, (after, limit)
+                ).fetchall()
+                keys = list(dict.fromkeys(key for _, key in entries))
+                rows = {}
+                for first in range(0, len(keys), self.MAX_KEYS_PER_QUERY):
+                    chunk = keys[first:first + self.MAX_KEYS_PER_QUERY]
+                    rows.update(
+                        (key, (value, flags, expiry))
+                        for key, value, flags, expiry in con.execute(
+                            self.SELECT_STORED.format(
+                                ",".join("?" * len(chunk))
+                            ), chunk
+                        )
+                    )
+        return {
+            "writes": [(decode_key(key), rows.get(key)) for key in keys],
+            "position": entries[-1][0] if entries else after,
+            "head": head,
+        }
+
+    def dump_items(self, after=None, limit=SCAN_PAGE_SIZE):
+        """
+        Reads the items that have not expired in key order, as they are
+        stored, to copy them into a replica.
+
+        :param after: only return keys larger than this
+        :param limit: maximum number of items returned
+        :return: a list of (key, row) writes as taken by apply_changes
+        """
+        return [
+            (row["key"], (row["value"], storage_flags(row),
+                          row["expires_at"]))
+            for row in self.scan(after=after, limit=limit)
+        ]
+
+    def scan_keys(self, after=None, limit=SCAN_PAGE_SIZE):
+        """
+        Reads the keys of the items that have not expired in key order,
+        without their values.
+
+        :param after: only return keys larger than this
+        :param limit: maximum number of keys returned
+        :return: a list of keys
+        """
+        return [
+            row["key"]
+            for row in self.scan(after=after, limit=limit, fields=SCAN_KEYS)
+        ]
+
+    def replica_state(self):
+        """
+        :return: the id of the change log this database follows as a replica
+        and the position up to which it has applied it, both None if it
+        does not follow any
+        """
+        with self.pool.connection() as con:
+            try:
+                row = con.execute(self.SELECT_REPLICA_STATE).fetchone()
+            except sqlite3.OperationalError:
+                # Not a replica yet, so the table is missing
+                return None, None
+        return row if row else (None, None)
+
+    def reset_replica(self):
+        """
+        Deletes every item and forgets the change log followed, before a
+        replica copies the items of its primary anew.
+        """
+        with self.pool.connection() as con:
+            with con:
+                con.execute("BEGIN IMMEDIATE")
+                create_replica_state(con)
+                con.execute(self.UPDATE_REPLICA_STATE, (None, None))
+                con.execute("DELETE FROM ITEMS")
+
+    def apply_changes(self, writes, log_id=None, position=None):
+        """
+        Applies writes received from a primary in a single transaction,
+        storing the rows as they are given, and records the position of the
+        primary's change log they bring the replica up to.
+
+        :param writes: (key, row) pairs as returned by changes. 'row' is a
+        (value, stored flags, expires_at) tuple, or None for deleted keys.
+        :param log_id: the id of the primary's change log
+        :param position: the position in the log the writes bring the replica
+        to, None to leave the recorded one alone
+        :return: the number of keys written
+        """
+        latest = dict(writes)
+        with self.pool.connection() as con:
+            with con:
+                con.execute("BEGIN IMMEDIATE")
+                self._load(con, latest, tuple)
+                if position is not None:
+                    con.execute(
+                        self.UPDATE_REPLICA_STATE, (log_id, position)
+                    )
+        return len(latest)
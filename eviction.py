@@ -0,0 +1,110 @@
+from twisted.internet import defer, task
+from twisted.internet import reactor as global_reactor
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Evictor:
+    """
+    Keeps a data layer (synchronous or asynchronous) within a maximum number
+    of keys and bytes by evicting the least recently used keys, like
+    memcached does.
+
+    Every sweep first writes out the access time of the keys read since the
+    previous one. Then, while the store is over its limits, it evicts
+    batches of the keys with the oldest access times. Like the expiry
+    reaper, each batch is a short transaction of its own, run in a separate
+    reactor call so that requests keep being served in between.
+    """
+
+    def __init__(self, data_layer, max_items=None, max_bytes=None,
+                 interval=1.0, batch_size=500, clock=global_reactor):
+        """
+            :param data_layer: the data layer to keep within the limits. It
+            has to track the keys read (see DataLayer.note_accesses).
+            :param max_items: maximum number of keys, None for no limit
+            :param max_bytes: maximum total size of the keys and values in
+            bytes, None for no limit
+            :param interval: seconds between sweeps
+            :param batch_size: maximum number of keys evicted per
+            transaction, 0 to only record accesses and leave evicting to
+            another process
+            :param clock: provider of callLater used for scheduling
+        """
+        self.data_layer = data_layer
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch_size = batch_size
+        self.clock = clock
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.access_updates = 0
+        self.usage = {"items": 0, "bytes": 0}
+        self.loop = task.LoopingCall(self.sweep)
+        self.loop.clock = clock
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def sweep(self):
+        """
+        Records the accesses made since the last sweep, then evicts batches
+        of keys until the store is within its limits.
+
+        :return: a Deferred firing with the number of keys evicted
+        """
+        result = defer.Deferred()
+        evicted = [0]
+
+        def recorded(count):
+            self.access_updates += count
+            evict()
+
+        def evict():
+            d = defer.maybeDeferred(
+                self.data_layer.evict,
+                self.max_items, self.max_bytes, self.batch_size
+            )
+            d.addCallbacks(done, failed)
+
+        def done(outcome):
+            count = outcome["evicted"]
+            evicted[0] += count
+            self.evictions += count
+            self.evicted_bytes += outcome["evicted_bytes"]
+            self.usage = {
+                "items": outcome["items"], "bytes": outcome["bytes"]
+            }
+            if self.batch_size and count >= self.batch_size:
+                self.clock.callLater(0, evict)
+            else:
+                result.callback(evicted[0])
+
+        def failed(failure):
+            logger.error(failure.getTraceback())
+            result.callback(evicted[0])
+
+        d = defer.maybeDeferred(self.data_layer.record_accesses)
+        d.addCallbacks(recorded, failed)
+        return result
+
+    def stats(self):
+        """
+        :return: a dictionary with the evictor's counters and the usage of
+        the store as of the last sweep
+        """
+        return {
+            "curr_items": self.usage["items"],
+            "bytes": self.usage["bytes"],
+            "limit_items": self.max_items or 0,
+            "limit_maxbytes": self.max_bytes or 0,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "access_updates": self.access_updates,
+        }
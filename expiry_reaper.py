@@ -0,0 +1,70 @@
+from twisted.internet import defer, task
+from twisted.internet import reactor as global_reactor
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ExpiryReaper:
+    """
+    Periodically deletes expired rows from a data layer (synchronous or
+    asynchronous).
+
+    Rows are deleted in small batches so that each transaction is short.
+    When a batch comes back full there are probably more expired rows, so the
+    next batch is scheduled right away, but as a separate reactor call so that
+    requests keep being served in between.
+    """
+
+    def __init__(self, data_layer, interval=1.0, batch_size=500,
+                 clock=global_reactor):
+        """
+            :param data_layer: the data layer to delete expired rows from
+            :param interval: seconds between sweeps
+            :param batch_size: maximum number of rows deleted per transaction
+            :param clock: provider of callLater used for scheduling
+        """
+        self.data_layer = data_layer
+        self.batch_size = batch_size
+        self.interval = interval
+        self.clock = clock
+        self.reaped = 0
+        self.loop = task.LoopingCall(self.sweep)
+        self.loop.clock = clock
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def sweep(self):
+        """
+        Deletes batches of expired rows until a batch comes back short.
+
+        :return: a Deferred firing with the number of rows deleted
+        """
+        result = defer.Deferred()
+        deleted = [0]
+
+        def reap():
+            d = defer.maybeDeferred(
+                self.data_layer.delete_expired, self.batch_size
+            )
+            d.addCallbacks(reaped, failed)
+
+        def reaped(count):
+            deleted[0] += count
+            self.reaped += count
+            if count >= self.batch_size:
+                self.clock.callLater(0, reap)
+            else:
+                result.callback(deleted[0])
+
+        def failed(failure):
+            logger.error(failure.getTraceback())
+            result.callback(deleted[0])
+
+        reap()
+        return result
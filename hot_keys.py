@@ -0,0 +1,219 @@
+from data_layer import encode_key
+from memcache_receiver import AdminError
+import random
+
+
+class CountMinSketch:
+    """
+    Estimates how often each key of a stream occurred, in memory which does
+    not grow with the number of keys.
+
+    Every key has a counter in each of the 'depth' rows, picked by hashing
+    it. Keys sharing counters can only make estimates too high, never too
+    low: with N keys counted, an estimate is within 2.7 * N / 'width' of
+    the true count with a probability of 1 - 0.37 ** 'depth'. Counters are
+    updated conservatively, only raised as far as the new estimate, which
+    keeps the estimates of the other keys sharing them lower.
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _cells(self, key):
+        width = self.width
+        return [
+            (row, hash((seed, key)) % width)
+            for seed, row in enumerate(self.rows)
+        ]
+
+    def add(self, key, count=1):
+        """
+        :return: the estimate of the number of times 'key' was added
+        """
+        cells = self._cells(key)
+        estimate = min(row[index] for row, index in cells) + count
+        for row, index in cells:
+            if row[index] < estimate:
+                row[index] = estimate
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in self._cells(key))
+
+
+class TopKeys:
+    """
+    The 'size' keys added most often (the heavy hitters), going by the
+    estimates of a CountMinSketch.
+
+    The keys whose estimate is among the 'size' largest are kept along with
+    it, so a key becomes one of them as soon as it is added once more than
+    the least of them.
+    """
+
+    def __init__(self, size, width, depth):
+        self.size = size
+        self.sketch = CountMinSketch(width, depth)
+        # Estimates of the top keys
+        self.counts = {}
+        # No more than the least estimate of the top keys, which only grows
+        self.floor = 0
+        self.total = 0
+
+    def add(self, key):
+        self.total += 1
+        estimate = self.sketch.add(key)
+        counts = self.counts
+        if key in counts or len(counts) < self.size:
+            counts[key] = estimate
+        elif estimate > self.floor:
+            least = min(counts, key=counts.get)
+            if counts[least] < estimate:
+                del counts[least]
+                counts[key] = estimate
+            self.floor = min(counts.values())
+
+    def top(self):
+        """
+        :return: a list of (key, estimate) pairs, most frequent first
+        """
+        return sorted(self.counts.items(), key=lambda item: -item[1])
+
+
+class HotKeys:
+    """
+    Tracks the keys read and written most often, for the 'hotkeys' admin
+    command.
+
+    While tracking, it is the 'key_tracker' of the server's Stats, which the
+    receivers give the keys of every get and write. Otherwise they only find
+    there is none. Keys can be sampled, counting only 'sample_rate' of them
+    picked at random, with the counts reported scaled back up.
+    """
+
+    DEFAULT_SIZE = 20
+    # Counters per row and rows of the sketches. With a million keys
+    # counted, estimates are within about 700 of their true count.
+    DEFAULT_WIDTH = 4096
+    DEFAULT_DEPTH = 4
+
+    READ = b"READ"
+    WRITE = b"WRITE"
+    END = b"END"
+    OK = b"OK"
+    START = "start"
+    STOP = "stop"
+    RESET = "reset"
+    USAGE = "expected hotkeys [start [<sample rate>]|stop|reset]"
+
+    def __init__(self, stats, size=DEFAULT_SIZE, width=DEFAULT_WIDTH,
+                 depth=DEFAULT_DEPTH, random=random.random):
+        """
+            :param stats: the server's Stats
+            :param size: number of keys reported for reads and for writes
+            :param width: number of counters per row of the sketches
+            :param depth: number of rows of the sketches
+            :param random: function returning a random number between 0
+            and 1, which picks the keys sampled
+        """
+        self.server_stats = stats
+        self.size = size
+        self.width = width
+        self.depth = depth
+        self.random = random
+        self.sample_rate = 1.0
+        self.reset()
+
+    @property
+    def tracking(self):
+        return self.server_stats.key_tracker is self
+
+    def start(self, sample_rate=1.0):
+        """
+        Starts tracking keys anew, counting 'sample_rate' of them.
+        """
+        self.sample_rate = sample_rate
+        self.reset()
+        self.server_stats.key_tracker = self
+
+    def stop(self):
+        """
+        Stops tracking keys, keeping the counts for the report.
+        """
+        if self.tracking:
+            self.server_stats.key_tracker = None
+
+    def reset(self):
+        self.reads = TopKeys(self.size, self.width, self.depth)
+        self.writes = TopKeys(self.size, self.width, self.depth)
+
+    def record(self, keys, write=False):
+        """
+        Counts the keys of a request.
+
+        :param keys: an iterable of keys
+        :param write: whether they are written rather than read
+        """
+        top = self.writes if write else self.reads
+        if self.sample_rate < 1:
+            rate = self.sample_rate
+            draw = self.random
+            for key in keys:
+                if draw() < rate:
+                    top.add(key)
+        else:
+            for key in keys:
+                top.add(key)
+
+    def report(self):
+        """
+        :return: the lines answering 'hotkeys': 'READ <key> <count>' for
+        the keys read most often, then 'WRITE <key> <count>' for those
+        written most often, and 'END'
+        """
+        lines = []
+        for kind, top in ((self.READ, self.reads), (self.WRITE, self.writes)):
+            for key, count in top.top():
+                lines.append(b"%s %s %d" % (
+                    kind, encode_key(key), round(count / self.sample_rate)
+                ))
+        lines.append(self.END)
+        return lines
+
+    def command(self, args):
+        """
+        'hotkeys' reports the keys read and written most often, 'hotkeys
+        start [<sample rate>]' starts counting them anew, 'hotkeys stop'
+        stops and 'hotkeys reset' clears the counts.
+        """
+        if not args:
+            return self.report()
+        action, args = args[0], args[1:]
+        if action == self.START and len(args) <= 1:
+            try:
+                sample_rate = float(args[0]) if args else 1.0
+            except ValueError:
+                raise AdminError(self.USAGE)
+            if not 0 < sample_rate <= 1:
+                raise AdminError("the sample rate must be in (0, 1]")
+            self.start(sample_rate)
+        elif action == self.STOP and not args:
+            self.stop()
+        elif action == self.RESET and not args:
+            self.reset()
+        else:
+            raise AdminError(self.USAGE)
+        return [self.OK]
+
+    def stats(self):
+        """
+        :return: a dictionary with whether keys are tracked and the
+        estimated number of keys read and written while they were
+        """
+        return {
+            "tracking": int(self.tracking),
+            "sample_rate": self.sample_rate,
+            "reads": round(self.reads.total / self.sample_rate),
+            "writes": round(self.writes.total / self.sample_rate),
+        }
@@ -0,0 +1,328 @@
+from data_layer import encode_key
+from twisted.internet import defer, task
+from twisted.internet import reactor as global_reactor
+import hashlib
+import math
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CountingBloomFilter:
+    """
+    Set of keys which may answer that it holds a key it does not, but never
+    that it does not hold a key it does.
+
+    Each key increments 'hashes' of the byte-sized counters, and removing it
+    decrements them again. A counter which reaches 255 stays there, since
+    the keys counted by it can no longer be told apart: the filter then
+    holds more keys than it was sized for and should be rebuilt.
+    """
+
+    MAX_COUNT = 255
+    # Fewest counters a filter has, however few keys it is sized for
+    MIN_SIZE = 1024
+    MAX_HASHES = 16
+
+    def __init__(self, capacity, error_rate, max_bytes=None):
+        """
+            :param capacity: number of keys the filter is sized for
+            :param error_rate: fraction of the keys it does not hold which
+            it may answer it holds, once 'capacity' keys were added
+            :param max_bytes: upper limit for the memory used by the
+            counters, which raises the error rate if it is too low
+        """
+        size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        if max_bytes:
+            size = min(size, max_bytes)
+        self.size = max(size, self.MIN_SIZE)
+        self.hashes = min(max(
+            round(self.size / max(capacity, 1) * math.log(2)), 1
+        ), self.MAX_HASHES)
+        self.capacity = capacity
+        self.counters = bytearray(self.size)
+        # Number of keys added and not removed
+        self.count = 0
+
+    def _indexes(self, key):
+        # Double hashing: the i-th counter of a key is h1 + i * h2
+        digest = hashlib.blake2b(encode_key(key), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        counters = self.counters
+        for index in self._indexes(key):
+            if counters[index] < self.MAX_COUNT:
+                counters[index] += 1
+        self.count += 1
+
+    def remove(self, key):
+        """
+        Removes 'key', which must have been added before: removing any other
+        key may make the filter answer it does not hold keys it does.
+        """
+        counters = self.counters
+        for index in self._indexes(key):
+            if 0 < counters[index] < self.MAX_COUNT:
+                counters[index] -= 1
+        self.count -= 1
+
+    def __contains__(self, key):
+        counters = self.counters
+        return all(counters[index] for index in self._indexes(key))
+
+    def error_rate(self):
+        """
+        :return: the expected fraction of the keys the filter does not hold
+        which it answers it holds, with the keys it holds now
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** \
+            self.hashes
+
+
+class KeyFilter:
+    """
+    Answers gets for keys which don't exist without asking the data layer
+    behind it, going by a CountingBloomFilter of the keys which do.
+
+    The filter is built by reading every key of the database, and rebuilt
+    every 'rebuild_interval' seconds to drop the keys which expired, were
+    evicted or were overwritten (which counts them twice), and to resize it
+    for the keys there are by then. It is rebuilt early once it holds more
+    keys than it was sized for, past which it soon lets most of the keys
+    which don't exist through. Until the first build completes every key is
+    looked up.
+
+    The filter must never rule out a key which exists, so it has to see
+    every write which creates one: no other process may write to the
+    database. Keys are added when set or added, before the write is passed
+    on. They are only removed once a delete reports having deleted them,
+    and only from the filter they were found in: the keys read by a build
+    may or may not include those deleted while it was running.
+    """
+
+    # Rebuilt filters are sized for this many times the keys there are
+    GROWTH = 2
+    # Fewest keys a filter is sized for, so that a store which starts empty
+    # isn't rebuilt for every few keys written
+    MIN_CAPACITY = 1000
+
+    def __init__(self, data_layer, sources, error_rate=0.01, max_bytes=None,
+                 rebuild_interval=3600.0, batch_size=1000,
+                 clock=global_reactor):
+        """
+            :param data_layer: the data layer (synchronous or asynchronous)
+            to pass requests on to
+            :param sources: the data layers of the shards of the database,
+            read by the builds with scan_keys and usage
+            :param error_rate: fraction of the keys which don't exist that
+            the filter may let through
+            :param max_bytes: upper limit for the memory used by the filter
+            :param rebuild_interval: seconds between builds
+            :param batch_size: number of keys read per data layer call by a
+            build
+            :param clock: provider of callLater used for scheduling
+        """
+        self.data_layer = data_layer
+        self.READ_YOUR_WRITES = \
+            getattr(data_layer, "READ_YOUR_WRITES", False) is True
+        self.sources = sources
+        self.error_rate = error_rate
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.clock = clock
+        self.filter = None
+        # The filter being built, which keys are added to as well
+        self.next_filter = None
+        self.building = False
+        # The rebuild scheduled once the filter got full, if any
+        self.early_rebuild = None
+        # Keys of the sets and adds issued but not completed, by the number
+        # of them, which a build may not find in the database
+        self.in_flight = {}
+        self.builds = 0
+        self.saved_queries = 0
+        self.saved_keys = 0
+        self.false_positives = 0
+        self.loop = task.LoopingCall(self.rebuild)
+        self.loop.clock = clock
+        self.rebuild_interval = rebuild_interval
+
+    def start(self):
+        self.loop.start(self.rebuild_interval, now=True)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+        if self.early_rebuild is not None:
+            self.early_rebuild.cancel()
+            self.early_rebuild = None
+
+    def __getattr__(self, name):
+        # Other requests can't create keys nor answer without the database
+        return getattr(self.data_layer, name)
+
+    def rebuild(self):
+        """
+        Builds a new filter from the keys in the database and uses it once
+        complete.
+
+        :return: a Deferred firing once the build is complete
+        """
+        if self.building:
+            return defer.succeed(None)
+        self.building = True
+
+        def done(_):
+            self.building = False
+            self.next_filter = None
+
+        d = defer.gatherResults([
+            defer.maybeDeferred(source.usage) for source in self.sources
+        ], consumeErrors=True)
+        d.addCallback(self._build)
+        d.addErrback(lambda failure: logger.error(failure.getTraceback()))
+        return d.addCallback(done)
+
+    def _build(self, usages):
+        items = sum(usage["items"] for usage in usages)
+        self.next_filter = CountingBloomFilter(
+            max(items * self.GROWTH, self.MIN_CAPACITY), self.error_rate,
+            self.max_bytes
+        )
+        for key in self.in_flight:
+            self.next_filter.add(key)
+
+        result = defer.Deferred()
+
+        def read(index, after):
+            d = defer.maybeDeferred(
+                self.sources[index].scan_keys, after, self.batch_size
+            )
+            d.addCallback(add, index)
+            d.addErrback(result.errback)
+
+        def add(keys, index):
+            for key in keys:
+                self.next_filter.add(key)
+            # Further pages are read in separate reactor calls, so that
+            # requests keep being served in between
+            if len(keys) >= self.batch_size:
+                self.clock.callLater(0, read, index, keys[-1])
+            elif index + 1 < len(self.sources):
+                self.clock.callLater(0, read, index + 1, None)
+            else:
+                self.filter = self.next_filter
+                self.builds += 1
+                result.callback(None)
+
+        read(0, None)
+        return result
+
+    def _add(self, key):
+        for f in (self.filter, self.next_filter):
+            if f is not None:
+                f.add(key)
+        current = self.filter
+        if current is not None and current.count > current.capacity and \
+                not self.building and self.early_rebuild is None:
+            self.early_rebuild = self.clock.callLater(0, self._rebuild_early)
+
+    def _rebuild_early(self):
+        self.early_rebuild = None
+        self.rebuild()
+
+    def _create(self, key, method, *args):
+        self._add(key)
+        self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+        def written(result):
+            count = self.in_flight.pop(key) - 1
+            if count:
+                self.in_flight[key] = count
+            return result
+
+        return defer.maybeDeferred(method, *args).addBoth(written)
+
+    def set_value(self, key, value, flags, exptime=0):
+        return self._create(
+            key, self.data_layer.set_value, key, value, flags, exptime
+        )
+
+    def add_value(self, key, value, flags, exptime=0):
+        return self._create(
+            key, self.data_layer.add_value, key, value, flags, exptime
+        )
+
+    def delete_value(self, key):
+        found_in = self.filter
+
+        def deleted(anything_deleted):
+            if anything_deleted and found_in is not None and \
+                    found_in is self.filter:
+                found_in.remove(key)
+            return anything_deleted
+
+        d = defer.maybeDeferred(self.data_layer.delete_value, key)
+        return d.addCallback(deleted)
+
+    def get_values(self, keys, with_cas=False):
+        if self.filter is None:
+            return self.data_layer.get_values(keys, with_cas)
+
+        candidates = [key for key in keys if key in self.filter]
+        self.saved_keys += len(keys) - len(candidates)
+        if not candidates:
+            self.saved_queries += 1
+            return []
+
+        def fetched(rows):
+            rows = list(rows)
+            self.false_positives += len(candidates) - len(rows)
+            return rows
+
+        d = defer.maybeDeferred(
+            self.data_layer.get_values, candidates, with_cas
+        )
+        return d.addCallback(fetched)
+
+    def changed(self, keys):
+        """
+        Listener of a Replica, adding the keys it wrote.
+        """
+        if keys is None:
+            # The items were all deleted, which only leaves keys that don't
+            # exist in the filter. Those copied next are listed as written.
+            return
+        for key in keys:
+            self._add(key)
+
+    def stats(self):
+        """
+        :return: a dictionary with the filter's counters
+        """
+        stats = {
+            "saved_queries": self.saved_queries,
+            "saved_keys": self.saved_keys,
+            "false_positives": self.false_positives,
+            "builds": self.builds,
+            "keys": 0,
+            "capacity": 0,
+            "bytes": 0,
+            "hashes": 0,
+            "error_rate": 0,
+        }
+        current = self.filter
+        if current is not None:
+            stats.update(
+                keys=current.count,
+                capacity=current.capacity,
+                bytes=current.size,
+                hashes=current.hashes,
+                error_rate=round(current.error_rate(), 6),
+            )
+        return stats
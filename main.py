@@ -1,52 +1,1013 @@
-from data_layer import DataLayer
-from schema import create_schema
-from memcache_receiver import MemcacheFactory
-from twisted.internet import reactor
+import argparse
 import sys
 
+BACKEND_TWISTED = "twisted"
+BACKEND_ASYNCIO = "asyncio"
+
+if __name__ == "__main__":
+    # serve --backend asyncio runs the reactor on asyncio's event loop, which
+    # has to be installed before the modules below import the reactor
+    backend_parser = argparse.ArgumentParser(add_help=False)
+    backend_parser.add_argument("--backend")
+    if backend_parser.parse_known_args()[0].backend == BACKEND_ASYNCIO:
+        from asyncio_receiver import install_reactor
+        install_reactor()
+
+from async_data_layer import AsyncDataLayer
+from backup import DEFAULT_STEP_PAGES, DEFAULT_STEP_PAUSE, Snapshotter
+from asyncio_receiver import AsyncioMemcacheFactory
+from compression import Compressor, decompress_row
+from bench import (
+    LoadRun, Workload, bench_data_layer, compare, free_port, preload,
+    wait_for_server
+)
+from data_layer import (
+    DataLayer, SCAN_KEYS, SCAN_METADATA, SCAN_VALUES, TUNING_DEFAULT,
+    TUNING_FAST, TUNING_PROFILES, encode_key, prefix_range
+)
+from eviction import Evictor
+from expiry_reaper import ExpiryReaper
+from hot_keys import HotKeys
+from key_filter import KeyFilter
+from read_cache import ReadCache
+from replication import ReadOnlyStore, Replica, ReplicationSource
+from schema import (
+    DEFAULT_LOG_RETENTION, create_schema, drop_legacy_table, migrate_schema
+)
+from stats import Stats
+from sharded_data_layer import ShardedDataLayer, shard_files
+from write_batcher import WriteBatcher
+from memcache_receiver import MemcacheFactory, MemcacheReceiver
+from prefork import Supervisor, WORKER_LISTEN_FD, listening_socket
+from profiler import SamplingProfiler
+from twisted.internet import reactor
+from twisted.internet.asyncioreactor import AsyncioSelectorReactor
+from twisted.python.failure import Failure
+import asyncio
+import backup
+import base64
+import bulk
+import json
+import os
+import shlex
+import sharded_data_layer
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
 DEFAULT_PORT = 11211
 
 
-def install(db):
-    create_schema(db)
+def install(db, shards=1):
+    for name in shard_files(db, shards):
+        create_schema(name)
+
+
+def migrate(db, shards=1, batch_size=1000, drop_old=False):
+    for name in shard_files(db, shards):
+        if drop_old:
+            if drop_legacy_table(name):
+                print("{}: dropped the old table".format(name))
+            continue
+
+        def progress(copied):
+            print("{}: copied {} items".format(name, copied), end="\r",
+                  file=sys.stderr)
+
+        copied = migrate_schema(name, batch_size, progress)
+        if copied is None:
+            print("{}: already up to date".format(name))
+        else:
+            print("{}: migrated, copied {} items".format(name, copied))
+
+
+def open_store(db, shards, **options):
+    """
+    :return: a DataLayer for 'db', or a ShardedDataLayer over DataLayers for
+    each of its shard files
+    """
+    data_layers = [
+        DataLayer(name, **options) for name in shard_files(db, shards)
+    ]
+    if shards == 1:
+        return data_layers[0]
+    return ShardedDataLayer(data_layers)
+
+
+def serve(db, workers=1, listen_fd=None, **options):
+    if workers > 1:
+        # Each worker would have its own filter or cache, which the writes
+        # of the others never reach
+        for option, flag in (("key_filter", "--key-filter"),
+                             ("read_cache_size", "--read-cache-size")):
+            if options.get(option):
+                raise RuntimeError(
+                    "{} can't be used with --workers".format(flag)
+                )
+    if workers > 1:
+        supervise(db, workers, options)
+    else:
+        run_server(db, listen_fd, **options)
+
+
+def supervise(db, workers, options):
+    sock = listening_socket(options["port"])
+
+    def worker_argv(index):
+        worker_options = dict(options, listen_fd=WORKER_LISTEN_FD)
+        # A single worker is enough to reap expired items and evict. The
+        # others still record which keys they read.
+        if index > 0:
+            worker_options["reap_interval"] = 0
+            worker_options["evict_batch"] = 0
+            # Likewise for serving the change log and following a primary:
+            # the others read what is written to the database, refusing
+            # writes like the first if it is a replica
+            worker_options["replication_port"] = 0
+            worker_options["read_only"] = options.get("replica_of") is not None
+            worker_options["replica_of"] = None
+        argv = [sys.executable, os.path.abspath(__file__), MODE_SERVE, db]
+        for name, value in worker_options.items():
+            flag = "--" + name.replace("_", "-")
+            if isinstance(value, tuple):
+                # Parsed from HOST:PORT
+                value = ":".join(str(part) for part in value)
+            if value is True:
+                argv.append(flag)
+            elif value is not None and value is not False:
+                argv.extend([flag, str(value)])
+        return argv
+
+    Supervisor(sock.fileno(), worker_argv, workers).start()
+    reactor.run()
+    sock.close()
 
 
-def serve(db):
-    data_layer = DataLayer(db)
-    reactor.listenTCP(DEFAULT_PORT, MemcacheFactory(data_layer))
+def run_server(db, listen_fd=None, port=DEFAULT_PORT,
+               tuning=TUNING_DEFAULT, synchronous=None,
+               mmap_size=None, cache_size=None, busy_timeout=None,
+               async_io=False, read_threads=4, batch_window=0, batch_size=256,
+               relaxed_durability=False, read_cache_size=0,
+               reap_interval=1.0, reap_batch=500,
+               max_items=0, max_bytes=0, evict_interval=1.0, evict_batch=500,
+               max_item_size=MemcacheReceiver.DEFAULT_MAX_ITEM_SIZE,
+               shards=1, compress_threshold=0, compress_level=6,
+               backend=BACKEND_TWISTED, replication_port=0,
+               replication_log=DEFAULT_LOG_RETENTION, replica_of=None,
+               read_only=False, snapshot_dir=None,
+               response_high_water=MemcacheReceiver.DEFAULT_HIGH_WATER,
+               max_response_bytes=MemcacheReceiver.DEFAULT_MAX_RESPONSE_BYTES,
+               key_filter=False, key_filter_error_rate=0.01,
+               key_filter_max_bytes=0, key_filter_rebuild_interval=3600.0,
+               hot_keys=0, profile_dir=None,
+               profile_interval=SamplingProfiler.DEFAULT_INTERVAL * 1000,
+               profile_max_seconds=SamplingProfiler.DEFAULT_MAX_SECONDS):
+    # Values are compressed by the data layers, on the writer threads with
+    # --async-io, and decompressed by the receiver when sent
+    compressor = Compressor(compress_threshold or None, compress_level)
+    data_layers = [
+        DataLayer(
+            name, tuning,
+            pool_size=read_threads + 1,
+            compressor=compressor,
+            track_access=bool(max_items or max_bytes),
+            synchronous=synchronous,
+            mmap_size=mmap_size,
+            cache_size=cache_size,
+            busy_timeout=busy_timeout,
+        )
+        for name in shard_files(db, shards)
+    ]
+    stores = data_layers
+    if async_io:
+        # Every shard gets its own writer thread
+        stores = [
+            AsyncDataLayer(data_layer, read_threads)
+            for data_layer in data_layers
+        ]
+        for store in stores:
+            store.start()
+    store = stores[0] if shards == 1 else ShardedDataLayer(stores)
+    stats = Stats()
+    stats.add_source("compression_", compressor.stats)
+    if replication_port:
+        for data_layer in data_layers:
+            data_layer.enable_change_log(replication_log)
+        source = ReplicationSource(stores)
+        reactor.listenTCP(replication_port, source)
+        stats.add_source("replication_", source.stats)
+    admin_commands = {}
+    if snapshot_dir is not None:
+        snapshotter = Snapshotter([
+            (name, name[len(db):]) for name in shard_files(db, shards)
+        ], snapshot_dir)
+        admin_commands["snapshot"] = snapshotter.command
+        stats.add_source("snapshot_", snapshotter.stats)
+    # Keys are only tracked once switched on, here or by 'hotkeys start'
+    hot_key_tracker = HotKeys(stats)
+    if hot_keys > 0:
+        hot_key_tracker.start(min(hot_keys, 1.0))
+    admin_commands["hotkeys"] = hot_key_tracker.command
+    stats.add_source("hot_keys_", hot_key_tracker.stats)
+    if profile_dir is not None:
+        profiler = SamplingProfiler(
+            profile_dir, profile_interval / 1000.0, profile_max_seconds
+        )
+        admin_commands["profile"] = profiler.command
+        stats.add_source("profile_", profiler.stats)
+        # Signal handlers run between bytecodes of the reactor thread, which
+        # may be in the middle of anything
+        signal.signal(
+            signal.SIGUSR2,
+            lambda signum, frame: reactor.callFromThread(profiler.toggle)
+        )
+    replica = None
+    if replica_of is not None:
+        # Expired and evicted items are deleted by the primary, and
+        # replicated like any other change
+        reap_interval = 0
+        max_items = max_bytes = 0
+        replica = Replica(stores, *replica_of)
+        replica.start()
+        stats.add_source("replica_", replica.stats)
+    if reap_interval > 0:
+        reaper = ExpiryReaper(store, reap_interval, reap_batch)
+        reaper.start()
+        stats.add_source("", lambda: {"reclaimed": reaper.reaped})
+    if max_items or max_bytes:
+        evictor = Evictor(
+            store, max_items or None, max_bytes or None, evict_interval,
+            evict_batch
+        )
+        evictor.start()
+        stats.add_source("", evictor.stats)
+    if batch_window > 0:
+        store = WriteBatcher(
+            store, batch_window / 1000.0, batch_size, relaxed_durability
+        )
+        reactor.addSystemEventTrigger("before", "shutdown", store.flush)
+    if read_cache_size > 0:
+        store = ReadCache(store, read_cache_size)
+        stats.add_source("read_cache_", store.stats)
+        if replica is not None:
+            replica.listeners.append(_invalidator(store))
+    if key_filter:
+        store = KeyFilter(
+            store, stores, key_filter_error_rate, key_filter_max_bytes or None,
+            key_filter_rebuild_interval
+        )
+        store.start()
+        stats.add_source("key_filter_", store.stats)
+        if replica is not None:
+            replica.listeners.append(store.changed)
+    if replica is not None or read_only:
+        store = ReadOnlyStore(store)
+    if backend == BACKEND_ASYNCIO:
+        listen_asyncio(
+            AsyncioMemcacheFactory(
+                store, max_item_size, stats, compressor, admin_commands,
+                response_high_water, max_response_bytes
+            ),
+            port, listen_fd
+        )
+    else:
+        factory = MemcacheFactory(
+            store, max_item_size, stats, compressor, admin_commands,
+            response_high_water, max_response_bytes
+        )
+        if listen_fd is None:
+            reactor.listenTCP(port, factory)
+        else:
+            # Share the socket inherited from the supervising process
+            reactor.adoptStreamPort(listen_fd, socket.AF_INET, factory)
     reactor.run()
+    for data_layer in data_layers:
+        data_layer.close()
+
+
+def _invalidator(cache):
+    """
+    :return: a listener of a Replica dropping the keys it changes from
+    'cache'
+    """
+    def invalidate(keys):
+        if keys is None:
+            cache.clear()
+            return
+        for key in keys:
+            cache.invalidate(key)
+    return invalidate
+
+
+def listen_asyncio(factory, port, listen_fd=None):
+    """
+    Serves 'factory' with an asyncio server on the reactor's event loop,
+    which requires the asyncio reactor to be installed.
+    """
+    if not isinstance(reactor, AsyncioSelectorReactor):
+        raise RuntimeError(
+            "The asyncio backend needs the asyncio reactor, which main.py "
+            "installs when run with --backend asyncio"
+        )
+    loop = asyncio.get_event_loop()
+    if listen_fd is None:
+        server = loop.create_server(factory, "0.0.0.0", port)
+    else:
+        # Share the socket inherited from the supervising process
+        server = loop.create_server(
+            factory, sock=socket.socket(fileno=os.dup(listen_fd))
+        )
+    loop.run_until_complete(server)
+
+
+SHOW_FORMATS = {
+    SCAN_KEYS: "Key: {key}",
+    SCAN_METADATA:
+        "Key: {key}, Flags: {flags}, Expires: {expires_at}, Size: {size}",
+    SCAN_VALUES: "Key: {key}, Flags: {flags}, Value: {value}",
+}
+
+
+def show(db, shards=1, prefix=None, start=None, end=None, after=None,
+         limit=None, fields=SCAN_VALUES, json_lines=False):
+    if prefix is not None:
+        prefix_start, prefix_end = prefix_range(prefix)
+        # Bounds are compared as stored, like the keys
+        start = max(start or prefix_start, prefix_start, key=encode_key)
+        if prefix_end is not None:
+            end = min(end or prefix_end, prefix_end, key=encode_key)
+
+    data_layer = open_store(db, shards)
+    # Keys which are not UTF-8 are written out as the bytes they hold
+    sys.stdout.reconfigure(errors="surrogateescape")
+    # One more item than asked for tells whether there is another page
+    rows = data_layer.scan(
+        start, end, after, None if limit is None else limit + 1, fields
+    )
+    last_key = None
+    try:
+        for count, row in enumerate(rows):
+            if count == limit:
+                print("More items follow, continue with --after {!r}".format(
+                    last_key
+                ), file=sys.stderr)
+                break
+            row = decompress_row(row)
+            if json_lines:
+                line = json.dumps(_json_row(row))
+            else:
+                line = SHOW_FORMATS[fields].format(**row)
+            sys.stdout.write(line + "\n")
+            last_key = row["key"]
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader went away, e.g. 'show | head'. Point stdout at devnull
+        # so the interpreter doesn't fail flushing it on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        data_layer.close()
+
+
+def _json_row(row):
+    value = row.get("value")
+    if value is None:
+        return row
+    row = dict(row)
+    try:
+        row["value"] = value.decode("utf-8")
+    except UnicodeDecodeError:
+        del row["value"]
+        row["value_base64"] = base64.b64encode(value).decode("ascii")
+    return row
+
+
+def import_items(db, file="-", shards=1, batch_size=10000,
+                 compress_threshold=0, compress_level=6):
+    install(db, shards)
+    # Durability is relaxed while loading and restored by the checkpoint
+    data_layer = open_store(
+        db, shards, tuning=TUNING_FAST,
+        compressor=Compressor(compress_threshold or None, compress_level)
+    )
+    try:
+        with _open_binary(file, "rb") as f:
+            count = bulk.import_items(data_layer, f, batch_size)
+    finally:
+        data_layer.close()
+    for name in shard_files(db, shards):
+        bulk.checkpoint(name)
+    print("Imported {} items".format(count), file=sys.stderr)
+
+
+def export_items(db, file="-", shards=1, fmt=bulk.FORMAT_COMPACT):
+    data_layer = open_store(db, shards)
+    try:
+        with _open_binary(file, "wb") as f:
+            count = bulk.export_items(data_layer, f, fmt)
+    finally:
+        data_layer.close()
+    print("Exported {} items".format(count), file=sys.stderr)
+
 
+def _open_binary(file, mode):
+    """
+    Opens 'file' in binary 'mode', '-' standing for stdin or stdout, which
+    are left open when done.
+    """
+    if file != "-":
+        return open(file, mode)
+    stream = sys.stdin if mode.startswith("r") else sys.stdout
+    return os.fdopen(os.dup(stream.fileno()), mode)
 
-def show(db):
-    data_layer = DataLayer(db)
-    for row in data_layer.get_all_values():
-        print("Key: {key}, Flags: {flags}, Value: {value}".format(**row))
+
+def snapshot(db, target, shards=1, step_pages=DEFAULT_STEP_PAGES,
+             step_pause=DEFAULT_STEP_PAUSE * 1000):
+    for name, target_name in zip(shard_files(db, shards),
+                                 shard_files(target, shards)):
+        def progress(copied, total):
+            print("{}: copied {} of {} pages".format(name, copied, total),
+                  end="\r", file=sys.stderr)
+
+        pages = backup.snapshot(
+            name, target_name, step_pages, step_pause / 1000.0, progress
+        )
+        print("{}: wrote {} pages to {}".format(name, pages, target_name))
+
+
+def restore(snapshot, db, shards=1, force=False):
+    for snapshot_name, name in zip(shard_files(snapshot, shards),
+                                   shard_files(db, shards)):
+        backup.restore(snapshot_name, name, force)
+        print("Restored {} from {}".format(name, snapshot_name))
+
+
+def reshard(db, old_shards, new_shards):
+    copied = sharded_data_layer.reshard(db, old_shards, new_shards)
+    print("Moved {} items into {} shard(s)".format(copied, new_shards))
+
+
+SUITE_ALL = "all"
+SUITE_SERVER = "server"
+SUITE_DATA_LAYER = "datalayer"
+
+
+def bench(suite=SUITE_ALL, duration=10.0, connections=4, pipeline=1,
+          keys=10000, read_ratio=0.9, zipf=0.99, value_size=(100, 100),
+          seed=None, operations=10000, server_args="", output=None,
+          baseline=None):
+    server_argv = shlex.split(server_args)
+
+    def workload():
+        return Workload(keys, read_ratio, zipf, value_size, seed)
+
+    directory = tempfile.mkdtemp(prefix="tenantbase-bench-")
+    results = {
+        "time": int(time.time()),
+        "workload": workload().describe(),
+        "server_args": server_argv,
+    }
+    try:
+        if suite in (SUITE_ALL, SUITE_DATA_LAYER):
+            results["data_layer"] = bench_data_layer_suite(
+                os.path.join(directory, "data_layer.db"), workload(),
+                server_argv, operations
+            )
+        if suite in (SUITE_ALL, SUITE_SERVER):
+            results["server"] = bench_server(
+                os.path.join(directory, "server.db"), workload(),
+                server_argv, connections, pipeline, duration
+            )
+    finally:
+        shutil.rmtree(directory)
+
+    print_bench_results(results)
+    if baseline is not None:
+        with open(baseline) as f:
+            print("Compared with {}:".format(baseline))
+            for line in compare(json.load(f), results):
+                print("  " + line)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def _server_options(db, server_argv):
+    """
+    :return: the options 'serve' would run with, given 'server_argv'
+    """
+    options = vars(build_parser().parse_args([MODE_SERVE, db] + server_argv))
+    del options["mode"]
+    return options
+
+
+def bench_data_layer_suite(db, workload, server_argv, operations):
+    options = _server_options(db, server_argv)
+    install(db, options["shards"])
+    data_layer = open_store(
+        db, options["shards"], tuning=options["tuning"],
+        synchronous=options["synchronous"], mmap_size=options["mmap_size"],
+        cache_size=options["cache_size"], busy_timeout=options["busy_timeout"]
+    )
+    try:
+        preload(data_layer, workload)
+        return bench_data_layer(data_layer, workload, operations)
+    finally:
+        data_layer.close()
+
+
+def bench_server(db, workload, server_argv, connections, pipeline, duration):
+    """
+    Runs the server with 'server_argv' on a free loopback port in a separate
+    process, so that it does not compete with the load generator for the
+    interpreter, and sends it the requests of 'workload'.
+    """
+    port = free_port()
+    server_argv = ["--port", str(port)] + server_argv
+    shards = _server_options(db, server_argv)["shards"]
+    install(db, shards)
+    data_layer = open_store(db, shards)
+    preload(data_layer, workload)
+    data_layer.close()
+
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), MODE_SERVE, db] +
+        server_argv
+    )
+    results = []
+    try:
+        wait_for_server(port, process)
+        run = LoadRun(workload, connections, pipeline, duration)
+        d = run.start("127.0.0.1", port)
+        d.addBoth(results.append)
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    finally:
+        process.terminate()
+        process.wait()
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+def _latency(latency):
+    return "p50 {p50_us}us p99 {p99_us}us p999 {p999_us}us".format(**latency)
+
+
+def print_bench_results(results):
+    for name, result in sorted(results.get("data_layer", {}).items()):
+        print("{}: {} calls/sec ({} keys per call), {}".format(
+            name, result["calls_per_sec"], result["keys_per_call"],
+            _latency(result["latency"])
+        ))
+    server = results.get("server")
+    if server:
+        print("server: {} ops/sec ({} connections, pipeline {}), "
+              "{} errors".format(
+                  server["ops_per_sec"], server["connections"],
+                  server["pipeline"], server["errors"]
+              ))
+        for name, latency in sorted(server["latency"].items()):
+            print("  {}: {}".format(name, _latency(latency)))
 
 
 MODE_INSTALL = "install"
 MODE_SERVE = "serve"
 MODE_SHOW = "show"
+MODE_RESHARD = "reshard"
+MODE_BENCH = "bench"
+MODE_IMPORT = "import"
+MODE_EXPORT = "export"
+MODE_MIGRATE = "migrate"
+MODE_SNAPSHOT = "snapshot"
+MODE_RESTORE = "restore"
 MODE_MAP = {
     MODE_INSTALL: install,
     MODE_SERVE: serve,
     MODE_SHOW: show,
+    MODE_RESHARD: reshard,
+    MODE_BENCH: bench,
+    MODE_IMPORT: import_items,
+    MODE_EXPORT: export_items,
+    MODE_MIGRATE: migrate,
+    MODE_SNAPSHOT: snapshot,
+    MODE_RESTORE: restore,
 }
 
 
-def print_usage_and_exit():
-    print("Usage: main.py show|serve|install <database name>")
-    sys.exit(1)
+def host_port(text):
+    """
+    Parses a HOST:PORT command line argument.
+    """
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(
+            "expected HOST:PORT, got {!r}".format(text)
+        )
+    return host, int(port)
+
+
+def value_size_range(text):
+    """
+    Parses a value size, either a number of bytes or a 'MIN:MAX' range.
+    """
+    try:
+        sizes = [int(size) for size in text.split(":")]
+    except ValueError:
+        sizes = []
+    if len(sizes) == 1:
+        sizes *= 2
+    if len(sizes) != 2 or not 0 <= sizes[0] <= sizes[1]:
+        raise argparse.ArgumentTypeError(
+            "expected BYTES or MIN:MAX, got {!r}".format(text)
+        )
+    return tuple(sizes)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py")
+    modes = parser.add_subparsers(dest="mode", metavar="|".join(MODE_MAP))
+    modes.required = True
+    mode_parsers = {
+        mode: modes.add_parser(mode) for mode in MODE_MAP
+    }
+    for mode in (MODE_INSTALL, MODE_SERVE, MODE_SHOW, MODE_RESHARD,
+                 MODE_IMPORT, MODE_EXPORT, MODE_MIGRATE, MODE_SNAPSHOT):
+        mode_parsers[mode].add_argument("db", help="SQLite database name")
+    mode_parsers[MODE_RESTORE].add_argument(
+        "snapshot", help="name of the snapshot to restore"
+    )
+    mode_parsers[MODE_RESTORE].add_argument(
+        "db", help="name of the SQLite database to create"
+    )
+    for mode in (MODE_INSTALL, MODE_SERVE, MODE_SHOW, MODE_IMPORT,
+                 MODE_EXPORT, MODE_MIGRATE, MODE_SNAPSHOT, MODE_RESTORE):
+        mode_parsers[mode].add_argument(
+            "--shards", type=int, default=1,
+            help="number of database files the keys are spread over "
+                 "(default: %(default)s)"
+        )
+
+    show_parser = mode_parsers[MODE_SHOW]
+    show_parser.add_argument(
+        "--prefix", help="only show keys starting with PREFIX"
+    )
+    show_parser.add_argument(
+        "--start", metavar="KEY", help="only show keys from KEY onwards"
+    )
+    show_parser.add_argument(
+        "--end", metavar="KEY", help="only show keys before KEY"
+    )
+    show_parser.add_argument(
+        "--after", metavar="KEY",
+        help="only show keys after KEY, to continue an earlier listing"
+    )
+    show_parser.add_argument(
+        "--limit", type=int, help="show at most this many items"
+    )
+    fields = show_parser.add_mutually_exclusive_group()
+    fields.add_argument(
+        "--keys-only", dest="fields", action="store_const", const=SCAN_KEYS,
+        default=SCAN_VALUES, help="only show the keys"
+    )
+    fields.add_argument(
+        "--metadata", dest="fields", action="store_const",
+        const=SCAN_METADATA,
+        help="show the flags, expiration time and size instead of the value"
+    )
+    show_parser.add_argument(
+        "--json", dest="json_lines", action="store_true",
+        help="write one JSON object per item; values which are not UTF-8 "
+             "are written base64-encoded as 'value_base64'"
+    )
+
+    import_parser = mode_parsers[MODE_IMPORT]
+    import_parser.add_argument(
+        "file", nargs="?", default="-",
+        help="file written by export or holding memcached set/delete "
+             "commands (default: stdin)"
+    )
+    import_parser.add_argument(
+        "--batch-size", type=int, default=10000,
+        help="number of items written per transaction "
+             "(default: %(default)s)"
+    )
+    export_parser = mode_parsers[MODE_EXPORT]
+    export_parser.add_argument(
+        "file", nargs="?", default="-",
+        help="file to write the items to (default: stdout)"
+    )
+    export_parser.add_argument(
+        "--format", dest="fmt", choices=sorted(bulk.WRITERS),
+        default=bulk.FORMAT_COMPACT,
+        help="compact binary records, or memcached set commands "
+             "(default: %(default)s)"
+    )
+
+    migrate_parser = mode_parsers[MODE_MIGRATE]
+    migrate_parser.add_argument(
+        "--batch-size", type=int, default=1000,
+        help="number of items copied per transaction "
+             "(default: %(default)s)"
+    )
+    migrate_parser.add_argument(
+        "--drop-old", action="store_true",
+        help="drop the old table left by an earlier migration, once no "
+             "server uses the old schema any more"
+    )
+
+    snapshot_parser = mode_parsers[MODE_SNAPSHOT]
+    snapshot_parser.add_argument(
+        "target", help="file to write the snapshot to, while servers keep "
+                       "using the database"
+    )
+    snapshot_parser.add_argument(
+        "--step-pages", type=int, default=DEFAULT_STEP_PAGES,
+        help="number of pages copied per step (default: %(default)s)"
+    )
+    snapshot_parser.add_argument(
+        "--step-pause", type=float, default=DEFAULT_STEP_PAUSE * 1000,
+        metavar="MS",
+        help="pause after every step (default: %(default)s)"
+    )
+    mode_parsers[MODE_RESTORE].add_argument(
+        "--force", action="store_true",
+        help="replace the database if it exists; no server may be using it"
+    )
+
+    reshard_parser = mode_parsers[MODE_RESHARD]
+    reshard_parser.add_argument(
+        "--shards", dest="old_shards", type=int, required=True,
+        help="number of shards the database currently has"
+    )
+    reshard_parser.add_argument(
+        "--new-shards", type=int, required=True,
+        help="number of shards to move the data into"
+    )
+
+    serve_parser = mode_parsers[MODE_SERVE]
+    serve_parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of server processes sharing the port "
+             "(default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--listen-fd", type=int, help=argparse.SUPPRESS
+    )
+    # Given to the workers of a replica which don't follow the primary
+    serve_parser.add_argument(
+        "--read-only", action="store_true", help=argparse.SUPPRESS
+    )
+    serve_parser.add_argument(
+        "--backend", choices=[BACKEND_TWISTED, BACKEND_ASYNCIO],
+        default=BACKEND_TWISTED,
+        help="network layer serving the connections: Twisted's "
+             "LineReceiver, or an asyncio protocol parsing commands in "
+             "place (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT,
+        help="TCP port to listen on (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--tuning", choices=sorted(TUNING_PROFILES), default=TUNING_DEFAULT,
+        help="SQLite tuning profile (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--synchronous", choices=["OFF", "NORMAL", "FULL", "EXTRA"],
+        help="override the profile's PRAGMA synchronous"
+    )
+    serve_parser.add_argument(
+        "--mmap-size", type=int, help="override the profile's PRAGMA mmap_size"
+    )
+    serve_parser.add_argument(
+        "--cache-size", type=int,
+        help="override the profile's PRAGMA cache_size"
+    )
+    serve_parser.add_argument(
+        "--busy-timeout", type=int,
+        help="override the profile's PRAGMA busy_timeout (milliseconds)"
+    )
+    serve_parser.add_argument(
+        "--max-item-size", type=int,
+        default=MemcacheReceiver.DEFAULT_MAX_ITEM_SIZE, metavar="BYTES",
+        help="largest value accepted by set (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--response-high-water", type=int,
+        default=MemcacheReceiver.DEFAULT_HIGH_WATER, metavar="BYTES",
+        help="stop reading a connection's commands while this many bytes "
+             "of its responses wait to be sent (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--max-response-bytes", type=int,
+        default=MemcacheReceiver.DEFAULT_MAX_RESPONSE_BYTES, metavar="BYTES",
+        help="bytes of values a large get reads at once "
+             "(default: %(default)s)"
+    )
+    for mode in (MODE_SERVE, MODE_IMPORT):
+        mode_parsers[mode].add_argument(
+            "--compress-threshold", type=int, default=0, metavar="BYTES",
+            help="store values of at least this size compressed "
+                 "(default: %(default)s, no compression)"
+        )
+        mode_parsers[mode].add_argument(
+            "--compress-level", type=int, choices=range(1, 10), default=6,
+            metavar="1-9", help="zlib compression level (default: %(default)s)"
+        )
+    serve_parser.add_argument(
+        "--async-io", action="store_true",
+        help="run SQLite calls on background threads instead of the reactor"
+    )
+    serve_parser.add_argument(
+        "--read-threads", type=int, default=4,
+        help="number of reader threads with --async-io (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--batch-window", type=float, default=0, metavar="MS",
+        help="commit writes in groups collected over this many milliseconds "
+             "(default: %(default)s, every write commits on its own)"
+    )
+    serve_parser.add_argument(
+        "--batch-size", type=int, default=256,
+        help="commit a group as soon as it holds this many keys "
+             "(default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--relaxed-durability", action="store_true",
+        help="with --batch-window, acknowledge writes before they commit"
+    )
+    serve_parser.add_argument(
+        "--read-cache-size", type=int, default=0, metavar="BYTES",
+        help="keep up to this many bytes of recently read items in memory "
+             "(default: %(default)s, no cache)"
+    )
+    serve_parser.add_argument(
+        "--reap-interval", type=float, default=1.0, metavar="SECONDS",
+        help="how often expired items are deleted (default: %(default)s, "
+             "0 to never delete them)"
+    )
+    serve_parser.add_argument(
+        "--reap-batch", type=int, default=500,
+        help="maximum number of expired items deleted per transaction "
+             "(default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--max-items", type=int, default=0,
+        help="evict the least recently used items beyond this many "
+             "(default: %(default)s, no limit)"
+    )
+    serve_parser.add_argument(
+        "--max-bytes", type=int, default=0,
+        help="evict the least recently used items once keys and values take "
+             "up more than this many bytes (default: %(default)s, no limit)"
+    )
+    serve_parser.add_argument(
+        "--evict-interval", type=float, default=1.0, metavar="SECONDS",
+        help="how often accesses are recorded and the limits enforced "
+             "(default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--evict-batch", type=int, default=500,
+        help="maximum number of items evicted per transaction "
+             "(default: %(default)s)"
+    )
 
+    serve_parser.add_argument(
+        "--key-filter", action="store_true",
+        help="answer gets for keys which don't exist from an in-memory "
+             "filter of the keys which do, without asking SQLite"
+    )
+    serve_parser.add_argument(
+        "--key-filter-error-rate", type=float, default=0.01,
+        metavar="FRACTION",
+        help="fraction of the keys which don't exist that the filter lets "
+             "through (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--key-filter-max-bytes", type=int, default=0, metavar="BYTES",
+        help="memory the filter may use, raising its error rate if need be "
+             "(default: %(default)s, no limit)"
+    )
+    serve_parser.add_argument(
+        "--key-filter-rebuild-interval", type=float, default=3600.0,
+        metavar="SECONDS",
+        help="how often the filter is rebuilt from the keys in the database "
+             "(default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--snapshot-dir", metavar="DIR",
+        help="directory the 'snapshot <name>' command writes snapshots to "
+             "(default: none, the command is disabled)"
+    )
+    serve_parser.add_argument(
+        "--hot-keys", type=float, default=0, metavar="RATE",
+        help="track the keys read and written most often from the start, "
+             "sampling this fraction of them, for the 'hotkeys' command "
+             "(default: %(default)s, until 'hotkeys start')"
+    )
+    serve_parser.add_argument(
+        "--profile-dir", metavar="DIR",
+        help="directory the profiles of the reactor thread taken on "
+             "'profile start' or SIGUSR2 are written to (default: none, "
+             "profiling is disabled)"
+    )
+    serve_parser.add_argument(
+        "--profile-interval", type=float,
+        default=SamplingProfiler.DEFAULT_INTERVAL * 1000, metavar="MS",
+        help="time between samples of a profile (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--profile-max-seconds", type=float,
+        default=SamplingProfiler.DEFAULT_MAX_SECONDS, metavar="SECONDS",
+        help="time after which a profile stops and is written "
+             "(default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--replication-port", type=int, default=0, metavar="PORT",
+        help="record a change log and serve it to replicas on this port "
+             "(default: %(default)s, no replicas)"
+    )
+    serve_parser.add_argument(
+        "--replication-log", type=int, default=DEFAULT_LOG_RETENTION,
+        metavar="CHANGES",
+        help="number of changes the log keeps per shard; replicas further "
+             "behind copy all the items again (default: %(default)s)"
+    )
+    serve_parser.add_argument(
+        "--replica-of", type=host_port, metavar="HOST:PORT",
+        help="serve reads as a replica of the primary whose change log is "
+             "served on HOST:PORT, refusing writes"
+    )
 
-def main():
-    if len(sys.argv) != 3:
-        print_usage_and_exit()
+    bench_parser = mode_parsers[MODE_BENCH]
+    bench_parser.add_argument(
+        "--suite", choices=[SUITE_ALL, SUITE_SERVER, SUITE_DATA_LAYER],
+        default=SUITE_ALL,
+        help="benchmarks to run: the server under load, the data layer on "
+             "its own or both (default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--duration", type=float, default=10.0, metavar="SECONDS",
+        help="how long to load the server for (default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--connections", type=int, default=4,
+        help="number of concurrent client connections (default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--pipeline", type=int, default=1,
+        help="number of requests each connection keeps in flight "
+             "(default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--keys", type=int, default=10000,
+        help="number of distinct keys (default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--read-ratio", type=float, default=0.9,
+        help="fraction of requests which are gets (default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--zipf", type=float, default=0.99,
+        help="exponent of the Zipfian key popularity, 0 for uniform "
+             "(default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--value-size", type=value_size_range, default=(100, 100),
+        metavar="BYTES|MIN:MAX",
+        help="size of the values set, or a range to pick it uniformly from "
+             "(default: 100)"
+    )
+    bench_parser.add_argument(
+        "--seed", type=int, help="seed for repeatable request sequences"
+    )
+    bench_parser.add_argument(
+        "--operations", type=int, default=10000,
+        help="number of keys each data layer benchmark operates on "
+             "(default: %(default)s)"
+    )
+    bench_parser.add_argument(
+        "--server-args", default="", metavar="ARGS",
+        help="options passed to 'serve' and used for the data layer, "
+             "e.g. \"--async-io --batch-window 2\""
+    )
+    bench_parser.add_argument(
+        "--output", metavar="FILE", help="save the results as JSON"
+    )
+    bench_parser.add_argument(
+        "--baseline", metavar="FILE",
+        help="compare the results with those saved by an earlier run"
+    )
+    return parser
 
-    mode = sys.argv[1]
-    if mode not in MODE_MAP:
-        print_usage_and_exit()
 
-    MODE_MAP[mode](sys.argv[2])
+def main(argv=None):
+    options = vars(build_parser().parse_args(argv))
+    mode = options.pop("mode")
+    MODE_MAP[mode](**options)
 
 
 if __name__ == '__main__':
@@ -1,26 +1,86 @@
+from compression import Compressor
+from data_layer import (
+    CLIENT_FLAGS, KEY_ENCODING, KEY_ERRORS, MAX_COUNTER, NonNumericValue,
+    encode_key
+)
+from stats import Stats
+from time import perf_counter
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Factory
 from twisted.protocols.basic import LineReceiver
+from zope.interface import implementer
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-class MemcacheReceiver(LineReceiver):
+class AdminError(Exception):
+    """
+    Raised by admin commands for requests they cannot carry out, which are
+    answered with a CLIENT_ERROR.
+    """
+
+
+class MemcacheCommands:
+    """
+    The memcache commands themselves, shared by the server backends. A
+    backend frames the received data into command lines passed to
+    lineReceived and payloads passed to payloadReceived, implements
+    readPayload, writeToTransport, pauseReading and resumeReading, and calls
+    pauseResponses and resumeResponses as its transport's write buffer fills
+    up and drains.
+    """
+    delimiter = b"\r\n"
+
     # Constants for parsing commands
     CMD_SET = "set"
+    CMD_ADD = "add"
+    CMD_REPLACE = "replace"
+    CMD_APPEND = "append"
+    CMD_PREPEND = "prepend"
+    CMD_INCR = "incr"
+    CMD_DECR = "decr"
+    CMD_TOUCH = "touch"
+    CMD_CAS = "cas"
     CMD_GET = "get"
+    CMD_GETS = "gets"
     CMD_DELETE = "delete"
+    CMD_STATS = "stats"
+    CMD_COMPRESSED_FLAG = "compressed_flag"
     NO_REPLY = "noreply"
 
     # Certain commands are considered "storage" commands
-    STORAGE_COMMANDS = frozenset([CMD_SET])
+    STORAGE_COMMANDS = frozenset([
+        CMD_SET, CMD_ADD, CMD_REPLACE, CMD_APPEND, CMD_PREPEND, CMD_CAS
+    ])
+    # Consecutive retrieval commands are looked up together
+    RETRIEVAL_COMMANDS = frozenset([CMD_GET, CMD_GETS])
+    # Data layer method storing the payload of each storage command, and
+    # whether it takes the flags and expiration time as well
+    STORAGE_OPERATIONS = {
+        CMD_SET: ("set_value", True),
+        CMD_ADD: ("add_value", True),
+        CMD_REPLACE: ("replace_value", True),
+        CMD_APPEND: ("append_value", False),
+        CMD_PREPEND: ("prepend_value", False),
+        CMD_CAS: ("cas_value", True),
+    }
 
     # Successful response strings
     STORED = b"STORED"
+    NOT_STORED = b"NOT_STORED"
+    EXISTS = b"EXISTS"
+    TOUCHED = b"TOUCHED"
     DELETED = b"DELETED"
     NOT_FOUND = b"NOT_FOUND"
     VALUE = b"VALUE %s %d %d"
     END = b"END"
+    VALUE_HEADER = VALUE + b"\r\n"
+    VALUE_CAS_HEADER = VALUE + b" %d\r\n"
+    END_LINE = END + b"\r\n"
+    STAT_LINE = b"STAT %s %s\r\n"
+    OK = b"OK"
 
     # Error strings
     UNKNOWN_COMMAND_ERROR = b"ERROR"
@@ -28,52 +88,418 @@ class MemcacheReceiver(LineReceiver):
     INCORRECT_NUM_ARGUMENTS = b"Incorrect number of arguments"
     EXPECTED_NO_REPLY = b"Invalid last argument - expected 'noreply'"
     SERVER_ERROR = b"SERVER_ERROR %s"
+    BAD_DATA_CHUNK = b"bad data chunk"
+    OBJECT_TOO_LARGE = b"object too large for cache"
+    BAD_COMMAND_LINE = b"bad command line format"
+    INVALID_DELTA = b"invalid numeric delta argument"
+    NON_NUMERIC_VALUE = b"cannot increment or decrement non-numeric value"
+
+    # Largest value accepted by 'set' unless configured otherwise
+    DEFAULT_MAX_ITEM_SIZE = 1024 * 1024
+    # Bytes of responses the transport may hold before the connection stops
+    # reading commands and rows, unless configured otherwise
+    DEFAULT_HIGH_WATER = 64 * 1024
+    # Bytes of rows a connection reads at once for a large get, unless
+    # configured otherwise
+    DEFAULT_MAX_RESPONSE_BYTES = 1024 * 1024
+    # Gets for more keys than this are answered a chunk of keys at a time,
+    # starting with a chunk of this many keys
+    GET_CHUNK_KEYS = 16
+    # Largest chunk of keys read at once, however small their values
+    MAX_CHUNK_KEYS = 256
 
-    def __init__(self, data_layer):
+    def __init__(self, data_layer, max_item_size=DEFAULT_MAX_ITEM_SIZE,
+                 stats=None, compressor=None, admin_commands=None,
+                 high_water=DEFAULT_HIGH_WATER,
+                 max_response_bytes=DEFAULT_MAX_RESPONSE_BYTES):
         self.data_layer = data_layer
+        # Commands of the server's administrators, by name. Each is called
+        # with the arguments of the command and returns the lines of the
+        # response, or a Deferred firing with them.
+        self.admin_commands = admin_commands or {}
+        self.max_item_size = max_item_size
+        self.stats = Stats() if stats is None else stats
+        self.compressor = Compressor() if compressor is None else compressor
+        # Client flag marking compressed values sent as they are stored, None
+        # while this connection wants values decompressed
+        self.compressed_flag = None
+        # Fires once every data layer call issued so far on this connection
+        # has completed and its response has been sent.
+        self.pending = defer.succeed(None)
+        # Responses collected while a chunk of received data is processed,
+        # None when responses are written out right away
+        self.output = None
+        # Command, arguments and start time of the consecutive retrieval
+        # commands not looked up yet
+        self.queued_gets = []
+        self.high_water = high_water
+        self.max_response_bytes = max_response_bytes
+        # Whether the transport holds more than 'high_water' bytes, and the
+        # Deferreds waiting for it to drain
+        self.responses_paused = False
+        self.drain_waiters = []
+        # Number of retrieval commands answered a chunk at a time which have
+        # not completed yet
+        self.streams = 0
+        self.closed = False
+
+    def connectionMade(self):
+        self.stats.incr("curr_connections")
+        self.stats.incr("total_connections")
+
+    def connectionLost(self, reason):
+        self.stats.incr("curr_connections", -1)
+        self.closed = True
+        # Responses being streamed give up rather than wait forever
+        self.resumeResponses()
+
+    def readPayload(self):
+        """
+        Has the next 'self.bytes' bytes received and the delimiter following
+        them passed to payloadReceived, or None in their place if they are
+        larger than 'self.max_item_size'.
+        """
+        raise NotImplementedError
+
+    def writeToTransport(self, data):
+        """
+        Writes the sequence of byte strings 'data' to the transport.
+        """
+        raise NotImplementedError
+
+    def pauseReading(self):
+        """
+        Stops handling received commands until resumeReading is called.
+        """
+        raise NotImplementedError
+
+    def resumeReading(self):
+        """
+        Handles the commands received meanwhile and reads further ones.
+        """
+        raise NotImplementedError
+
+    def pauseResponses(self):
+        """
+        Called once the transport holds more than 'high_water' bytes not
+        sent yet. Until it has drained, neither commands nor the rows of
+        large gets are read, so a client which does not read its responses
+        holds up only itself.
+        """
+        if self.responses_paused:
+            return
+        self.responses_paused = True
+        self.stats.incr("response_pauses")
+        self.pauseReading()
+
+    def resumeResponses(self):
+        """
+        Called once the transport has drained.
+        """
+        if not self.responses_paused:
+            return
+        self.responses_paused = False
+        # A waiter may fill the transport up again
+        while self.drain_waiters and not self.responses_paused:
+            self.drain_waiters.pop(0).callback(None)
+        if not self.responses_paused and not self.closed:
+            self.resumeReading()
+
+    def whenDrained(self):
+        """
+        :return: a Deferred firing once the transport is below its
+        high-water mark
+        """
+        if not self.responses_paused:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.drain_waiters.append(d)
+        return d
+
+    def flushOutput(self):
+        """
+        Writes out the responses collected so far, if they are being
+        collected.
+        """
+        if self.output:
+            output, self.output = self.output, []
+            self.writeToTransport(output)
+
+    def write(self, data):
+        self.stats.incr("bytes_written", len(data))
+        if self.output is None:
+            self.transport.write(data)
+        else:
+            self.output.append(data)
+
+    def writeSequence(self, data):
+        self.stats.incr("bytes_written", sum(map(len, data)))
+        if self.output is None:
+            self.writeToTransport(data)
+        else:
+            self.output.extend(data)
+
+    def sendLine(self, line):
+        self.write(line + self.delimiter)
+
+    def sendResponse(self, line):
+        """
+        Sends 'line' once the responses to all earlier commands on this
+        connection have been sent.
+        """
+        self.pending.addCallback(lambda _: self.sendLine(line))
+
+    def commandQueued(self, cmd, start):
+        """
+        Records the latency of command 'cmd', received at 'start', once its
+        response has been sent.
+        """
+        self.pending.addCallback(self._commandDone, cmd, start)
+
+    def _commandDone(self, result, cmd, start):
+        self.stats.record_command(cmd, perf_counter() - start)
+        return result
+
+    def _operationDone(self, result, operation, start):
+        self.stats.record_operation(operation, perf_counter() - start)
+        return result
 
     def sendClientError(self, error):
-        self.sendLine(self.CLIENT_ERROR % error)
+        self.sendResponse(self.CLIENT_ERROR % error)
+
+    def sendServerError(self, failure):
+        logger.error(failure.getTraceback())
+        self.sendLine(self.SERVER_ERROR % repr(failure.value).encode("ascii"))
+
+    def noteKeys(self, keys, write=False):
+        """
+        Gives the keys of a request to the server's key tracker, if keys
+        are being tracked.
+
+        :param keys: an iterable of keys
+        :param write: whether they are written rather than read
+        """
+        tracker = self.stats.key_tracker
+        if tracker is not None:
+            tracker.record(keys, write)
+
+    def callDataLayer(self, operation, args, callback, errback=None):
+        """
+        Calls the data layer method named 'operation' with 'args' once all
+        previous calls made by this connection have completed, then passes
+        the result to 'callback' to send the response. Failures are passed
+        to 'errback' if given; those it does not handle are answered with a
+        SERVER_ERROR.
+
+        The data layer may either return its result directly or return a
+        Deferred. Calls are chained per connection, so pipelined commands
+        are executed and answered in the order they arrived while other
+        connections keep being served.
+
+        Data layers that answer each call as if every earlier call had
+        completed (READ_YOUR_WRITES) are called right away instead; only the
+        response waits for the earlier ones.
+        """
+        def call():
+            start = perf_counter()
+            d = defer.maybeDeferred(
+                getattr(self.data_layer, operation), *args
+            )
+            return d.addBoth(self._operationDone, operation, start)
+
+        # Commands following a get answered a chunk at a time must not be
+        # seen by the chunks read after them
+        if getattr(self.data_layer, "READ_YOUR_WRITES", False) is True \
+                and not self.streams:
+            result = call()
+            self.pending.addCallback(lambda _: result)
+        else:
+            self.pending.addCallback(lambda _: call())
+        self.pending.addCallbacks(callback, errback)
+        self.pending.addErrback(self.sendServerError)
 
     def doSet(self, args):
-        logger.info("set {}".format(args))
-        if len(args) > 5 or len(args) < 4:
+        """
+        Parses the command line of all storage commands, which share the
+        syntax of 'set', and reads their payload.
+        """
+        logger.info("%s %s", self.command, args)
+        self.stats.incr("cmd_set")
+        # cas takes the CAS value after the payload size
+        num_args = 5 if self.command == self.CMD_CAS else 4
+        if len(args) > num_args + 1 or len(args) < num_args:
             self.sendClientError(self.INCORRECT_NUM_ARGUMENTS)
             return
 
         self.no_reply = False
 
-        # If there are 5 args, then the last one better be 'noreply'
-        if len(args) == 5:
-            if args[4] != self.NO_REPLY:
+        # If there is one more argument, then it better be 'noreply'
+        if len(args) == num_args + 1:
+            if args[num_args] != self.NO_REPLY:
                 self.sendClientError(self.EXPECTED_NO_REPLY)
                 return
             self.no_reply = True
             args.pop()
 
+        self.storage_command = self.command
         self.key = args[0]
         self.flags = int(args[1])
         self.exptime = int(args[2])
         self.bytes = int(args[3])
-        self.buffer = []
-        self.buffer_length = 0
-
-        # The data being stored is binary, so switch to binary mode.
-        self.setRawMode()
+        self.cas_unique = int(args[4]) if num_args == 5 else None
+        # The flags are checked by storeValue, once the data block has been
+        # read past rather than taken for commands
+        self.readPayload()
 
     def doGet(self, args):
-        logger.info("get {}".format(args))
-        for row in self.data_layer.get_values(args):
-            value = row["value"]
-            self.sendLine(
-                self.VALUE %
-                (row["key"].encode("ascii"), row["flags"], len(value))
+        """
+        'get <key>*' returns the items found for the keys, 'gets' their CAS
+        values as well.
+        """
+        logger.info("%s %s", self.command, args)
+        # Consecutive gets are looked up together by flushGets, which runs
+        # before any other command and once all received data is processed
+        self.queued_gets.append((self.command, args, self.command_start))
+
+    def flushGets(self):
+        """
+        Looks up the keys of all queued retrieval commands with a single data
+        layer call and answers each of them, unless they are for more than
+        GET_CHUNK_KEYS keys, in which case each command is streamed.
+        """
+        if not self.queued_gets:
+            return
+
+        gets, self.queued_gets = self.queued_gets, []
+        self.noteKeys(key for _, args, _ in gets for key in args)
+        keys = list(dict.fromkeys(
+            key for _, args, _ in gets for key in args
+        ))
+        if len(keys) > self.GET_CHUNK_KEYS:
+            for cmd, args, start in gets:
+                self.streams += 1
+                self.pending.addCallback(
+                    lambda _, cmd=cmd, args=args: self.streamValues(cmd, args)
+                )
+                self.pending.addErrback(self.sendServerError)
+                self.pending.addBoth(self._streamDone)
+                self.commandQueued(cmd, start)
+            return
+
+        with_cas = any(cmd == self.CMD_GETS for cmd, _, _ in gets)
+
+        def reply(rows):
+            rows = {row["key"]: row for row in rows}
+            for cmd, args, _ in gets:
+                found = [
+                    rows[key] for key in dict.fromkeys(args) if key in rows
+                ]
+                self.stats.incr("cmd_get", len(args))
+                self.stats.incr("get_hits", len(found))
+                self.stats.incr("get_misses", len(args) - len(found))
+                self.sendValues(found, cmd == self.CMD_GETS)
+
+        self.callDataLayer(
+            "get_values", (keys, True) if with_cas else (keys,), reply
+        )
+        for cmd, _, start in gets:
+            self.commandQueued(cmd, start)
+
+    def streamValues(self, cmd, args):
+        """
+        Answers the retrieval command 'cmd' for the keys 'args' a chunk of
+        keys at a time. Each chunk is read once the previous one has been
+        written and the transport has drained below its high-water mark, so
+        a large get never holds much more than 'max_response_bytes' bytes of
+        rows: after the first chunk, chunks are sized by the largest value
+        read so far.
+
+        :return: a Deferred firing once the response has been sent
+        """
+        keys = list(dict.fromkeys(args))
+        with_cas = cmd == self.CMD_GETS
+        position = 0
+        chunk_keys = self.GET_CHUNK_KEYS
+        largest = 0
+        hits = 0
+
+        def read(_):
+            if self.closed:
+                return
+            chunk = keys[position:position + chunk_keys]
+            start = perf_counter()
+            d = defer.maybeDeferred(
+                self.data_layer.get_values,
+                *((chunk, True) if with_cas else (chunk,))
             )
-            self.sendLine(row["value"])
-        self.sendLine(self.END)
+            d.addBoth(self._operationDone, "get_values", start)
+            return d.addCallback(send, chunk)
+
+        def send(rows, chunk):
+            nonlocal position, chunk_keys, largest, hits
+            rows = {row["key"]: row for row in rows}
+            found = [rows[key] for key in chunk if key in rows]
+            position += len(chunk)
+            hits += len(found)
+            for row in found:
+                largest = max(largest, len(row["value"]))
+            chunk_keys = max(1, min(
+                self.MAX_CHUNK_KEYS,
+                self.max_response_bytes // max(largest, 1)
+            ))
+            self.writeSequence(self.valueLines(found, with_cas))
+            if position < len(keys):
+                self.flushOutput()
+                return self.whenDrained().addCallback(read)
+            self.stats.incr("cmd_get", len(args))
+            self.stats.incr("get_hits", hits)
+            self.stats.incr("get_misses", len(args) - hits)
+            self.write(self.END_LINE)
+
+        return self.whenDrained().addCallback(read)
+
+    def _streamDone(self, result):
+        self.streams -= 1
+        return result
+
+    def sendValues(self, rows, with_cas=False):
+        # Collect the whole response and write it in one call. The values
+        # themselves are passed along without being copied into a bigger
+        # buffer.
+        response = self.valueLines(rows, with_cas)
+        response.append(self.END_LINE)
+        self.writeSequence(response)
+
+    def valueLines(self, rows, with_cas=False):
+        """
+        :return: the list of byte strings of the VALUE lines and data blocks
+        of 'rows'
+        """
+        response = []
+        for row in rows:
+            value = row["value"]
+            flags = row["flags"]
+            if row.get("compressed"):
+                if self.compressed_flag is None:
+                    value = self.compressor.decompress(value)
+                else:
+                    flags |= self.compressed_flag
+            if with_cas:
+                header = self.VALUE_CAS_HEADER % (
+                    encode_key(row["key"]), flags, len(value), row["cas"]
+                )
+            else:
+                header = self.VALUE_HEADER % (
+                    encode_key(row["key"]), flags, len(value)
+                )
+            response.append(header)
+            response.append(value)
+            response.append(self.delimiter)
+        return response
 
     def doDelete(self, args):
-        logger.info("delete {}".format(args))
+        logger.info("delete %s", args)
+        self.stats.incr("cmd_delete")
         # delete expects exactly one or two arguments
         if len(args) > 2 or len(args) == 0:
             self.sendClientError(self.INCORRECT_NUM_ARGUMENTS)
@@ -88,69 +514,393 @@ class MemcacheReceiver(LineReceiver):
                 self.sendClientError(self.EXPECTED_NO_REPLY)
                 return
             no_reply = True
+        self.noteKeys((key,), True)
 
         # Now delete the data
-        anything_deleted = self.data_layer.delete_value(key)
-        if no_reply:
+        def reply(anything_deleted):
+            self.stats.incr(
+                "delete_hits" if anything_deleted else "delete_misses"
+            )
+            if no_reply:
+                return
+
+            self.sendLine(
+                self.DELETED if anything_deleted else self.NOT_FOUND
+            )
+
+        self.callDataLayer("delete_value", (key,), reply)
+
+    def doCompressedFlag(self, args):
+        """
+        'compressed_flag <flag>' has values stored compressed sent to this
+        connection as they are, zlib-compressed, with 'flag' set in their
+        flags for the client library to decompress them. A flag of 0 has
+        them decompressed by the server again.
+        """
+        if len(args) != 1:
+            self.sendClientError(self.INCORRECT_NUM_ARGUMENTS)
+            return
+        flag = int(args[0])
+        if not 0 <= flag <= CLIENT_FLAGS:
+            self.sendClientError(self.BAD_COMMAND_LINE)
             return
+        self.compressed_flag = flag or None
+        self.sendResponse(self.OK)
 
-        self.sendLine(
-            self.DELETED if anything_deleted else self.NOT_FOUND
+    def doStats(self, args):
+        report = self.STATS_REPORTS.get(" ".join(args))
+        if report is None:
+            self.sendResponse(self.UNKNOWN_COMMAND_ERROR)
+            return
+
+        response = [
+            self.STAT_LINE % (
+                name.encode("ascii"), str(value).encode("ascii")
+            )
+            for name, value in report(self.stats)
+        ]
+        response.append(self.END_LINE)
+        self.pending.addCallback(lambda _: self.writeSequence(response))
+
+    def doAdmin(self, args):
+        """
+        Runs the admin command, once the responses to all earlier commands
+        on this connection have been sent.
+        """
+        command = self.admin_commands[self.command]
+
+        def refused(failure):
+            failure.trap(AdminError)
+            self.sendLine(
+                self.CLIENT_ERROR % str(failure.value).encode("ascii")
+            )
+
+        self.pending.addCallback(
+            lambda _: defer.maybeDeferred(command, args)
+        )
+        self.pending.addCallbacks(
+            lambda lines: self.writeSequence(
+                [line + self.delimiter for line in lines]
+            ),
+            refused
         )
+        self.pending.addErrback(self.sendServerError)
 
-    # Reads in the payload to be stored for the 'set' command
-    def rawDataReceived(self, data):
+    # Reports of 'stats', by the argument selecting them
+    STATS_REPORTS = {
+        "": Stats.general,
+        "latency": Stats.latency,
+        "datalayer": Stats.data_layer,
+    }
+
+    def payloadReceived(self, payload):
+        """
+        Stores 'payload', the bytearray holding the data block of a storage
+        command followed by its delimiter, or answers that the data block
+        was too large if it is None.
+        """
         try:
-            self.buffer.append(data)
-            self.buffer_length += len(data)
-
-            # Keep on reading data until the expected number of bytes have been
-            # encountered
-            if self.buffer_length >= self.bytes + 2:
-                full_buffer = b"".join(self.buffer)
-                value = full_buffer[:self.bytes]
-                left_over = full_buffer[self.bytes + 2:]
-
-                # Store the value in the database
-                self.data_layer.set_value(self.key, value, self.flags)
-                if not self.no_reply:
-                    self.sendLine(self.STORED)
-
-                # now switch back to parsing new commands
-                self.setLineMode(left_over)
+            if payload is None:
+                self.sendResponse(self.SERVER_ERROR % self.OBJECT_TOO_LARGE)
+            else:
+                self.storeValue(payload)
         except Exception as e:
             logger.exception(e)
-            self.sendLine(self.SERVER_ERROR % repr(e).encode("ascii"))
+            self.sendResponse(self.SERVER_ERROR % repr(e).encode("ascii"))
+        self.commandQueued(self.storage_command, self.command_start)
+
+    def storeValue(self, value):
+        # Drop the trailing delimiter in place, which lets the buffer itself
+        # be stored as the value
+        if value[self.bytes:] != self.delimiter:
+            self.sendClientError(self.BAD_DATA_CHUNK)
+            return
+        del value[self.bytes:]
+        if not 0 <= self.flags <= CLIENT_FLAGS:
+            self.sendClientError(self.BAD_COMMAND_LINE)
+            return
+
+        # Store the value in the database
+        no_reply = self.no_reply
+        command = self.storage_command
+        operation, full_item = self.STORAGE_OPERATIONS[command]
+        args = (self.key, value)
+        if full_item:
+            args += (self.flags, self.exptime)
+        if command == self.CMD_CAS:
+            args += (self.cas_unique,)
+        self.noteKeys((self.key,), True)
+
+        def reply(stored):
+            if command == self.CMD_CAS:
+                # True if stored, False if the key changed, None if missing
+                self.stats.incr(self.CAS_STATS[stored])
+                response = self.CAS_RESPONSES[stored]
+            elif stored or command == self.CMD_SET:
+                # set always stores the value, the others report whether
+                # they did
+                response = self.STORED
+            else:
+                response = self.NOT_STORED
+            if not no_reply:
+                self.sendLine(response)
+
+        self.callDataLayer(operation, args, reply)
+
+    def parseNoReply(self, args, num_args):
+        """
+        Checks that 'args' holds 'num_args' arguments, optionally followed by
+        'noreply', and sends an error response if it does not.
+
+        :return: whether 'noreply' was given, None if the arguments are
+        invalid
+        """
+        if len(args) not in (num_args, num_args + 1):
+            self.sendClientError(self.INCORRECT_NUM_ARGUMENTS)
+            return None
+        if len(args) > num_args:
+            if args[num_args] != self.NO_REPLY:
+                self.sendClientError(self.EXPECTED_NO_REPLY)
+                return None
+            return True
+        return False
+
+    def doIncr(self, args):
+        """
+        'incr <key> <delta> [noreply]' adds 'delta' to the number stored for
+        'key' and answers with the result, 'decr' subtracts it.
+        """
+        command = self.command
+        logger.info("%s %s", command, args)
+        no_reply = self.parseNoReply(args, 2)
+        if no_reply is None:
+            return
+        key, delta = args[:2]
+        if not delta.isdigit() or int(delta) > MAX_COUNTER:
+            self.sendClientError(self.INVALID_DELTA)
+            return
+        delta = int(delta)
+        if command == self.CMD_DECR:
+            delta = -delta
+        self.noteKeys((key,), True)
+
+        def reply(value):
+            self.stats.incr("{}_{}".format(
+                command, "misses" if value is None else "hits"
+            ))
+            if not no_reply:
+                self.sendLine(
+                    self.NOT_FOUND if value is None
+                    else str(value).encode("ascii")
+                )
+
+        def nonNumeric(failure):
+            failure.trap(NonNumericValue)
+            if not no_reply:
+                self.sendLine(self.CLIENT_ERROR % self.NON_NUMERIC_VALUE)
+
+        self.callDataLayer("incr_value", (key, delta), reply, nonNumeric)
+
+    def doTouch(self, args):
+        """
+        'touch <key> <exptime> [noreply]' changes the expiration time of
+        'key' without fetching or storing its value.
+        """
+        logger.info("touch %s", args)
+        self.stats.incr("cmd_touch")
+        no_reply = self.parseNoReply(args, 2)
+        if no_reply is None:
+            return
+
+        self.noteKeys(args[:1], True)
+
+        def reply(touched):
+            self.stats.incr("touch_hits" if touched else "touch_misses")
+            if not no_reply:
+                self.sendLine(self.TOUCHED if touched else self.NOT_FOUND)
+
+        self.callDataLayer(
+            "touch_value", (args[0], int(args[1])), reply
+        )
+
+    CAS_RESPONSES = {True: STORED, False: EXISTS, None: NOT_FOUND}
+    CAS_STATS = {True: "cas_hits", False: "cas_badval", None: "cas_misses"}
 
     # Extensible set of commands
     COMMAND_MAP = {
         CMD_SET: doSet,
+        CMD_ADD: doSet,
+        CMD_REPLACE: doSet,
+        CMD_APPEND: doSet,
+        CMD_PREPEND: doSet,
+        CMD_INCR: doIncr,
+        CMD_DECR: doIncr,
+        CMD_TOUCH: doTouch,
+        CMD_CAS: doSet,
         CMD_GET: doGet,
+        CMD_GETS: doGet,
         CMD_DELETE: doDelete,
+        CMD_STATS: doStats,
+        CMD_COMPRESSED_FLAG: doCompressedFlag,
     }
 
     # Parses commands
     def lineReceived(self, line):
-        parsed_line = line.decode("ascii").split(" ")
+        # 'line' may be any bytes-like object. It is decoded the way keys
+        # are, so keys may be any bytes.
+        parsed_line = str(line, KEY_ENCODING, KEY_ERRORS).split(" ")
         cmd = parsed_line[0]
         args = parsed_line[1:]
 
+        if cmd not in self.RETRIEVAL_COMMANDS:
+            self.flushGets()
+
         # Unrecognized command - abort
-        if cmd not in self.COMMAND_MAP:
-            self.sendLine(self.UNKNOWN_COMMAND_ERROR)
+        if cmd in self.COMMAND_MAP:
+            handler = self.COMMAND_MAP[cmd]
+        elif cmd in self.admin_commands:
+            handler = MemcacheCommands.doAdmin
+        else:
+            self.sendResponse(self.UNKNOWN_COMMAND_ERROR)
             return
 
+        self.command = cmd
+        self.command_start = perf_counter()
         try:
-            self.COMMAND_MAP[cmd](self, args)
+            handler(self, args)
         except Exception as e:
             logger.exception(e)
-            self.transport.write(self.SERVER_ERROR % repr(e).encode("ascii"))
+            self.sendResponse(self.SERVER_ERROR % repr(e).encode("ascii"))
+
+        # Gets are recorded by flushGets, and commands which switched to raw
+        # mode once their payload has been received
+        if cmd not in self.RETRIEVAL_COMMANDS and self.line_mode:
+            self.commandQueued(cmd, self.command_start)
+
+
+@implementer(IPushProducer)
+class ResponseProducer:
+    """
+    Registered as the streaming producer of a MemcacheReceiver's transport,
+    which pauses it once more than its bufferSize bytes are waiting to be
+    sent and resumes it once they have been. The receiver can't be the
+    producer itself: LineReceiver's pauseProducing and resumeProducing are
+    about reading.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def pauseProducing(self):
+        self.receiver.pauseResponses()
+
+    def resumeProducing(self):
+        self.receiver.resumeResponses()
+
+    def stopProducing(self):
+        pass
+
+
+class MemcacheReceiver(MemcacheCommands, LineReceiver):
+    """
+    Serves the memcache protocol on a Twisted transport, with LineReceiver
+    splitting the received data into lines.
+    """
+
+    def connectionMade(self):
+        super().connectionMade()
+        # The transport's high-water mark
+        self.transport.bufferSize = self.high_water
+        self.transport.registerProducer(ResponseProducer(self), True)
+
+    def pauseReading(self):
+        self.pauseProducing()
+
+    def resumeReading(self):
+        self.resumeProducing()
+
+    def dataReceived(self, data):
+        """
+        Processes every complete command in 'data' and then writes out all
+        the responses that are ready in one go.
+        """
+        if self.output is not None:
+            # Called again by setLineMode() with the data left over after
+            # a payload
+            super().dataReceived(data)
+            return
+
+        self.stats.incr("bytes_read", len(data))
+        self.output = []
+        try:
+            super().dataReceived(data)
+            self.flushGets()
+        finally:
+            output, self.output = self.output, None
+            if output:
+                self.transport.writeSequence(output)
+
+    def writeToTransport(self, data):
+        self.transport.writeSequence(data)
+
+    def readPayload(self):
+        # The payload is read straight into a buffer of its final size. Too
+        # large payloads are not buffered at all, just skipped.
+        if self.bytes > self.max_item_size:
+            self.buffer = None
+        else:
+            self.buffer = bytearray(self.bytes + 2)
+            self.buffer_view = memoryview(self.buffer)
+        self.buffer_length = 0
+
+        # The data being stored is binary, so switch to binary mode.
+        self.setRawMode()
+
+    # Reads in the payload to be stored by a storage command
+    def rawDataReceived(self, data):
+        # Keep on reading data until the expected number of bytes have been
+        # encountered
+        needed = self.bytes + 2 - self.buffer_length
+        if self.buffer is not None:
+            chunk = memoryview(data)[:needed]
+            self.buffer_view[
+                self.buffer_length:self.buffer_length + len(chunk)
+            ] = chunk
+        self.buffer_length += min(len(data), needed)
+        if self.buffer_length < self.bytes + 2:
+            return
+
+        left_over = data[needed:]
+        payload = self.buffer
+        if payload is not None:
+            self.buffer = None
+            self.buffer_view.release()
+        self.payloadReceived(payload)
+
+        # now switch back to parsing new commands
+        self.setLineMode(left_over)
 
 
 class MemcacheFactory(Factory):
-    def __init__(self, data_layer):
+    protocol = MemcacheReceiver
+
+    def __init__(self, data_layer,
+                 max_item_size=MemcacheReceiver.DEFAULT_MAX_ITEM_SIZE,
+                 stats=None, compressor=None, admin_commands=None,
+                 high_water=MemcacheReceiver.DEFAULT_HIGH_WATER,
+                 max_response_bytes=MemcacheReceiver
+                 .DEFAULT_MAX_RESPONSE_BYTES):
         super().__init__()
         self.data_layer = data_layer
+        self.max_item_size = max_item_size
+        self.stats = Stats() if stats is None else stats
+        self.compressor = Compressor() if compressor is None else compressor
+        self.admin_commands = admin_commands or {}
+        self.high_water = high_water
+        self.max_response_bytes = max_response_bytes
 
     def buildProtocol(self, addr):
-        return MemcacheReceiver(self.data_layer)
+        return self.protocol(
+            self.data_layer, self.max_item_size, self.stats, self.compressor,
+            self.admin_commands, self.high_water, self.max_response_bytes
+        )
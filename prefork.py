@@ -0,0 +1,125 @@
+from twisted.internet import defer, protocol
+from twisted.internet import reactor as global_reactor
+from twisted.internet.error import ProcessExitedAlready
+import os
+import socket
+
+import logging
+logger = logging.getLogger(__name__)
+
+# File descriptor number under which workers inherit the listening socket
+WORKER_LISTEN_FD = 3
+
+
+def listening_socket(port, backlog=1024):
+    """
+    Creates a non-blocking TCP socket listening on 'port' on all interfaces,
+    to be shared by the worker processes.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self.index, reason)
+
+
+class Supervisor:
+    """
+    Runs a fixed number of worker processes which all accept connections on
+    the same inherited listening socket, restarts workers that die and stops
+    them all when the reactor shuts down.
+    """
+
+    def __init__(self, listen_fd, worker_argv, num_workers,
+                 restart_delay=1.0, stop_timeout=10.0,
+                 reactor=global_reactor):
+        """
+            :param listen_fd: file descriptor of the listening socket. Each
+            worker gets it as WORKER_LISTEN_FD.
+            :param worker_argv: function returning the command line of the
+            worker with the given index
+            :param num_workers: number of worker processes to keep running
+            :param restart_delay: seconds to wait before restarting a worker
+            :param stop_timeout: seconds to wait for workers to exit on
+            shutdown before killing them
+            :param reactor: the reactor used to run the processes
+        """
+        self.listen_fd = listen_fd
+        self.worker_argv = worker_argv
+        self.num_workers = num_workers
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.reactor = reactor
+        self.workers = {}
+        self.restarts = 0
+        self.stopping = False
+        self.stopped = None
+
+    def start(self):
+        for index in range(self.num_workers):
+            self.spawn(index)
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        argv = self.worker_argv(index)
+        self.workers[index] = self.reactor.spawnProcess(
+            WorkerProtocol(self, index), argv[0], argv, env=os.environ,
+            childFDs={0: 0, 1: 1, 2: 2, WORKER_LISTEN_FD: self.listen_fd},
+        )
+        logger.info(
+            "Started worker %d (pid %d)", index, self.workers[index].pid
+        )
+
+    def workerEnded(self, index, reason):
+        self.workers.pop(index, None)
+        if self.stopping:
+            if not self.workers and self.stopped is not None:
+                self.stopped.callback(None)
+            return
+
+        logger.error("Worker %d ended: %s", index, reason.value)
+        self.restarts += 1
+        self.reactor.callLater(self.restart_delay, self.spawn, index)
+
+    def _signal_all(self, signal):
+        for process in self.workers.values():
+            try:
+                process.signalProcess(signal)
+            except ProcessExitedAlready:
+                pass
+
+    def stop(self):
+        """
+        Asks every worker to exit, killing those that have not done so after
+        'stop_timeout' seconds.
+
+        :return: a Deferred firing once all workers have exited
+        """
+        self.stopping = True
+        if not self.workers:
+            return defer.succeed(None)
+
+        self.stopped = defer.Deferred()
+        self._signal_all("TERM")
+        kill = self.reactor.callLater(
+            self.stop_timeout, self._signal_all, "KILL"
+        )
+
+        def cancel_kill(result):
+            if kill.active():
+                kill.cancel()
+            return result
+
+        return self.stopped.addBoth(cancel_kill)
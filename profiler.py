@@ -0,0 +1,169 @@
+from memcache_receiver import AdminError
+from twisted.internet import reactor as global_reactor
+import os
+import sys
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    Profiles the reactor thread while switched on, by the 'profile' admin
+    command or a signal, by sampling its stack from a thread of its own.
+
+    Every 'interval' seconds the sampling thread looks up the frame the
+    reactor thread is running and counts its stack. When stopped, or after
+    'max_seconds', the counts are written to a file in the profile
+    directory as folded stacks, one line per stack with its functions from
+    the outermost down separated by semicolons and followed by its count,
+    which flame graph tools read. Switched off, the profiler costs nothing:
+    the sampling thread only runs while a profile is taken.
+    """
+
+    DEFAULT_INTERVAL = 0.01
+    DEFAULT_MAX_SECONDS = 60.0
+    # Distinct stacks counted in a profile, beyond which stacks not seen
+    # yet are counted together as OTHER
+    MAX_STACKS = 10000
+    OTHER = "[other]"
+
+    OK = b"OK"
+    START = "start"
+    STOP = "stop"
+    USAGE = "expected profile start [<seconds>]|stop"
+
+    def __init__(self, directory, interval=DEFAULT_INTERVAL,
+                 max_seconds=DEFAULT_MAX_SECONDS, thread_id=None,
+                 clock=global_reactor):
+        """
+            :param directory: directory the profiles are written to
+            :param interval: seconds between samples
+            :param max_seconds: seconds after which a profile stops unless
+            a shorter time is given when starting it
+            :param thread_id: identifier of the thread profiled, by default
+            the one creating the profiler
+            :param clock: provider of callLater used for scheduling
+        """
+        self.directory = directory
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.thread_id = threading.get_ident() if thread_id is None \
+            else thread_id
+        self.clock = clock
+        self.thread = None
+        self.stopping = None
+        self.timeout = None
+        self.samples = {}
+        self.profiles = 0
+        self.sample_count = 0
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, seconds=None):
+        """
+        Starts sampling, for at most 'seconds' or 'max_seconds'.
+        """
+        if self.running:
+            raise AdminError("a profile is being taken already")
+        self.samples = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self._sample, args=(self.samples, self.stopping),
+            name="profiler", daemon=True
+        )
+        self.thread.start()
+        self.timeout = self.clock.callLater(
+            min(seconds or self.max_seconds, self.max_seconds), self.stop
+        )
+
+    def _sample(self, samples, stopping):
+        # Runs on the sampling thread. Labels are made once per function.
+        labels = {}
+        current_frames = sys._current_frames
+        while not stopping.wait(self.interval):
+            frame = current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = "{} ({}:{})".format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno
+                    )
+                stack.append(label)
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack = ";".join(reversed(stack))
+            if stack not in samples and len(samples) >= self.MAX_STACKS:
+                stack = self.OTHER
+            samples[stack] = samples.get(stack, 0) + 1
+
+    def stop(self):
+        """
+        Stops sampling and writes the profile.
+
+        :return: the name of the file written
+        """
+        if not self.running:
+            raise AdminError("no profile is being taken")
+        if self.timeout.active():
+            self.timeout.cancel()
+        else:
+            logger.warning("Profile stopped at its time limit")
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+        self.profiles += 1
+        name = os.path.join(self.directory, "profile-{}-{}-{}.folded".format(
+            os.getpid(), time.strftime("%Y%m%d-%H%M%S"), self.profiles
+        ))
+        samples = sorted(self.samples.items(), key=lambda item: -item[1])
+        with open(name, "w", errors="backslashreplace") as f:
+            for stack, count in samples:
+                f.write("{} {}\n".format(stack, count))
+        self.sample_count += sum(self.samples.values())
+        logger.warning("Profile written to %s", name)
+        return name
+
+    def toggle(self):
+        """
+        Starts sampling if stopped, stops it otherwise, as a signal does.
+        """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def command(self, args):
+        """
+        'profile start [<seconds>]' starts sampling, 'profile stop' stops
+        and answers 'OK <file>' with the name of the profile written.
+        """
+        if args[:1] == [self.START] and len(args) <= 2:
+            try:
+                seconds = float(args[1]) if len(args) == 2 else None
+            except ValueError:
+                raise AdminError(self.USAGE)
+            if seconds is not None and seconds <= 0:
+                raise AdminError("the time must be positive")
+            self.start(seconds)
+            return [self.OK]
+        if args == [self.STOP]:
+            name = self.stop()
+            return [self.OK + b" " + os.fsencode(name)]
+        raise AdminError(self.USAGE)
+
+    def stats(self):
+        return {
+            "running": int(self.running),
+            "profiles": self.profiles,
+            "samples": self.sample_count,
+        }
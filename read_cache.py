@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from data_layer import is_expired
+from twisted.internet import defer
+
+
+class ReadCache:
+    """
+    Memory-bounded, least recently used cache of rows in front of a data
+    layer (synchronous or asynchronous).
+
+    Reads are served from the cache where possible; the keys it does not
+    hold are fetched from the data layer in a single get_values call and
+    cached. Writes drop the key from the cache both when they are issued and
+    when they complete, so the cache never serves a value older than one the
+    data layer has already returned.
+    """
+
+    # Approximate per-entry cost of the dictionaries and the LRU bookkeeping,
+    # on top of the key and value themselves
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, data_layer, max_bytes):
+        """
+            :param data_layer: the data layer to read through to
+            :param max_bytes: upper limit for the memory used by cached rows
+        """
+        self.data_layer = data_layer
+        self.max_bytes = max_bytes
+        self.READ_YOUR_WRITES = \
+            getattr(data_layer, "READ_YOUR_WRITES", False) is True
+
+        self.rows = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Incremented by every write, so that reads which were in flight
+        # while a key changed don't cache what they read
+        self.write_epoch = 0
+
+    def _entry_size(self, row):
+        return len(row["key"]) + len(row["value"]) + self.ENTRY_OVERHEAD
+
+    def _add(self, row):
+        size = self._entry_size(row)
+        if size > self.max_bytes:
+            return
+
+        self._discard(row["key"])
+        self.rows[row["key"]] = row
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.rows.popitem(last=False)
+            self.bytes -= self._entry_size(evicted)
+            self.evictions += 1
+
+    def _discard(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.bytes -= self._entry_size(row)
+
+    def invalidate(self, key):
+        """
+        Drops 'key' from the cache.
+        """
+        self.write_epoch += 1
+        self._discard(key)
+
+    def clear(self):
+        """
+        Drops every key from the cache.
+        """
+        self.write_epoch += 1
+        self.rows.clear()
+        self.bytes = 0
+
+    def _write(self, key, method, *args):
+        self.invalidate(key)
+
+        def written(result):
+            self.invalidate(key)
+            return result
+
+        return defer.maybeDeferred(method, *args).addBoth(written)
+
+    def set_value(self, key, value, flags, exptime=0):
+        return self._write(
+            key, self.data_layer.set_value, key, value, flags, exptime
+        )
+
+    def add_value(self, key, value, flags, exptime=0):
+        return self._write(
+            key, self.data_layer.add_value, key, value, flags, exptime
+        )
+
+    def replace_value(self, key, value, flags, exptime=0):
+        return self._write(
+            key, self.data_layer.replace_value, key, value, flags, exptime
+        )
+
+    def cas_value(self, key, value, flags, exptime, cas):
+        return self._write(
+            key, self.data_layer.cas_value, key, value, flags, exptime, cas
+        )
+
+    def append_value(self, key, value):
+        return self._write(key, self.data_layer.append_value, key, value)
+
+    def prepend_value(self, key, value):
+        return self._write(key, self.data_layer.prepend_value, key, value)
+
+    def incr_value(self, key, delta):
+        return self._write(key, self.data_layer.incr_value, key, delta)
+
+    def touch_value(self, key, exptime):
+        return self._write(key, self.data_layer.touch_value, key, exptime)
+
+    def delete_value(self, key):
+        return self._write(key, self.data_layer.delete_value, key)
+
+    def get_values(self, keys, with_cas=False):
+        if with_cas:
+            # Cached rows don't carry CAS values
+            return self.data_layer.get_values(keys, with_cas)
+
+        cached = []
+        missing = []
+        for key in keys:
+            row = self.rows.get(key)
+            if row is not None and is_expired(row):
+                self._discard(key)
+                row = None
+            if row is None:
+                missing.append(key)
+                continue
+            self.rows.move_to_end(key)
+            cached.append(row)
+
+        self.hits += len(cached)
+        self.misses += len(missing)
+        if cached:
+            # Reads served from memory still count for eviction
+            self.data_layer.note_accesses([row["key"] for row in cached])
+        if not missing:
+            return cached
+
+        epoch = self.write_epoch
+
+        def fetched(rows):
+            rows = list(rows)
+            if epoch == self.write_epoch:
+                for row in rows:
+                    self._add(row)
+            return cached + rows
+
+        d = defer.maybeDeferred(self.data_layer.get_values, missing)
+        d.addCallback(fetched)
+        return d
+
+    def get_all_values(self):
+        return self.data_layer.get_all_values()
+
+    def stats(self):
+        """
+        :return: a dictionary with the cache's counters
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "items": len(self.rows),
+            "bytes": self.bytes,
+            "limit_maxbytes": self.max_bytes,
+        }
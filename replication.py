@@ -0,0 +1,555 @@
+from data_layer import decode_key, encode_key
+from twisted.internet import defer, protocol
+from twisted.internet import reactor as global_reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.protocols.basic import LineReceiver
+from zope.interface import implementer
+import struct
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Replicas follow the change log of their primary (see
+# schema.create_change_log) over a connection per shard. A replica opens
+# with
+#
+#   SYNC <shard> <log id> <position>
+#
+# giving the log it follows and the position up to which it has applied it,
+# '-' for both if it has none. The primary answers with batches of changes:
+#
+#   BATCH <position> <head> <length>\r\n<length bytes of changes>
+#
+# which bring the replica to 'position' of the log, whose last entry is
+# 'head'. If the replica does not follow the primary's log or has fallen
+# behind what the log retains, the primary first sends
+#
+#   SNAPSHOT <log id>
+#
+# upon which the replica deletes its items, followed by batches of all the
+# primary's items with '-' as their position and a last, empty, batch with
+# the position of the log the copy started at.
+SYNC = b"SYNC"
+SNAPSHOT = b"SNAPSHOT"
+BATCH = b"BATCH"
+ERROR = b"ERROR"
+NONE = b"-"
+
+# Every change starts with whether the key was set, the lengths of the key,
+# the stored flags, the expiration time and the length of the value,
+# followed by the key and the value. Deleted keys have no value.
+CHANGE_HEADER = struct.Struct(">?HqqI")
+
+
+def encode_changes(writes):
+    """
+    :param writes: (key, row) pairs as returned by DataLayer.changes
+    :return: the bytes sent for 'writes'
+    """
+    parts = []
+    for key, row in writes:
+        key = encode_key(key)
+        if row is None:
+            parts.extend([CHANGE_HEADER.pack(False, len(key), 0, 0, 0), key])
+            continue
+        value, flags, expiry = row
+        parts.extend([
+            CHANGE_HEADER.pack(True, len(key), flags, expiry, len(value)),
+            key, value
+        ])
+    return b"".join(parts)
+
+
+def decode_changes(data):
+    """
+    :return: the (key, row) writes encoded in 'data' by encode_changes
+    """
+    writes = []
+    pos = 0
+    while pos < len(data):
+        if len(data) - pos < CHANGE_HEADER.size:
+            raise ValueError("Truncated change")
+        is_set, key_size, flags, expiry, value_size = \
+            CHANGE_HEADER.unpack_from(data, pos)
+        pos += CHANGE_HEADER.size
+        key = decode_key(data[pos:pos + key_size])
+        pos += key_size
+        if is_set:
+            writes.append(
+                (key, (bytes(data[pos:pos + value_size]), flags, expiry))
+            )
+            pos += value_size
+        else:
+            writes.append((key, None))
+    if pos > len(data):
+        raise ValueError("Truncated change")
+    return writes
+
+
+def _optional(value):
+    return NONE if value is None else str(value).encode("ascii")
+
+
+def _parse_optional(value, parse):
+    return None if value == NONE else parse(value)
+
+
+@implementer(IPushProducer)
+class ChangeSender(LineReceiver):
+    """
+    Sends the changes of one shard of the primary to a replica.
+
+    The change log is polled for entries after the replica's position, and
+    as long as a poll finds a full batch, the next one is read right away.
+    A SendProducer is registered as the producer of its transport, so it
+    stops reading while the replica is slow to take what was sent.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.store = None
+        self.log_id = None
+        # Position of the log the replica has been sent up to
+        self.position = None
+        # Whether all the items are being copied, and the last key copied
+        self.copying = False
+        self.copied_key = None
+        # The head of the log as last sent to the replica
+        self.reported_head = None
+        self.busy = False
+        # Whether the transport has asked for no more to be sent for now
+        self.throttled = False
+        self.poll = None
+
+    def connectionMade(self):
+        self.source.senders.add(self)
+        self.transport.registerProducer(SendProducer(self), True)
+
+    def connectionLost(self, reason):
+        self.source.senders.discard(self)
+        self.store = None
+        if self.poll is not None and self.poll.active():
+            self.poll.cancel()
+
+    def lineReceived(self, line):
+        parts = line.split()
+        try:
+            command, shard, log_id, position = parts
+            if command != SYNC or self.store is not None:
+                raise ValueError(command)
+            shard = int(shard)
+            log_id = _parse_optional(log_id, lambda v: v.decode("ascii"))
+            position = _parse_optional(position, int)
+        except ValueError:
+            return self.refuse(b"expected SYNC <shard> <log id> <position>")
+        if not 0 <= shard < len(self.source.stores):
+            return self.refuse(b"no shard %d" % shard)
+
+        self.store = self.source.stores[shard]
+        d = defer.maybeDeferred(self.store.log_position)
+        d.addCallback(self.synced, log_id, position)
+        d.addErrback(self.failed)
+
+    def synced(self, log_position, log_id, position):
+        self.log_id, head = log_position
+        if log_id == self.log_id and position is not None:
+            self.position = position
+        else:
+            self.startCopy(head)
+        self.pump()
+
+    def startCopy(self, head):
+        """
+        Starts sending all the items, followed by the changes made from
+        position 'head' of the log on.
+        """
+        self.source.snapshots += 1
+        self.position = head
+        self.copying = True
+        self.copied_key = None
+        self.sendLine(SNAPSHOT + b" " + self.log_id.encode("ascii"))
+
+    def pump(self):
+        """
+        Reads and sends the next batch, unless one is being read already or
+        the replica is not taking any more.
+        """
+        if self.busy or self.throttled or self.store is None:
+            return
+        if self.poll is not None and self.poll.active():
+            self.poll.cancel()
+        self.poll = None
+        self.busy = True
+        if self.copying:
+            d = defer.maybeDeferred(
+                self.store.dump_items, self.copied_key,
+                self.source.batch_size
+            )
+            d.addCallback(self.sendItems)
+        else:
+            d = defer.maybeDeferred(
+                self.store.changes, self.position, self.source.batch_size
+            )
+            d.addCallback(self.sendChanges)
+        d.addCallbacks(self.pumped, self.failed)
+
+    def pumped(self, more):
+        self.busy = False
+        if self.store is None or self.transport.disconnecting:
+            return
+        delay = 0 if more else self.source.interval
+        self.poll = self.source.clock.callLater(delay, self.pump)
+
+    def sendItems(self, items):
+        """
+        :return: true, more items or changes follow
+        """
+        if items:
+            self.sendBatch(items, None, self.position)
+            self.copied_key = items[-1][0]
+        if len(items) < self.source.batch_size:
+            self.copying = False
+            self.sendBatch([], self.position, self.position)
+        return True
+
+    def sendChanges(self, changes):
+        """
+        :return: true if more changes are waiting to be sent
+        """
+        if changes is None:
+            # The log no longer goes back to the replica's position
+            d = defer.maybeDeferred(self.store.log_position)
+            d.addCallback(lambda log_position: self.startCopy(
+                log_position[1]
+            ))
+            return d.addCallback(lambda _: True)
+        if changes["position"] == self.position:
+            # Tells a replica which has just connected that it is caught up
+            if changes["head"] != self.reported_head:
+                self.sendBatch([], self.position, changes["head"])
+            return False
+        self.sendBatch(
+            changes["writes"], changes["position"], changes["head"]
+        )
+        self.position = changes["position"]
+        return self.position < changes["head"]
+
+    def sendBatch(self, writes, position, head):
+        data = encode_changes(writes)
+        self.transport.writeSequence([
+            b"%s %s %d %d\r\n" % (BATCH, _optional(position), head,
+                                  len(data)),
+            data
+        ])
+        self.source.sent_changes += len(writes)
+        self.reported_head = head
+
+    def refuse(self, reason):
+        self.sendLine(ERROR + b" " + reason)
+        self.transport.loseConnection()
+
+    def failed(self, failure):
+        logger.error(failure.getTraceback())
+        self.busy = False
+        self.refuse(b"server error")
+
+    def pauseSending(self):
+        self.throttled = True
+
+    def resumeSending(self):
+        self.throttled = False
+        self.pump()
+
+
+class SendProducer:
+    """
+    Registered as the streaming producer of a ChangeSender's transport,
+    which pauses it while more than its bufferSize bytes are waiting to be
+    sent. The sender can't be the producer itself: LineReceiver's
+    pauseProducing and resumeProducing are about reading.
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def pauseProducing(self):
+        self.sender.pauseSending()
+
+    def resumeProducing(self):
+        self.sender.resumeSending()
+
+    def stopProducing(self):
+        self.sender.pauseSending()
+
+
+class ReplicationSource(protocol.ServerFactory):
+    """
+    Serves the change logs of the shards of a primary to its replicas.
+    """
+    protocol = ChangeSender
+
+    def __init__(self, stores, batch_size=1000, interval=0.1,
+                 clock=global_reactor):
+        """
+            :param stores: a data layer (synchronous or asynchronous) for
+            each shard, whose databases record their change log
+            :param batch_size: maximum number of log entries, or of items
+            when copying all of them, read and sent at a time
+            :param interval: seconds between polls of the log once a replica
+            has been sent all of it
+            :param clock: provider of callLater used for scheduling
+        """
+        self.stores = stores
+        self.batch_size = batch_size
+        self.interval = interval
+        self.clock = clock
+        self.senders = set()
+        self.sent_changes = 0
+        self.snapshots = 0
+
+    def buildProtocol(self, addr):
+        sender = self.protocol(self)
+        sender.factory = self
+        return sender
+
+    def stats(self):
+        return {
+            "replicas": len(self.senders),
+            "sent_changes": self.sent_changes,
+            "sent_snapshots": self.snapshots,
+        }
+
+
+class ChangeReceiver(LineReceiver):
+    """
+    Applies the changes of one shard of the primary to the replica's
+    database. Every batch received is applied in one transaction, along
+    with the position in the log it brings the replica to, and nothing more
+    is read from the primary until it has been.
+    """
+
+    def __init__(self, replica, shard):
+        self.replica = replica
+        self.shard = shard
+        self.store = replica.stores[shard]
+        self.log_id = None
+        self.batch = None
+        self.payload = None
+        self.remaining = 0
+
+    def connectionMade(self):
+        d = defer.maybeDeferred(self.store.replica_state)
+        d.addCallbacks(self.sendSync, self.failed)
+
+    def connectionLost(self, reason):
+        self.connected = False
+        self.replica.disconnected(self.shard)
+
+    def sendSync(self, state):
+        self.log_id, position = state
+        self.replica.connected(self.shard, position)
+        self.sendLine(b"%s %d %s %s" % (
+            SYNC, self.shard, _optional(self.log_id), _optional(position)
+        ))
+
+    def lineReceived(self, line):
+        parts = line.split()
+        try:
+            if parts[0] == BATCH:
+                position, head, length = parts[1:]
+                self.batch = (_parse_optional(position, int), int(head))
+                self.remaining = int(length)
+                self.payload = bytearray()
+                if self.remaining:
+                    self.setRawMode()
+                else:
+                    self.batchReceived()
+            elif parts[0] == SNAPSHOT:
+                self.log_id = parts[1].decode("ascii")
+                self.replica.snapshots += 1
+                self.apply(self.store.reset_replica).addCallback(
+                    lambda _: self.replica.changed(self.shard, None)
+                )
+            elif parts[0] == ERROR:
+                logger.error("Primary refused shard {}: {}".format(
+                    self.shard, line.decode("ascii", "replace")
+                ))
+                self.transport.loseConnection()
+            else:
+                raise ValueError(parts[0])
+        except (IndexError, ValueError):
+            logger.error("Unexpected line from the primary: {!r}".format(
+                line
+            ))
+            self.transport.loseConnection()
+
+    def rawDataReceived(self, data):
+        self.payload += data[:self.remaining]
+        left_over = data[self.remaining:]
+        self.remaining -= len(data) - len(left_over)
+        if not self.remaining:
+            self.setLineMode(left_over)
+            self.batchReceived()
+
+    def batchReceived(self):
+        position, head = self.batch
+        writes = decode_changes(self.payload)
+        self.batch = self.payload = None
+
+        def applied(_):
+            self.replica.applied(self.shard, len(writes), position, head)
+            self.replica.changed(self.shard, [key for key, _ in writes])
+
+        self.apply(
+            self.store.apply_changes, writes, self.log_id, position
+        ).addCallback(applied)
+
+    def apply(self, f, *args):
+        """
+        Calls 'f' on the data layer, reading nothing more from the primary
+        until it has completed.
+        """
+        self.pauseProducing()
+        d = defer.maybeDeferred(f, *args)
+
+        def done(result):
+            if self.connected:
+                self.resumeProducing()
+            return result
+
+        return d.addCallbacks(done, self.failed)
+
+    def failed(self, failure):
+        logger.error(failure.getTraceback())
+        self.transport.loseConnection()
+
+
+class ReplicaClientFactory(protocol.ReconnectingClientFactory):
+    maxDelay = 10
+
+    def __init__(self, replica, shard):
+        self.replica = replica
+        self.shard = shard
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        receiver = ChangeReceiver(self.replica, self.shard)
+        receiver.factory = self
+        return receiver
+
+
+class Replica:
+    """
+    Keeps the databases of a replica in sync with those of its primary,
+    shard by shard, reconnecting whenever the connection is lost.
+
+    The lag reported is the number of entries of the primary's change logs
+    not applied yet, as of the last batch received, and the number of
+    seconds since the replica last had everything applied.
+    """
+
+    def __init__(self, stores, host, port, reactor=global_reactor):
+        """
+            :param stores: a data layer (synchronous or asynchronous) for
+            each shard, as many as the primary has
+            :param host: host name of the primary
+            :param port: port the primary serves its change log on
+            :param reactor: the reactor to connect with
+        """
+        self.stores = stores
+        self.host = host
+        self.port = port
+        self.reactor = reactor
+        self.factories = []
+        # Functions called with the keys of each batch applied, or None
+        # when all the items have been deleted
+        self.listeners = []
+        self.applied_changes = 0
+        self.snapshots = 0
+        now = reactor.seconds()
+        self.shards = [
+            {"connected": False, "position": None, "head": None,
+             "caught_up_at": now}
+            for _ in stores
+        ]
+
+    def start(self):
+        for shard in range(len(self.stores)):
+            factory = ReplicaClientFactory(self, shard)
+            self.factories.append(factory)
+            self.reactor.connectTCP(self.host, self.port, factory)
+
+    def stop(self):
+        for factory in self.factories:
+            factory.stopTrying()
+
+    def connected(self, shard, position):
+        self.shards[shard].update(connected=True, position=position)
+
+    def disconnected(self, shard):
+        self.shards[shard]["connected"] = False
+
+    def applied(self, shard, count, position, head):
+        self.applied_changes += count
+        state = self.shards[shard]
+        if position is not None:
+            state["position"] = position
+        state["head"] = head
+        if state["position"] == head:
+            state["caught_up_at"] = self.reactor.seconds()
+
+    def changed(self, shard, keys):
+        for listener in self.listeners:
+            listener(keys)
+
+    def stats(self):
+        now = self.reactor.seconds()
+        lag = 0
+        lag_seconds = 0
+        for state in self.shards:
+            caught_up = state["connected"] and \
+                state["position"] is not None and \
+                state["position"] == state["head"]
+            if state["position"] is not None and state["head"] is not None:
+                lag += max(state["head"] - state["position"], 0)
+            if not caught_up:
+                lag_seconds = max(lag_seconds, now - state["caught_up_at"])
+        return {
+            "connected_shards": sum(
+                state["connected"] for state in self.shards
+            ),
+            "lag": lag,
+            "lag_seconds": round(lag_seconds, 3),
+            "applied_changes": self.applied_changes,
+            "snapshots": self.snapshots,
+        }
+
+
+class ReadOnlyReplica(Exception):
+    """
+    Raised for writes sent to a replica.
+    """
+
+
+class ReadOnlyStore:
+    """
+    Wraps the data layer of a replica so that it refuses every write, which
+    only the primary takes.
+    """
+    WRITES = frozenset([
+        "set_value", "add_value", "replace_value", "cas_value",
+        "append_value", "prepend_value", "incr_value", "touch_value",
+        "delete_value", "apply_batch", "load",
+    ])
+
+    def __init__(self, data_layer):
+        self.data_layer = data_layer
+
+    def __getattr__(self, name):
+        if name in self.WRITES:
+            return self._refuse
+        return getattr(self.data_layer, name)
+
+    @staticmethod
+    def _refuse(*args):
+        raise ReadOnlyReplica("writes go to the primary")
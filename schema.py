@@ -1,22 +1,453 @@
 import sqlite3
 from contextlib import closing
 
+# Version of the schema created by create_schema, recorded in the
+# database's PRAGMA user_version. Version 2 took CAS values from the
+# largest one in ITEMS, which the write following a delete of that key
+# handed out again; create_schema upgrades it.
+SCHEMA_VERSION = 3
+# The first schema kept items in KEY_VALUE_PAIRS, a rowid table with text
+# keys, and recorded no version; migrate_schema upgrades it
+LEGACY_VERSION = 1
+# The oldest SQLite the schema and statements work with: ITEMS has a
+# generated column (3.31) and incr, decr and the CAS sequence use
+# RETURNING (3.35)
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+class SchemaVersionError(RuntimeError):
+    """
+    Raised for databases whose schema is not the version this code uses.
+    """
+
+
+class SQLiteVersionError(RuntimeError):
+    """
+    Raised when the SQLite library Python uses is older than
+    MIN_SQLITE_VERSION.
+    """
+
+
+def check_sqlite_version():
+    """
+    Raises SQLiteVersionError if the SQLite library Python uses is older
+    than MIN_SQLITE_VERSION.
+    """
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise SQLiteVersionError(
+            "SQLite {} or newer is needed, Python uses {}".format(
+                ".".join(map(str, MIN_SQLITE_VERSION)),
+                sqlite3.sqlite_version
+            )
+        )
+
+
+def schema_version(con):
+    """
+    :return: the version of the schema of the database 'con' is connected
+    to, 0 if it has none
+    """
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0 and con.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'KEY_VALUE_PAIRS'"
+    ).fetchone():
+        return LEGACY_VERSION
+    return version
+
+
+def check_schema_version(con):
+    """
+    Raises SchemaVersionError unless the database 'con' is connected to has
+    the current version of the schema.
+    """
+    version = schema_version(con)
+    if version == SCHEMA_VERSION:
+        return
+    if version == 0:
+        problem = "has no schema, create it with 'main.py install'"
+    elif version < SCHEMA_VERSION:
+        problem = "has version {} of the schema, upgrade it with " \
+            "'main.py migrate'".format(version)
+    else:
+        problem = "has version {} of the schema, which is newer than " \
+            "this code".format(version)
+    raise SchemaVersionError("The database {}".format(problem))
+
 
 def create_schema(db):
     """
     Creates the SQLite database schema to store our key/value pairs.
 
-    We don't store the expiration time for now. Only the key and the associated
-    value and flags.
+    ITEMS is a WITHOUT ROWID table clustered on the keys, stored as BLOBs,
+    so that looking a key up reads a single b-tree. Each key is stored with
+    its flags, the absolute unix time at which it expires (0 if it never
+    does), the size of its value, its CAS value, which changes with every
+    write of the key, the minute it was last accessed in and its value. The
+    value comes last, so that the other columns can be read without reading
+    through it. The partial index on the expiration time only covers keys
+    that can expire and lets the reaper find expired keys without scanning
+    the table, and the one on the last access lets eviction find the least
+    recently used keys.
+
+    STORE_USAGE holds the number of keys and their total size, kept up to
+    date by triggers so that finding out whether the store is full is a
+    single row read.
+
+    CAS_SEQUENCE holds the largest CAS value ever given to a key, which
+    writes give the next one to. Triggers raise it to any larger CAS value
+    written, such as those copied from another database, and it never goes
+    down, so a CAS value read before a key was deleted never matches the
+    key written again.
+
+    Running this again adds whatever is missing from the schema. Databases
+    with the first version of the schema are left to migrate_schema.
 
     :param db: name of the SQLite database file to use.
     :return: nothing
     """
+    check_sqlite_version()
+    with closing(sqlite3.connect(db)) as con:
+        with con:
+            version = schema_version(con)
+            if version == LEGACY_VERSION:
+                return
+            if version > SCHEMA_VERSION:
+                check_schema_version(con)
+            _create_items(con)
+            _create_usage(con)
+            _create_cas_sequence(con)
+            con.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+
+def _create_items(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS ITEMS(
+            KEY         BLOB PRIMARY KEY,
+            FLAGS       INTEGER,
+            EXPIRES_AT  INTEGER NOT NULL DEFAULT 0,
+            SIZE        INTEGER NOT NULL
+                        GENERATED ALWAYS AS (LENGTH(VALUE)) STORED,
+            CAS         INTEGER NOT NULL DEFAULT 0,
+            LAST_ACCESS INTEGER NOT NULL DEFAULT 0,
+            VALUE       BLOB
+        ) WITHOUT ROWID"""
+                )
+    con.execute("""
+        CREATE INDEX IF NOT EXISTS ITEMS_EXPIRES_AT
+        ON ITEMS(EXPIRES_AT)
+        WHERE EXPIRES_AT > 0"""
+                )
+    con.execute("""
+        CREATE INDEX IF NOT EXISTS ITEMS_LAST_ACCESS
+        ON ITEMS(LAST_ACCESS)"""
+                )
+
+
+# What an item counts towards the size of the store: its key and value
+ITEM_SIZE = "(LENGTH({0}.KEY) + {0}.SIZE)"
+
+
+def _create_usage(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS STORE_USAGE(
+            ID     INTEGER PRIMARY KEY CHECK (ID = 0),
+            ITEMS  INTEGER NOT NULL,
+            BYTES  INTEGER NOT NULL
+        )"""
+                )
+    # Counts the keys already there when the table is created. Triggers
+    # created in the same transaction keep the counts up to date from then
+    # on.
+    con.execute("""
+        INSERT OR IGNORE INTO STORE_USAGE (ID, ITEMS, BYTES)
+        SELECT 0, COUNT(*), IFNULL(SUM({}), 0) FROM ITEMS
+        """.format(ITEM_SIZE.format("ITEMS"))
+                )
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS ITEMS_USAGE_INSERT
+        AFTER INSERT ON ITEMS
+        BEGIN
+            UPDATE STORE_USAGE
+            SET ITEMS = ITEMS + 1, BYTES = BYTES + {};
+        END""".format(ITEM_SIZE.format("NEW"))
+                )
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS ITEMS_USAGE_DELETE
+        AFTER DELETE ON ITEMS
+        BEGIN
+            UPDATE STORE_USAGE
+            SET ITEMS = ITEMS - 1, BYTES = BYTES - {};
+        END""".format(ITEM_SIZE.format("OLD"))
+                )
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS ITEMS_USAGE_UPDATE
+        AFTER UPDATE OF VALUE ON ITEMS
+        BEGIN
+            UPDATE STORE_USAGE SET BYTES = BYTES + NEW.SIZE - OLD.SIZE;
+        END"""
+                )
+
+
+def _create_cas_sequence(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS CAS_SEQUENCE(
+            ID     INTEGER PRIMARY KEY CHECK (ID = 0),
+            VALUE  INTEGER NOT NULL
+        )"""
+                )
+    # Starts from the CAS values there are, like STORE_USAGE
+    con.execute("""
+        INSERT OR IGNORE INTO CAS_SEQUENCE (ID, VALUE)
+        SELECT 0, IFNULL(MAX(CAS), 0) FROM ITEMS"""
+                )
+    for event in ("INSERT", "UPDATE OF CAS"):
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS ITEMS_CAS_{}
+            AFTER {} ON ITEMS
+            BEGIN
+                UPDATE CAS_SEQUENCE SET VALUE = NEW.CAS
+                WHERE VALUE < NEW.CAS;
+            END""".format(event.split()[0], event)
+                    )
+    # The second version found the largest CAS value with this index, which
+    # nothing needs any more
+    con.execute("DROP INDEX IF EXISTS ITEMS_CAS")
+
+
+# The columns of ITEMS copied from KEY_VALUE_PAIRS, and what they are copied
+# from in a row of it named {0}
+MIGRATED_COLUMNS = "KEY, FLAGS, EXPIRES_AT, CAS, LAST_ACCESS, VALUE"
+MIGRATED_VALUES = "CAST({0}.KEY AS BLOB), {0}.FLAGS, {0}.EXPIRES_AT, " \
+    "{0}.CAS, {0}.LAST_ACCESS, {0}.VALUE"
+MIRROR_ROW = """
+    INSERT INTO ITEMS ({}) VALUES ({})
+    ON CONFLICT (KEY) DO UPDATE SET
+        FLAGS = excluded.FLAGS, EXPIRES_AT = excluded.EXPIRES_AT,
+        CAS = excluded.CAS, LAST_ACCESS = excluded.LAST_ACCESS,
+        VALUE = excluded.VALUE;
+""".format(MIGRATED_COLUMNS, MIGRATED_VALUES.format("NEW"))
+# Copies the legacy rows after a key, or from the first one, up to and
+# including a key. Rows already copied, or written since the copy started,
+# are left alone.
+COPY_ROWS = """
+    INSERT INTO ITEMS ({}) SELECT {} FROM KEY_VALUE_PAIRS AS LEGACY
+    WHERE {} KEY <= ?
+    ON CONFLICT (KEY) DO NOTHING
+""".format(MIGRATED_COLUMNS, MIGRATED_VALUES.format("LEGACY"), "{}")
+COPY_END = """
+    SELECT MAX(KEY) FROM (
+        SELECT KEY FROM KEY_VALUE_PAIRS WHERE {} 1 ORDER BY KEY LIMIT ?
+    )
+"""
+MIRROR_DELETE = "DELETE FROM ITEMS WHERE KEY = CAST(OLD.KEY AS BLOB);"
+# Triggers mirroring the writes made to the legacy table while it is copied,
+# and for as long as servers using the first schema keep running, by name:
+# (event, statement)
+MIRROR_TRIGGERS = {
+    "KEY_VALUE_PAIRS_MIRROR_INSERT": ("AFTER INSERT", MIRROR_ROW),
+    "KEY_VALUE_PAIRS_MIRROR_UPDATE": ("AFTER UPDATE", MIRROR_ROW),
+    "KEY_VALUE_PAIRS_MIRROR_DELETE": ("AFTER DELETE", MIRROR_DELETE),
+}
+
+
+def migrate_schema(db, batch_size=1000, progress=None):
+    """
+    Upgrades a database with the first version of the schema to the current
+    one, while servers keep using it.
+
+    ITEMS is created next to the legacy table and triggers on the latter
+    mirror every write made to it into ITEMS from then on. The legacy rows
+    are then copied over in key order, 'batch_size' of them per transaction,
+    so that servers only ever wait for one short transaction. Once all of
+    them have been copied, a last transaction hands STORE_USAGE over to
+    ITEMS and records the new version, which DataLayer requires.
+
+    The legacy table and the triggers mirroring it are kept, so that servers
+    still running on the first schema keep working until they are
+    restarted; drop_legacy_table removes them afterwards. A migration which
+    was interrupted can be run again. Later versions are upgraded by
+    create_schema, in a single short transaction.
+
+    :param db: name of the SQLite database file
+    :param batch_size: number of rows copied per transaction
+    :param progress: called with the number of rows copied so far after
+    every transaction, if given
+    :return: the number of rows copied, None if there was nothing to
+    migrate
+    """
+    check_sqlite_version()
     with closing(sqlite3.connect(db)) as con:
+        version = schema_version(con)
+        if LEGACY_VERSION < version < SCHEMA_VERSION:
+            create_schema(db)
+            return 0
+        if version != LEGACY_VERSION:
+            return None
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            _upgrade_legacy(con)
+            _create_items(con)
+            for name, (event, statement) in MIRROR_TRIGGERS.items():
+                con.execute("""
+                    CREATE TRIGGER IF NOT EXISTS {} {} ON KEY_VALUE_PAIRS
+                    BEGIN {} END""".format(name, event, statement)
+                            )
+
+        copied = 0
+        last = None
+        while True:
+            after = "" if last is None else "KEY > ? AND"
+            params = () if last is None else (last,)
+            with con:
+                con.execute("BEGIN IMMEDIATE")
+                end, = con.execute(
+                    COPY_END.format(after), params + (batch_size,)
+                ).fetchone()
+                if end is None:
+                    break
+                copied += con.execute(
+                    COPY_ROWS.format(after), params + (end,)
+                ).rowcount
+            last = end
+            if progress is not None:
+                progress(copied)
+
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            for event in ("INSERT", "DELETE", "UPDATE"):
+                con.execute(
+                    "DROP TRIGGER IF EXISTS KEY_VALUE_PAIRS_USAGE_" + event
+                )
+            con.execute("DROP TABLE IF EXISTS STORE_USAGE")
+            _create_usage(con)
+            _create_cas_sequence(con)
+            con.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        return copied
+
+
+def drop_legacy_table(db):
+    """
+    Drops the legacy table left by migrate_schema, along with the triggers
+    mirroring it. No server may be using the first schema any more.
+
+    :return: true if there was a legacy table to drop
+    """
+    with closing(sqlite3.connect(db)) as con:
+        if schema_version(con) != SCHEMA_VERSION:
+            return False
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            for name in MIRROR_TRIGGERS:
+                con.execute("DROP TRIGGER IF EXISTS " + name)
+            dropped = con.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'KEY_VALUE_PAIRS'"
+            ).fetchone() is not None
+            con.execute("DROP TABLE IF EXISTS KEY_VALUE_PAIRS")
+        return dropped
+
+
+def _upgrade_legacy(con):
+    """
+    Adds the columns the legacy table gained before it was replaced, which
+    the migration copies.
+    """
+    columns = {
+        row[1].upper()
+        for row in con.execute("PRAGMA table_info(KEY_VALUE_PAIRS)")
+    }
+    if "EXPIRES_AT" not in columns:
+        con.execute("""
+            ALTER TABLE KEY_VALUE_PAIRS
+            ADD COLUMN EXPIRES_AT INTEGER NOT NULL DEFAULT 0"""
+                    )
+    if "CAS" not in columns:
+        con.execute("""
+            ALTER TABLE KEY_VALUE_PAIRS
+            ADD COLUMN CAS INTEGER NOT NULL DEFAULT 0"""
+                    )
+        # Give the existing keys distinct CAS values
+        con.execute("UPDATE KEY_VALUE_PAIRS SET CAS = rowid")
+    if "LAST_ACCESS" not in columns:
         con.execute("""
-            CREATE TABLE KEY_VALUE_PAIRS(
-                KEY     TEXT PRIMARY KEY,
-                VALUE   BLOB,
-                FLAGS   INTEGER
-            )"""
+            ALTER TABLE KEY_VALUE_PAIRS
+            ADD COLUMN LAST_ACCESS INTEGER NOT NULL DEFAULT 0"""
                     )
+
+
+# Number of changes kept in the change log by default
+DEFAULT_LOG_RETENTION = 1000000
+
+
+def create_change_log(con, retention=DEFAULT_LOG_RETENTION):
+    """
+    Starts recording the keys written in ITEMS in CHANGE_LOG, for replicas
+    to follow (see replication.py).
+
+    Triggers on ITEMS append the key of every insert, delete and write of a
+    value, flags or expiration time to the log, whichever process makes it,
+    and drop the entries older than the last 'retention' ones, so the log
+    never grows beyond that. Recording accesses is not a change. The log
+    has an id of its own, so that replicas can tell a log they followed
+    from a new one with the same positions.
+
+    Running this again changes the retention of an existing log.
+
+    :param con: connection to a database with the current schema
+    :param retention: number of changes kept in the log
+    :return: nothing
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS CHANGE_LOG(
+            SEQ  INTEGER PRIMARY KEY AUTOINCREMENT,
+            KEY  BLOB NOT NULL
+        )"""
+                )
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS CHANGE_LOG_INFO(
+            ID         INTEGER PRIMARY KEY CHECK (ID = 0),
+            LOG_ID     TEXT NOT NULL,
+            RETENTION  INTEGER NOT NULL
+        )"""
+                )
+    con.execute("""
+        INSERT INTO CHANGE_LOG_INFO (ID, LOG_ID, RETENTION)
+        VALUES (0, LOWER(HEX(RANDOMBLOB(8))), ?)
+        ON CONFLICT (ID) DO UPDATE SET RETENTION = excluded.RETENTION
+        """, (retention,)
+                )
+    con.execute(
+        "DELETE FROM CHANGE_LOG WHERE SEQ <= "
+        "(SELECT MAX(SEQ) FROM CHANGE_LOG) - ?", (retention,)
+    )
+    # Within a trigger, last_insert_rowid() is the sequence number just
+    # logged
+    for name, event, row in [
+        ("ITEMS_LOG_INSERT", "INSERT", "NEW"),
+        ("ITEMS_LOG_UPDATE", "UPDATE OF VALUE, FLAGS, EXPIRES_AT", "NEW"),
+        ("ITEMS_LOG_DELETE", "DELETE", "OLD"),
+    ]:
+        con.execute("""
+            CREATE TRIGGER IF NOT EXISTS {} AFTER {} ON ITEMS
+            BEGIN
+                INSERT INTO CHANGE_LOG (KEY) VALUES ({}.KEY);
+                DELETE FROM CHANGE_LOG WHERE SEQ <= last_insert_rowid() -
+                    (SELECT RETENTION FROM CHANGE_LOG_INFO);
+            END""".format(name, event, row)
+                    )
+
+
+def create_replica_state(con):
+    """
+    Creates REPLICA_STATE, which records the change log a replica follows
+    and the position up to which it has applied it.
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS REPLICA_STATE(
+            ID        INTEGER PRIMARY KEY CHECK (ID = 0),
+            LOG_ID    TEXT,
+            POSITION  INTEGER
+        )"""
+                )
+    con.execute(
+        "INSERT OR IGNORE INTO REPLICA_STATE (ID) VALUES (0)"
+    )
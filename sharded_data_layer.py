@@ -0,0 +1,260 @@
+from data_layer import (
+    DataLayer, SCAN_VALUES, TUNING_FAST, encode_key, storage_flags
+)
+from operator import itemgetter
+from schema import create_schema
+from twisted.internet import defer
+import heapq
+import itertools
+import os
+import zlib
+
+
+def shard_files(db, num_shards):
+    """
+    :return: the names of the SQLite database files holding the data of a
+    database split into 'num_shards' shards. An unsharded database is kept
+    in the file 'db' itself.
+    """
+    if num_shards == 1:
+        return [db]
+    return ["{}.shard{}".format(db, i) for i in range(num_shards)]
+
+
+def shard_index(key, num_shards):
+    """
+    :return: the index of the shard 'key' belongs to. The hash is stable
+    across processes and Python versions.
+    """
+    return zlib.crc32(encode_key(key)) % num_shards
+
+
+class ShardedDataLayer:
+    """
+    Spreads keys over several data layers, each with its own database file,
+    so that writes to different shards do not wait for each other.
+
+    The shards may be synchronous DataLayers, in which case results are
+    returned directly, or asynchronous ones returning Deferreds, in which case
+    the combined results are returned as Deferreds as well.
+    """
+
+    def __init__(self, shards):
+        """
+            :param shards: the data layers of the shards, in shard order
+        """
+        self.shards = shards
+        self.READ_YOUR_WRITES = all(
+            getattr(shard, "READ_YOUR_WRITES", False) is True
+            for shard in shards
+        )
+
+    def shard(self, key):
+        return self.shards[shard_index(key, len(self.shards))]
+
+    def _partition(self, items, key=lambda item: item):
+        """
+        :return: a dictionary mapping the index of each shard to the list of
+        'items' belonging to it
+        """
+        parts = {}
+        for item in items:
+            index = shard_index(key(item), len(self.shards))
+            parts.setdefault(index, []).append(item)
+        return parts
+
+    @staticmethod
+    def _gather(results, combine):
+        """
+        Combines the results of calls to several shards with 'combine',
+        waiting for them first if any of them is a Deferred.
+        """
+        if not any(isinstance(r, defer.Deferred) for r in results):
+            return combine(results)
+
+        d = defer.gatherResults(
+            [defer.maybeDeferred(lambda r=r: r) for r in results],
+            consumeErrors=True
+        )
+        d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallback(combine)
+        return d
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def set_value(self, key, value, flags, exptime=0):
+        return self.shard(key).set_value(key, value, flags, exptime)
+
+    def add_value(self, key, value, flags, exptime=0):
+        return self.shard(key).add_value(key, value, flags, exptime)
+
+    def replace_value(self, key, value, flags, exptime=0):
+        return self.shard(key).replace_value(key, value, flags, exptime)
+
+    def cas_value(self, key, value, flags, exptime, cas):
+        return self.shard(key).cas_value(key, value, flags, exptime, cas)
+
+    def append_value(self, key, value):
+        return self.shard(key).append_value(key, value)
+
+    def prepend_value(self, key, value):
+        return self.shard(key).prepend_value(key, value)
+
+    def incr_value(self, key, delta):
+        return self.shard(key).incr_value(key, delta)
+
+    def touch_value(self, key, exptime):
+        return self.shard(key).touch_value(key, exptime)
+
+    def apply_batch(self, writes):
+        # Each shard commits its part of the batch in its own transaction
+        parts = self._partition(writes, key=lambda write: write[0])
+        results = [
+            self.shards[index].apply_batch(part)
+            for index, part in parts.items()
+        ]
+
+        def combine(results):
+            existed = {}
+            for result in results:
+                existed.update(result)
+            return existed
+
+        return self._gather(results, combine)
+
+    def load(self, writes):
+        parts = self._partition(writes, key=lambda write: write[0])
+        return self._gather(
+            [self.shards[index].load(part) for index, part in parts.items()],
+            sum
+        )
+
+    def get_values(self, keys, with_cas=False):
+        results = [
+            self.shards[index].get_values(part, with_cas)
+            for index, part in self._partition(keys).items()
+        ]
+        return self._gather(
+            results, lambda results: list(itertools.chain(*results))
+        )
+
+    def get_all_values(self):
+        results = [shard.get_all_values() for shard in self.shards]
+        return self._gather(results, itertools.chain.from_iterable)
+
+    def scan(self, start=None, end=None, after=None, limit=None,
+             fields=SCAN_VALUES):
+        """
+        Merges the scans of all shards into a single one in key order. Only
+        supported by synchronous shards.
+        """
+        scans = [
+            shard.scan(start, end, after, limit, fields)
+            for shard in self.shards
+        ]
+        return itertools.islice(
+            heapq.merge(*scans, key=itemgetter("key")), limit
+        )
+
+    def delete_value(self, key):
+        return self.shard(key).delete_value(key)
+
+    def delete_expired(self, limit):
+        results = [shard.delete_expired(limit) for shard in self.shards]
+        return self._gather(results, sum)
+
+    def note_accesses(self, keys):
+        for index, part in self._partition(keys).items():
+            self.shards[index].note_accesses(part)
+
+    def record_accesses(self):
+        results = [shard.record_accesses() for shard in self.shards]
+        return self._gather(results, sum)
+
+    @staticmethod
+    def _add_counts(results):
+        total = {}
+        for result in results:
+            for name, count in result.items():
+                total[name] = total.get(name, 0) + count
+        return total
+
+    def usage(self):
+        results = [shard.usage() for shard in self.shards]
+        return self._gather(results, self._add_counts)
+
+    def evict(self, max_items=None, max_bytes=None, limit=500):
+        """
+        Keeps every shard within its share of the limits. Keys are spread
+        evenly over the shards, so together they stay close to the limits.
+        """
+        def share(total):
+            if not total:
+                return total
+            return max(total // len(self.shards), 1)
+
+        results = [
+            shard.evict(share(max_items), share(max_bytes), limit)
+            for shard in self.shards
+        ]
+        return self._gather(results, self._add_counts)
+
+
+def reshard(db, old_shards, new_shards, batch_size=1000):
+    """
+    Moves all data of a database from 'old_shards' shard files into
+    'new_shards' shard files. The server must not be running.
+
+    The new shards are written next to the old ones under temporary names
+    and only replace them once all data has been copied, so a run interrupted
+    while copying leaves the old shards untouched. Expired items are not
+    copied.
+
+    :param db: name of the SQLite database
+    :param old_shards: number of shards the data is currently split into
+    :param new_shards: number of shards to split the data into
+    :param batch_size: number of items written per transaction
+    :return: the number of items copied
+    """
+    old_files = shard_files(db, old_shards)
+    new_files = shard_files(db, new_shards)
+    temp_files = [name + ".resharding" for name in new_files]
+    for name in temp_files:
+        _remove_database(name)
+        create_schema(name)
+
+    source = ShardedDataLayer([DataLayer(name) for name in old_files])
+    target = ShardedDataLayer(
+        [DataLayer(name, TUNING_FAST) for name in temp_files]
+    )
+    copied = 0
+    try:
+        rows = source.get_all_values()
+        while True:
+            batch = [
+                (row["key"],
+                 (row["value"], storage_flags(row), row["expires_at"]))
+                for row in itertools.islice(rows, batch_size)
+            ]
+            if not batch:
+                break
+            target.apply_batch(batch)
+            copied += len(batch)
+    finally:
+        source.close()
+        target.close()
+
+    for temp_name, name in zip(temp_files, new_files):
+        _remove_database(name)
+        os.replace(temp_name, name)
+    for name in set(old_files) - set(new_files):
+        _remove_database(name)
+    return copied
+
+
+def _remove_database(name):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(name + suffix):
+            os.remove(name + suffix)
@@ -0,0 +1,172 @@
+import os
+import time
+
+
+class Histogram:
+    """
+    Latency histogram with a fixed set of preallocated buckets, so that
+    recording a sample is a little arithmetic and a list increment.
+
+    Samples are bucketed by microseconds on a log-linear scale: each power of
+    two is split into SUB_BUCKETS buckets, which bounds the error of reported
+    percentiles to 1/SUB_BUCKETS of the value.
+    """
+
+    SUB_BUCKET_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    # Samples of 2**MAX_BITS microseconds (about 18 minutes) or more all go
+    # in the last bucket
+    MAX_BITS = 30
+
+    def __init__(self):
+        num_buckets = (self.MAX_BITS - self.SUB_BUCKET_BITS + 1) * \
+            self.SUB_BUCKETS
+        self.counts = [0] * num_buckets
+        self.count = 0
+        self.total = 0.0
+
+    @classmethod
+    def bucket(cls, micros):
+        """
+        :return: the index of the bucket holding a sample of 'micros'
+        """
+        if micros < cls.SUB_BUCKETS:
+            return micros
+        exponent = micros.bit_length() - 1
+        if exponent >= cls.MAX_BITS:
+            return (cls.MAX_BITS - cls.SUB_BUCKET_BITS + 1) * \
+                cls.SUB_BUCKETS - 1
+        shift = exponent - cls.SUB_BUCKET_BITS
+        return (shift + 1) * cls.SUB_BUCKETS + \
+            (micros >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def bucket_limit(cls, index):
+        """
+        :return: the largest number of microseconds held by bucket 'index'
+        """
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        mantissa = index % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        self.counts[self.bucket(int(seconds * 1000000))] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, fraction):
+        """
+        :return: the upper bound in microseconds of the bucket holding the
+        sample below which 'fraction' of all samples lie, 0 if there are none
+        """
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bucket_limit(index)
+        return self.bucket_limit(len(self.counts) - 1)
+
+    def summary(self):
+        """
+        :return: a list of (name, value) pairs describing the histogram
+        """
+        mean = self.total / self.count * 1000000 if self.count else 0
+        return [
+            ("count", self.count),
+            ("mean_us", int(mean)),
+            ("p50_us", self.percentile(0.5)),
+            ("p99_us", self.percentile(0.99)),
+            ("p999_us", self.percentile(0.999)),
+        ]
+
+
+class Stats:
+    """
+    Server-wide counters and latency histograms, shared by all connections.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = dict.fromkeys([
+            "curr_connections", "total_connections",
+            "cmd_get", "cmd_set", "cmd_delete", "cmd_touch",
+            "get_hits", "get_misses", "delete_hits", "delete_misses",
+            "incr_hits", "incr_misses", "decr_hits", "decr_misses",
+            "touch_hits", "touch_misses",
+            "cas_hits", "cas_badval", "cas_misses",
+            "bytes_read", "bytes_written", "response_pauses",
+        ], 0)
+        self.commands = {}
+        self.operations = {}
+        # Functions returning further (name, value) pairs for 'stats'
+        self.sources = []
+        # Tracker the receivers give the keys of their requests to, None
+        # while no keys are tracked
+        self.key_tracker = None
+
+    def incr(self, name, amount=1):
+        self.counters[name] += amount
+
+    def add_source(self, prefix, source):
+        """
+        Adds the counters returned by 'source', a function returning a
+        dictionary, to the 'stats' report with their names prefixed by
+        'prefix'.
+        """
+        self.sources.append((prefix, source))
+
+    @staticmethod
+    def _record(histograms, name, seconds):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    def record_command(self, name, seconds):
+        self._record(self.commands, name, seconds)
+
+    def record_operation(self, name, seconds):
+        self._record(self.operations, name, seconds)
+
+    def general(self):
+        """
+        :return: the (name, value) pairs of the general 'stats' report
+        """
+        now = time.time()
+        report = [
+            ("pid", os.getpid()),
+            ("uptime", int(now - self.started)),
+            ("time", int(now)),
+        ]
+        report.extend(self.counters.items())
+        for prefix, source in self.sources:
+            report.extend(
+                (prefix + name, value) for name, value in source().items()
+            )
+        return report
+
+    @staticmethod
+    def _histograms(histograms):
+        return [
+            ("{}:{}".format(name, field), value)
+            for name, histogram in sorted(histograms.items())
+            for field, value in histogram.summary()
+        ]
+
+    def latency(self):
+        """
+        :return: the (name, value) pairs of the per-command latencies
+        """
+        return self._histograms(self.commands)
+
+    def data_layer(self):
+        """
+        :return: the (name, value) pairs of the per data layer operation
+        latencies
+        """
+        return self._histograms(self.operations)
@@ -0,0 +1,55 @@
+import tempfile
+import threading
+from async_data_layer import AsyncDataLayer
+from data_layer import DataLayer
+from schema import create_schema
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+
+class AsyncDataLayerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile()
+        create_schema(self.file.name)
+        self.data_layer = DataLayer(self.file.name, pool_size=3)
+        self.async_data_layer = AsyncDataLayer(
+            self.data_layer, read_threads=2, reactor=reactor
+        )
+        self.async_data_layer.start()
+
+    def tearDown(self):
+        self.async_data_layer.stop()
+        self.data_layer.close()
+        self.file.close()
+
+    @defer.inlineCallbacks
+    def test_set_get_and_delete(self):
+        yield self.async_data_layer.set_value("foo", b"bar", 3)
+        values = yield self.async_data_layer.get_values(["foo", "baz"])
+        self.assertEqual(values, [
+            {"key": "foo", "value": b"bar", "flags": 3, "expires_at": 0}
+        ])
+
+        deleted = yield self.async_data_layer.delete_value("foo")
+        self.assertTrue(deleted)
+        values = yield self.async_data_layer.get_all_values()
+        self.assertEqual(values, [])
+
+    @defer.inlineCallbacks
+    def test_writes_run_on_a_single_thread_in_order(self):
+        threads = set()
+        set_value = self.data_layer.set_value
+
+        def recording_set_value(*args):
+            threads.add(threading.current_thread())
+            set_value(*args)
+
+        self.data_layer.set_value = recording_set_value
+        yield defer.gatherResults([
+            self.async_data_layer.set_value("foo", b"%d" % i, i)
+            for i in range(20)
+        ])
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.current_thread(), threads)
+        values = yield self.async_data_layer.get_values(["foo"])
+        self.assertEqual(values[0]["flags"], 19)
@@ -0,0 +1,62 @@
+from asyncio_receiver import AsyncioMemcacheFactory
+from test import test_memcache_receiver
+from twisted.test import proto_helpers
+from unittest import mock
+
+
+class AsyncioTransport(proto_helpers.StringTransport):
+    """
+    StringTransport with the methods of an asyncio transport.
+    """
+
+    def writelines(self, data):
+        self.writeSequence(data)
+
+    def close(self):
+        self.loseConnection()
+
+    def is_closing(self):
+        return self.disconnecting
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.high_water = high
+
+    def pause_reading(self):
+        self.pauseProducing()
+
+    def resume_reading(self):
+        self.resumeProducing()
+
+
+class AsyncioMemcacheReceiverTestCase(
+        test_memcache_receiver.MemcacheReceiverTestCase):
+    """
+    Runs the tests of the Twisted backend against the asyncio one.
+    """
+
+    def setUp(self):
+        self.data_layer = mock.Mock()
+        self.proto = AsyncioMemcacheFactory(self.data_layer)()
+        self.proto.dataReceived = self.proto.data_received
+        self.tr = AsyncioTransport()
+        self.proto.connection_made(self.tr)
+
+    def test_too_large_payload_is_not_buffered(self):
+        self.proto.max_item_size = 10
+        self.data_layer.delete_value.return_value = True
+        self.proto.dataReceived(b"set foo 0 0 1000\r\n" + b"x" * 500)
+        self.assertEqual(self.proto.received, b"")
+        self.proto.dataReceived(b"x" * 500 + b"\r\ndelete foo\r\n")
+        self.assertEqual(
+            self.tr.value(),
+            b"SERVER_ERROR object too large for cache\r\nDELETED\r\n"
+        )
+
+    def test_transport_pauses_responses(self):
+        self.assertEqual(self.tr.high_water, self.proto.high_water)
+        self.proto.pause_writing()
+        self.assertTrue(self.proto.responses_paused)
+        self.assertEqual(self.tr.producerState, "paused")
+        self.proto.resume_writing()
+        self.assertFalse(self.proto.responses_paused)
+        self.assertEqual(self.tr.producerState, "producing")
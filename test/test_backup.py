@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from backup import Snapshotter, restore, snapshot
+from contextlib import closing
+from data_layer import DataLayer
+from memcache_receiver import AdminError
+from schema import SchemaVersionError, create_schema
+from twisted.internet import defer
+from unittest import mock
+
+
+class BackupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = self.path("live.db")
+        create_schema(self.db)
+        self.data_layer = DataLayer(self.db)
+        self.data_layer.load(
+            ("k%04d" % i, (os.urandom(1000), 0, 0)) for i in range(500)
+        )
+
+    def tearDown(self):
+        self.data_layer.close()
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def count(self, db):
+        with closing(sqlite3.connect(db)) as con:
+            return con.execute("SELECT COUNT(*) FROM ITEMS").fetchone()[0]
+
+    def test_snapshot_is_the_database_as_of_its_start(self):
+        steps = []
+
+        def progress(copied, total):
+            steps.append(copied)
+            # Writes made during the copy neither restart nor join it
+            self.data_layer.set_value("new%d" % len(steps), b"v", 0)
+
+        target = self.path("snap.db")
+        pages = snapshot(self.db, target, step_pages=20, step_pause=0,
+                         progress=progress)
+        self.assertEqual(steps, sorted(steps))
+        self.assertEqual(steps[-1], pages)
+        self.assertGreater(len(steps), 10)
+        self.assertEqual(self.count(target), 500)
+        self.assertEqual(self.count(self.db), 500 + len(steps))
+        self.assertFalse(os.path.exists(target + ".partial"))
+        self.assertFalse(os.path.exists(target + "-wal"))
+
+    def test_restore(self):
+        self.data_layer.enable_change_log()
+        log_id, _ = self.data_layer.log_position()
+        target = self.path("snap.db")
+        snapshot(self.db, target)
+        restored = self.path("restored.db")
+        restore(target, restored)
+        with self.assertRaises(FileExistsError):
+            restore(target, restored)
+        restore(target, restored, force=True)
+
+        data_layer = DataLayer(restored)
+        try:
+            self.assertEqual(data_layer.usage()["items"], 500)
+            self.assertEqual(
+                data_layer.get_values(["k0001"]),
+                self.data_layer.get_values(["k0001"])
+            )
+            # Replicas of the original database don't take the restored
+            # one for it
+            self.assertNotEqual(data_layer.log_position()[0], log_id)
+        finally:
+            data_layer.close()
+
+    def test_restore_checks_the_snapshot(self):
+        empty = self.path("empty.db")
+        sqlite3.connect(empty).close()
+        with self.assertRaises(SchemaVersionError):
+            restore(empty, self.path("restored.db"))
+        garbage = self.path("garbage.db")
+        with open(garbage, "wb") as f:
+            f.write(b"x" * 4096)
+        with self.assertRaises(sqlite3.DatabaseError):
+            restore(garbage, self.path("restored.db"))
+        self.assertFalse(os.path.exists(self.path("restored.db")))
+
+    @mock.patch(
+        "backup.threads.deferToThread",
+        side_effect=lambda f: defer.maybeDeferred(f)
+    )
+    def test_snapshotter(self, deferToThread):
+        snapshotter = Snapshotter(
+            [(self.db, ".shard0")], self.dir.name, step_pause=0
+        )
+        results = []
+        snapshotter.command(["backup"]).addCallback(results.append)
+        self.assertEqual(results, [[b"OK"]])
+        self.assertEqual(self.count(self.path("backup.shard0")), 500)
+        self.assertEqual(snapshotter.stats()["completed"], 1)
+        self.assertEqual(snapshotter.stats()["in_progress"], 0)
+        for args in ([], ["../escape"], [".hidden"], ["a", "b"]):
+            with self.assertRaises(AdminError):
+                snapshotter.command(args)
+
+        snapshotter.running = True
+        failures = []
+        snapshotter.command(["again"]).addErrback(failures.append)
+        failures[0].trap(AdminError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import tempfile
+import unittest
+from collections import Counter
+from bench import (
+    CMD_GET, CMD_SET, LoadClientFactory, LoadRun, Workload, bench_data_layer,
+    compare, preload
+)
+from data_layer import DataLayer
+from schema import create_schema
+from twisted.test import proto_helpers
+
+
+class WorkloadTestCase(unittest.TestCase):
+    def test_zipfian_popularity(self):
+        workload = Workload(keys=100, zipf=1.0, seed=1)
+        counts = Counter(workload.key() for _ in range(10000))
+        self.assertEqual(counts.most_common(1)[0][0], "key:0")
+        self.assertGreater(counts["key:0"], 10 * counts["key:50"])
+
+    def test_uniform_popularity(self):
+        workload = Workload(keys=10, zipf=0, seed=1)
+        counts = Counter(workload.key() for _ in range(10000))
+        self.assertEqual(len(counts), 10)
+        self.assertLess(max(counts.values()), 2 * min(counts.values()))
+
+    def test_requests(self):
+        workload = Workload(
+            keys=10, read_ratio=0.75, value_size=(5, 20), seed=1
+        )
+        requests = [workload.request() for _ in range(4000)]
+        gets = [r for r in requests if r[0] == CMD_GET]
+        sets = [r for r in requests if r[0] == CMD_SET]
+        self.assertAlmostEqual(len(gets) / len(requests), 0.75, delta=0.03)
+        self.assertTrue(all(value is None for _, _, value in gets))
+        self.assertTrue(all(5 <= len(value) <= 20 for _, _, value in sets))
+
+    def test_same_seed_same_requests(self):
+        self.assertEqual(
+            [Workload(seed=7).key() for _ in range(10)],
+            [Workload(seed=7).key() for _ in range(10)]
+        )
+
+
+class LoadRunTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = proto_helpers.MemoryReactorClock()
+        self.run = LoadRun(
+            Workload(keys=10, read_ratio=0.5, value_size=(3, 3), seed=1),
+            connections=1, pipeline=2, duration=1.0, reactor=self.reactor
+        )
+        self.run.started = 0
+        self.client = self.connect()
+
+    def connect(self):
+        client = LoadClientFactory(self.run).buildProtocol(None)
+        self.tr = proto_helpers.StringTransport()
+        client.makeConnection(self.tr)
+        return client
+
+    def respond(self, data):
+        sent = self.tr.value()
+        self.tr.clear()
+        self.client.dataReceived(data)
+        return sent
+
+    def test_keeps_pipeline_full(self):
+        self.assertEqual(len(self.client.in_flight), 2)
+        commands = [command for command, _ in self.client.in_flight]
+        responses = {
+            CMD_GET: b"VALUE key:0 0 3\r\nabc\r\nEND\r\n",
+            CMD_SET: b"STORED\r\n",
+        }
+        self.respond(b"".join(responses[c] for c in commands))
+        self.assertEqual(len(self.client.in_flight), 2)
+        self.assertEqual(self.run.histograms["all"].count, 2)
+        self.assertEqual(self.run.hits, commands.count(CMD_GET))
+        self.assertEqual(self.run.errors, 0)
+
+    def test_unexpected_responses_are_errors(self):
+        self.respond(b"SERVER_ERROR disk full\r\n")
+        self.assertEqual(self.run.errors, 1)
+        self.assertEqual(self.run.histograms["all"].count, 0)
+
+    def test_stops_after_duration(self):
+        results = []
+        self.run.start("127.0.0.1", 11211).addCallback(results.append)
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.reactor.advance(1.0)
+        self.assertEqual(results[0]["operations"], 0)
+        self.assertTrue(self.run.finished)
+        self.assertTrue(self.tr.disconnecting)
+
+
+class BenchDataLayerTestCase(unittest.TestCase):
+    def test_reports_every_operation(self):
+        with tempfile.NamedTemporaryFile() as file:
+            create_schema(file.name)
+            data_layer = DataLayer(file.name)
+            workload = Workload(keys=50, seed=1)
+            preload(data_layer, workload)
+            self.assertEqual(len(list(data_layer.get_all_values())), 50)
+            results = bench_data_layer(
+                data_layer, workload, operations=20, batch_size=10
+            )
+            data_layer.close()
+        self.assertEqual(set(results), {
+            "set_value", "get_values", "get_values_batch", "apply_batch",
+            "delete_value",
+        })
+        self.assertEqual(results["set_value"]["latency"]["count"], 20)
+        self.assertEqual(results["apply_batch"]["latency"]["count"], 2)
+        self.assertEqual(results["apply_batch"]["keys_per_call"], 10)
+
+
+class CompareTestCase(unittest.TestCase):
+    def test_compare(self):
+        def results(ops, p99):
+            return {
+                "server": {
+                    "ops_per_sec": ops, "latency": {"get": {"p99_us": p99}}
+                },
+                "data_layer": {"set_value": {"calls_per_sec": ops}},
+            }
+        self.assertEqual(compare(results(100, 50), results(150, 40)), [
+            "server ops_per_sec: 100 -> 150 (+50.0%)",
+            "server get p99_us: 50 -> 40 (-20.0%)",
+            "set_value calls_per_sec: 100 -> 150 (+50.0%)",
+        ])
@@ -0,0 +1,92 @@
+import io
+import tempfile
+import unittest
+from bulk import FORMAT_MEMCACHED, export_items, import_items, \
+    read_memcached, read_records
+from data_layer import DataLayer
+from schema import create_schema
+
+
+def reader(data):
+    return io.BufferedReader(io.BytesIO(data))
+
+
+class BulkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile()
+        create_schema(self.file.name)
+        self.data_layer = DataLayer(self.file.name)
+
+    def tearDown(self):
+        self.data_layer.close()
+        self.file.close()
+
+    def export(self, fmt="compact"):
+        out = io.BytesIO()
+        count = export_items(self.data_layer, out, fmt)
+        return count, out.getvalue()
+
+    def test_compact_round_trip(self):
+        self.data_layer.set_value("foo", b"\r\n\x00\xff", 2 ** 40, 3600)
+        self.data_layer.set_value("bar", b"", 0)
+        count, data = self.export()
+        self.assertEqual(count, 2)
+        rows = list(self.data_layer.get_all_values())
+
+        self.data_layer.delete_value("foo")
+        self.data_layer.delete_value("bar")
+        self.assertEqual(import_items(self.data_layer, reader(data), 1), 2)
+        self.assertCountEqual(list(self.data_layer.get_all_values()), rows)
+
+    def test_memcached_round_trip(self):
+        self.data_layer.set_value("foo", b"bar", 3, 3600)
+        count, data = self.export(FORMAT_MEMCACHED)
+        self.assertEqual(data.split(b"\r\n")[1:], [b"bar", b""])
+        records = list(read_records(reader(data)))
+        self.assertEqual(
+            records, [("foo", (b"bar", 3, records[0][1][2]))]
+        )
+        self.assertEqual(
+            [row["expires_at"] for row in self.data_layer.get_all_values()],
+            [records[0][1][2]]
+        )
+
+    def test_memcached_transcript(self):
+        transcript = (
+            b"set foo 1 60 3\r\nbar\r\n"
+            b"get foo\r\n"
+            b"set baz 0 0 2 noreply\r\nhi\r\n"
+            b"delete foo\r\n"
+        )
+        self.assertEqual(list(read_memcached(reader(transcript), 1000)), [
+            ("foo", (b"bar", 1, 1060)),
+            ("baz", (b"hi", 0, 0)),
+            ("foo", None),
+        ])
+        import_items(self.data_layer, reader(transcript))
+        self.assertEqual(
+            [row["key"] for row in self.data_layer.get_all_values()], ["baz"]
+        )
+
+    def test_memcached_transcript_skips_other_storage_commands(self):
+        # Their data blocks are not read as commands
+        transcript = (
+            b"set foo 0 0 3\r\nbar\r\n"
+            b"add x 0 0 10\r\ndelete foo\r\n"
+            b"cas y 0 0 13 5 noreply\r\nset z 0 0 1\r\n\r\n"
+            b"append foo 0 0 2\r\nhi\r\n"
+        )
+        self.assertEqual(list(read_memcached(reader(transcript), 1000)), [
+            ("foo", (b"bar", 0, 0)),
+        ])
+        self.assertRaises(
+            ValueError, list, read_memcached(reader(b"add x 0 0\r\n"))
+        )
+
+    def test_bad_input(self):
+        self.assertRaises(
+            ValueError, list, read_records(reader(b"set foo 0 0 5\r\nab\r\n"))
+        )
+        self.data_layer.set_value("foo", b"bar", 0)
+        _, data = self.export()
+        self.assertRaises(ValueError, list, read_records(reader(data[:-1])))
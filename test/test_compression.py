@@ -0,0 +1,41 @@
+import os
+import unittest
+import zlib
+from compression import Compressor, decompress_row
+
+
+class CompressorTestCase(unittest.TestCase):
+    def test_small_values_are_not_compressed(self):
+        compressor = Compressor(threshold=100)
+        self.assertEqual(compressor.compress(b"a" * 99), (b"a" * 99, False))
+        self.assertEqual(compressor.stats()["values"], 0)
+
+    def test_disabled(self):
+        self.assertEqual(Compressor().compress(b"a" * 1000)[1], False)
+
+    def test_compress(self):
+        compressor = Compressor(threshold=100)
+        value, compressed = compressor.compress(bytearray(b"a" * 1000))
+        self.assertTrue(compressed)
+        self.assertEqual(zlib.decompress(value), b"a" * 1000)
+        self.assertEqual(compressor.decompress(value), b"a" * 1000)
+        stats = compressor.stats()
+        self.assertEqual(stats["values"], 1)
+        self.assertEqual(stats["bytes_in"], 1000)
+        self.assertEqual(stats["ratio"], round(1000 / len(value), 3))
+        self.assertEqual(stats["decompressed"], 1)
+
+    def test_incompressible_values_are_stored_as_they_are(self):
+        compressor = Compressor(threshold=100)
+        value = os.urandom(1000)
+        self.assertEqual(compressor.compress(value), (value, False))
+        self.assertEqual(compressor.stats()["incompressible"], 1)
+
+    def test_decompress_row(self):
+        row = {"key": "foo", "value": zlib.compress(b"bar"), "flags": 1,
+               "compressed": True}
+        self.assertEqual(
+            decompress_row(row), {"key": "foo", "value": b"bar", "flags": 1}
+        )
+        plain = {"key": "foo", "value": b"bar"}
+        self.assertIs(decompress_row(plain), plain)
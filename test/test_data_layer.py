@@ -1,8 +1,15 @@
 import sqlite3
 import tempfile
+import time
 import unittest
+import zlib
 from contextlib import closing
-from data_layer import DataLayer
+from data_layer import DataLayer, TUNING_FAST, tuning_pragmas, \
+    expires_at, MAX_RELATIVE_EXPTIME, NEVER_EXPIRES, SCAN_KEYS, \
+    SCAN_METADATA, prefix_range, COMPRESSED_FLAG, MAX_COUNTER, \
+    NonNumericValue, incremented, ACCESS_RESOLUTION, encode_key, \
+    decode_key
+from compression import Compressor
 from schema import create_schema
 
 
@@ -22,10 +29,11 @@ class TestDataLayer(unittest.TestCase):
         self.data_layer = DataLayer(self.db_name)
 
     def tearDown(self):
+        self.data_layer.close()
         # Resets the database for each test
         with closing(sqlite3.connect(self.db_name)) as con:
             with con:
-                con.execute("DELETE FROM KEY_VALUE_PAIRS")
+                con.execute("DELETE FROM ITEMS")
 
     def test_set_ascii_data(self):
         key = "greeting"
@@ -34,7 +42,9 @@ class TestDataLayer(unittest.TestCase):
         self.data_layer.set_value(key, value, flags)
         all_values = list(self.data_layer.get_all_values())
         self.assertEqual(
-            all_values, [{"key": key, "value": value, "flags": flags}]
+            all_values, [{
+                "key": key, "value": value, "flags": flags, "expires_at": 0
+            }]
         )
 
     def test_set_binary_data(self):
@@ -45,7 +55,9 @@ class TestDataLayer(unittest.TestCase):
         self.data_layer.set_value(key, data, flags)
         all_values = list(self.data_layer.get_all_values())
         self.assertEqual(
-            all_values, [{"key": key, "value": data, "flags": flags}]
+            all_values, [{
+                "key": key, "value": data, "flags": flags, "expires_at": 0
+            }]
         )
 
     def test_set_data_override(self):
@@ -56,7 +68,10 @@ class TestDataLayer(unittest.TestCase):
         self.data_layer.set_value(key, new_value, new_flags)
         all_values = list(self.data_layer.get_all_values())
         self.assertEqual(
-            all_values, [{"key": key, "value": new_value, "flags": new_flags}]
+            all_values, [{
+                "key": key, "value": new_value, "flags": new_flags,
+                "expires_at": 0
+            }]
         )
 
     def test_get_one_value_that_exists(self):
@@ -66,7 +81,9 @@ class TestDataLayer(unittest.TestCase):
         self.data_layer.set_value(key, value, flags)
         values = list(self.data_layer.get_values((key,)))
         self.assertEqual(
-            values, [{"key": key, "value": value, "flags": flags}]
+            values, [{
+                "key": key, "value": value, "flags": flags, "expires_at": 0
+            }]
         )
 
     def test_get_one_value_that_does_not_exist(self):
@@ -93,6 +110,29 @@ class TestDataLayer(unittest.TestCase):
         values = list(self.data_layer.get_values(keys))
         self.assertListEqual(expected_values, values)
 
+    def test_get_many_values(self):
+        num_keys = DataLayer.MAX_KEYS_PER_QUERY * 4 + 3
+        self.data_layer.apply_batch(
+            ("key%d" % i, (b"val%d" % i, i, 0)) for i in range(num_keys)
+        )
+        keys = ["key%d" % i for i in range(0, num_keys * 2, 2)]
+        values = self.data_layer.get_values(keys + keys[:10])
+        self.assertEqual(
+            sorted(v["flags"] for v in values), list(range(0, num_keys, 2))
+        )
+
+    def test_set_large_value(self):
+        data_layer = DataLayer(self.db_name)
+        try:
+            value = bytearray(range(256)) * 1000
+            data_layer.set_value("large", value, 1)
+            data_layer.set_value("large", value[::-1], 2)
+            values = data_layer.get_values(["large"])
+            self.assertEqual(values[0]["value"], value[::-1])
+            self.assertEqual(values[0]["flags"], 2)
+        finally:
+            data_layer.close()
+
     def test_get_all_values(self):
         expected_values = self.insert_records(10)
         all_values = list(self.data_layer.get_all_values())
@@ -106,7 +146,7 @@ class TestDataLayer(unittest.TestCase):
             flags = i * 3
             self.data_layer.set_value(key, value, flags)
             expected_values.append(
-                {"key": key, "value": value, "flags": flags}
+                {"key": key, "value": value, "flags": flags, "expires_at": 0}
             )
         return expected_values
 
@@ -125,6 +165,346 @@ class TestDataLayer(unittest.TestCase):
         all_values = list(self.data_layer.get_all_values())
         self.assertListEqual(expected_values, all_values)
 
+    def test_expired_values_are_not_returned(self):
+        now = int(time.time())
+        self.data_layer.set_value("old", b"1", 0, now - 1)
+        self.data_layer.set_value("new", b"2", 0, 3600)
+        self.data_layer.set_value("gone", b"3", 0, -1)
+        values = list(self.data_layer.get_values(["old", "new", "gone"]))
+        self.assertEqual([v["key"] for v in values], ["new"])
+        self.assertGreaterEqual(values[0]["expires_at"], now + 3600)
+        all_values = list(self.data_layer.get_all_values())
+        self.assertEqual([v["key"] for v in all_values], ["new"])
+        self.assertFalse(self.data_layer.delete_value("old"))
+
+    def test_delete_expired(self):
+        now = int(time.time())
+        for i in range(5):
+            self.data_layer.set_value("key%d" % i, b"", 0, now - i - 1)
+        self.data_layer.set_value("forever", b"", 0)
+        self.assertEqual(self.data_layer.delete_expired(3), 3)
+        self.assertEqual(self.data_layer.delete_expired(3), 2)
+        self.assertEqual(self.data_layer.delete_expired(3), 0)
+        with closing(sqlite3.connect(self.db_name)) as con:
+            count = con.execute("SELECT COUNT(*) FROM ITEMS")
+            self.assertEqual(count.fetchone()[0], 1)
+
+    def test_load(self):
+        self.insert_records(2)
+        self.assertEqual(self.data_layer.load([
+            ("key0", None),
+            ("new", (b"1", 1, 0)),
+            ("key1", (b"old", 1, 0)),
+            ("key1", (b"new", 2, 0)),
+        ]), 3)
+        self.assertEqual(
+            [(row["key"], row["value"], row["flags"])
+             for row in self.data_layer.scan()],
+            [("key1", b"new", 2), ("new", b"1", 1)]
+        )
+
+    def test_compressed_values(self):
+        data_layer = DataLayer(
+            self.db_name, compressor=Compressor(threshold=10)
+        )
+        try:
+            data_layer.set_value("big", b"a" * 100, 7)
+            data_layer.set_value("small", b"a", 7)
+            big, small = data_layer.get_values(["big", "small"])
+        finally:
+            data_layer.close()
+        self.assertEqual(big["flags"], 7)
+        self.assertTrue(big["compressed"])
+        self.assertEqual(zlib.decompress(big["value"]), b"a" * 100)
+        self.assertNotIn("compressed", small)
+        with closing(sqlite3.connect(self.db_name)) as con:
+            flags = con.execute(
+                "SELECT FLAGS FROM ITEMS WHERE KEY = CAST('big' AS BLOB)"
+            ).fetchone()[0]
+        self.assertEqual(flags, 7 | COMPRESSED_FLAG)
+        row, = self.data_layer.scan(start="big", end="big0")
+        self.assertEqual((row["flags"], row["compressed"]), (7, True))
+
+    def values(self, *keys):
+        return {
+            row["key"]: row["value"]
+            for row in self.data_layer.get_values(list(keys))
+        }
+
+    def test_add_and_replace(self):
+        self.data_layer.set_value("expired", b"old", 0, -1)
+        self.assertTrue(self.data_layer.add_value("new", b"1", 1))
+        self.assertFalse(self.data_layer.add_value("new", b"2", 2))
+        self.assertTrue(self.data_layer.add_value("expired", b"3", 3))
+        self.assertFalse(self.data_layer.replace_value("missing", b"4", 4))
+        self.assertTrue(self.data_layer.replace_value("new", b"5", 5))
+        self.assertEqual(
+            self.values("new", "expired", "missing"),
+            {"new": b"5", "expired": b"3"}
+        )
+
+    def test_append_and_prepend(self):
+        self.data_layer.set_value("foo", b"\x00\xff", 7, 3600)
+        self.assertTrue(self.data_layer.append_value("foo", b"\xfe\x00"))
+        self.assertTrue(self.data_layer.prepend_value("foo", b"ab"))
+        self.assertFalse(self.data_layer.append_value("missing", b"x"))
+        row, = self.data_layer.get_values(["foo"])
+        self.assertEqual(row["value"], b"ab\x00\xff\xfe\x00")
+        self.assertEqual(row["flags"], 7)
+        self.assertGreater(row["expires_at"], 0)
+
+    def test_append_to_compressed_value(self):
+        data_layer = DataLayer(
+            self.db_name, compressor=Compressor(threshold=10)
+        )
+        try:
+            data_layer.set_value("big", b"a" * 100, 7)
+            self.assertTrue(data_layer.append_value("big", b"b"))
+            row, = data_layer.get_values(["big"])
+        finally:
+            data_layer.close()
+        self.assertEqual(row["value"], b"a" * 100 + b"b")
+        self.assertEqual(row["flags"], 7)
+        self.assertNotIn("compressed", row)
+
+    def cas(self, key):
+        return self.data_layer.get_values([key], with_cas=True)[0]["cas"]
+
+    def test_every_write_changes_cas(self):
+        self.data_layer.set_value("foo", b"1", 0)
+        self.data_layer.set_value("bar", b"1", 0)
+        seen = [self.cas("foo"), self.cas("bar")]
+        for write in [
+            lambda: self.data_layer.set_value("foo", b"2", 0),
+            lambda: self.data_layer.replace_value("foo", b"3", 0),
+            lambda: self.data_layer.append_value("foo", b"4"),
+            lambda: self.data_layer.incr_value("foo", 1),
+        ]:
+            write()
+            self.assertGreater(self.cas("foo"), max(seen))
+            seen.append(self.cas("foo"))
+        self.assertNotIn("cas", self.data_layer.get_values(["foo"])[0])
+
+    def test_cas(self):
+        self.data_layer.set_value("foo", b"1", 0)
+        cas = self.cas("foo")
+        self.assertTrue(self.data_layer.cas_value("foo", b"2", 5, 0, cas))
+        self.assertFalse(self.data_layer.cas_value("foo", b"3", 6, 0, cas))
+        self.assertIsNone(self.data_layer.cas_value("bar", b"4", 7, 0, cas))
+        row, = self.data_layer.get_values(["foo"])
+        self.assertEqual((row["value"], row["flags"]), (b"2", 5))
+
+    def test_cas_after_the_key_is_written_again(self):
+        # The key holds the largest CAS value, which must not be handed out
+        # again once it is deleted
+        self.data_layer.set_value("foo", b"1", 0)
+        cas = self.cas("foo")
+        self.data_layer.delete_value("foo")
+        self.assertIsNone(self.data_layer.cas_value("foo", b"2", 0, 0, cas))
+        self.data_layer.set_value("foo", b"3", 0)
+        self.assertGreater(self.cas("foo"), cas)
+        self.assertFalse(self.data_layer.cas_value("foo", b"4", 0, 0, cas))
+        self.assertEqual(self.values("foo"), {"foo": b"3"})
+
+    def test_incr_and_decr(self):
+        self.data_layer.set_value("counter", b"10", 0)
+        self.assertEqual(self.data_layer.incr_value("counter", 5), 15)
+        self.assertEqual(self.data_layer.incr_value("counter", -20), 0)
+        self.assertIsNone(self.data_layer.incr_value("missing", 1))
+        self.data_layer.set_value("text", b"ten", 0)
+        with self.assertRaises(NonNumericValue):
+            self.data_layer.incr_value("text", 1)
+        self.assertEqual(self.values("counter", "text"),
+                         {"counter": b"0", "text": b"ten"})
+
+    def test_incremented(self):
+        self.assertEqual(incremented(b"41", 1), b"42")
+        self.assertEqual(incremented(b"007", -8), b"0")
+        self.assertEqual(incremented(str(MAX_COUNTER).encode(), 2), b"1")
+        self.assertIsNone(incremented(str(MAX_COUNTER + 1).encode(), 0))
+        self.assertIsNone(incremented(b"-1", 1))
+        self.assertIsNone(incremented(b"", 1))
+
+    def test_touch(self):
+        self.data_layer.set_value("foo", b"1", 0)
+        self.data_layer.set_value("expired", b"2", 0, -1)
+        self.assertTrue(self.data_layer.touch_value("foo", -1))
+        self.assertFalse(self.data_layer.touch_value("expired", 0))
+        self.assertFalse(self.data_layer.touch_value("foo", 0))
+        self.assertEqual(self.values("foo", "expired"), {})
+
+    def test_usage_is_kept_up_to_date(self):
+        self.data_layer.set_value("foo", b"12345", 0)
+        self.data_layer.set_value("bar", b"1", 0)
+        self.data_layer.set_value("foo", b"123", 0)
+        self.data_layer.append_value("bar", b"23")
+        self.data_layer.load([("baz", (b"1", 0, 0)), ("baz", (b"12", 0, 0))])
+        self.data_layer.load([("baz", (b"1", 0, 0))])
+        self.assertEqual(
+            self.data_layer.usage(), {"items": 3, "bytes": 3 * 3 + 7}
+        )
+        self.data_layer.delete_value("foo")
+        self.data_layer.set_value("old", b"1", 0, -1)
+        self.data_layer.delete_expired(10)
+        self.assertEqual(
+            self.data_layer.usage(), {"items": 2, "bytes": 2 * 3 + 4}
+        )
+
+    def test_evict_least_recently_used(self):
+        data_layer = DataLayer(self.db_name, track_access=True)
+        try:
+            for key in ["a", "b", "c", "d"]:
+                data_layer.set_value(key, b"xxxxxxxxx", 0)
+            # Each key is 10 bytes. Mark b, then c, then a as read later on.
+            later = time.time() + ACCESS_RESOLUTION
+            data_layer.get_values(["b", "c"])
+            data_layer.get_values(["c"])
+            self.assertEqual(data_layer.record_accesses(later), 2)
+            data_layer.get_values(["c", "a"])
+            self.assertEqual(
+                data_layer.record_accesses(later + ACCESS_RESOLUTION), 2
+            )
+            data_layer.get_values(["a"])
+            self.assertEqual(
+                data_layer.record_accesses(later + 2 * ACCESS_RESOLUTION), 1
+            )
+            self.assertEqual(data_layer.record_accesses(), 0)
+
+            self.assertEqual(
+                data_layer.evict(max_items=10)["evicted"], 0
+            )
+            self.assertEqual(data_layer.evict(max_items=3), {
+                "evicted": 1, "evicted_bytes": 10,
+                "items": 3, "bytes": 30,
+            })
+            self.assertEqual(
+                data_layer.evict(max_bytes=15, limit=5)["evicted"], 2
+            )
+            self.assertEqual(self.values("a", "b", "c", "d"), {
+                "a": b"xxxxxxxxx"
+            })
+        finally:
+            data_layer.close()
+
+    def test_accesses_are_not_tracked_by_default(self):
+        self.data_layer.set_value("a", b"", 0)
+        self.data_layer.get_values(["a"])
+        self.assertEqual(self.data_layer.accessed, set())
+
+    def scan_keys(self, *args, **kwargs):
+        return [row["key"] for row in self.data_layer.scan(*args, **kwargs)]
+
+    def test_scan_in_key_order(self):
+        for key in ["b", "a2", "c", "a1", "a"]:
+            self.data_layer.set_value(key, b"v", 1)
+        self.data_layer.set_value("a3", b"v", 1, -1)
+        self.assertEqual(self.scan_keys(), ["a", "a1", "a2", "b", "c"])
+        self.assertEqual(
+            list(self.data_layer.scan(limit=1)),
+            [{"key": "a", "flags": 1, "expires_at": 0, "size": 1,
+              "value": b"v"}]
+        )
+
+    def test_keys_of_any_bytes(self):
+        # Keys are stored as the bytes received, whether or not they are
+        # valid UTF-8
+        keys = [decode_key(b"caf\xc3\xa9"), decode_key(b"\xff\x00")]
+        for key in keys:
+            self.data_layer.set_value(key, b"v", 1)
+        self.assertEqual(
+            sorted(row["key"] for row in self.data_layer.get_values(keys)),
+            sorted(keys)
+        )
+        self.assertEqual(self.scan_keys(), keys)
+        with closing(sqlite3.connect(self.db_name)) as con:
+            self.assertEqual(
+                [row[0] for row in con.execute(
+                    "SELECT KEY FROM ITEMS ORDER BY KEY"
+                )],
+                [b"caf\xc3\xa9", b"\xff\x00"]
+            )
+        self.assertEqual([encode_key(key) for key in keys],
+                         [b"caf\xc3\xa9", b"\xff\x00"])
+
+    def test_scan_range(self):
+        self.insert_records(12)
+        self.assertEqual(
+            self.scan_keys(*prefix_range("key1")),
+            ["key1", "key10", "key11"]
+        )
+        self.assertEqual(self.scan_keys("key2", "key4"), ["key2", "key3"])
+        self.assertEqual(
+            self.scan_keys("key2", "key4", after="key2"), ["key3"]
+        )
+        self.assertEqual(self.scan_keys(after="key8"), ["key9"])
+
+    def test_scan_pages(self):
+        self.data_layer.SCAN_PAGE_SIZE = 2
+        self.insert_records(5)
+        self.assertEqual(len(self.scan_keys()), 5)
+        self.assertEqual(self.scan_keys(limit=3), ["key0", "key1", "key2"])
+
+    def test_scan_fields(self):
+        self.data_layer.set_value("foo", b"12345", 7, 3600)
+        self.assertEqual(
+            list(self.data_layer.scan(fields=SCAN_KEYS)), [{"key": "foo"}]
+        )
+        row, = self.data_layer.scan(fields=SCAN_METADATA)
+        self.assertEqual(set(row), {"key", "flags", "expires_at", "size"})
+        self.assertEqual(row["size"], 5)
+
+    def test_prefix_range(self):
+        self.assertEqual(prefix_range("ab"), ("ab", "ac"))
+        self.assertEqual(prefix_range("a\U0010ffff")[1],
+                         decode_key(b"a\xf4\x8f\xbf\xc0"))
+        self.assertEqual(prefix_range("a\udcff"), ("a\udcff", "b"))
+        self.assertEqual(prefix_range(""), ("", None))
+
+    def test_scan_prefix_next_to_the_surrogates(self):
+        # The character after U+D7FF would be a surrogate, and keys which
+        # are not UTF-8 may sort right after the prefix
+        keys = ["\ud7ff", "\ud7ffa", "\ud7fe", "\ue000",
+                decode_key(b"\xed\xa0\x80")]
+        for key in keys:
+            self.data_layer.set_value(key, b"v", 0)
+        self.assertEqual(
+            self.scan_keys(*prefix_range("\ud7ff")), ["\ud7ff", "\ud7ffa"]
+        )
+
+    def test_expires_at(self):
+        now = 1000000000
+        self.assertEqual(expires_at(0, now), NEVER_EXPIRES)
+        self.assertEqual(expires_at(60, now), now + 60)
+        self.assertEqual(
+            expires_at(MAX_RELATIVE_EXPTIME, now), now + MAX_RELATIVE_EXPTIME
+        )
+        self.assertEqual(expires_at(now + 60, now), now + 60)
+        self.assertEqual(expires_at(-1, now), now)
+
+    def test_connection_is_reused(self):
+        self.insert_records(3)
+        list(self.data_layer.get_values(["key1"]))
+        self.data_layer.delete_value("key2")
+        self.assertEqual(len(self.data_layer.pool._all), 1)
+
+    def test_connection_is_tuned(self):
+        data_layer = DataLayer(
+            self.db_name, TUNING_FAST, cache_size=-1234
+        )
+        try:
+            with data_layer.pool.connection() as con:
+                pragma = lambda name: \
+                    con.execute("PRAGMA %s" % name).fetchone()[0]
+                self.assertEqual(pragma("journal_mode"), "wal")
+                self.assertEqual(pragma("synchronous"), 0)
+                self.assertEqual(pragma("cache_size"), -1234)
+                self.assertEqual(pragma("busy_timeout"), 5000)
+        finally:
+            data_layer.close()
+
+    def test_unknown_tuning_profile(self):
+        self.assertRaises(ValueError, tuning_pragmas, "turbo")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+from eviction import Evictor
+from twisted.internet import task
+
+
+class EvictorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_layer = mock.Mock()
+        self.data_layer.record_accesses.return_value = 3
+        self.clock = task.Clock()
+        self.evictor = Evictor(
+            self.data_layer, max_items=100, interval=1.0, batch_size=10,
+            clock=self.clock
+        )
+
+    def outcome(self, evicted, items):
+        return {
+            "evicted": evicted, "evicted_bytes": evicted * 10,
+            "items": items, "bytes": items * 10,
+        }
+
+    def test_evicts_until_a_batch_comes_back_short(self):
+        self.data_layer.evict.side_effect = [
+            self.outcome(10, 110), self.outcome(10, 100),
+            self.outcome(0, 100),
+        ]
+        results = []
+        self.evictor.sweep().addCallback(results.append)
+
+        # Accesses are recorded first, each further batch runs in its own
+        # reactor iteration
+        self.data_layer.record_accesses.assert_called_once_with()
+        self.assertEqual(self.data_layer.evict.call_count, 1)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual(results, [20])
+        self.data_layer.evict.assert_called_with(100, None, 10)
+        stats = self.evictor.stats()
+        self.assertEqual(stats["evictions"], 20)
+        self.assertEqual(stats["evicted_bytes"], 200)
+        self.assertEqual(stats["access_updates"], 3)
+        self.assertEqual(stats["curr_items"], 100)
+
+    def test_recording_only(self):
+        self.evictor.batch_size = 0
+        self.data_layer.evict.return_value = self.outcome(0, 500)
+        results = []
+        self.evictor.sweep().addCallback(results.append)
+        self.assertEqual(results, [0])
+        self.data_layer.evict.assert_called_once_with(100, None, 0)
+
+    def test_failures_do_not_stop_the_evictor(self):
+        self.data_layer.record_accesses.side_effect = IOError("disk full")
+        self.evictor.start()
+        self.clock.pump([1.0] * 2)
+        self.assertEqual(self.data_layer.record_accesses.call_count, 2)
+        self.data_layer.evict.assert_not_called()
+        self.evictor.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
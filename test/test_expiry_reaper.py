@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+from expiry_reaper import ExpiryReaper
+from twisted.internet import task
+
+
+class ExpiryReaperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_layer = mock.Mock()
+        self.clock = task.Clock()
+        self.reaper = ExpiryReaper(
+            self.data_layer, interval=1.0, batch_size=10, clock=self.clock
+        )
+
+    def test_sweeps_until_a_batch_comes_back_short(self):
+        self.data_layer.delete_expired.side_effect = [10, 10, 4]
+        results = []
+        self.reaper.sweep().addCallback(results.append)
+
+        # Each further batch runs in its own reactor iteration
+        self.assertEqual(self.data_layer.delete_expired.call_count, 1)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual(results, [24])
+        self.assertEqual(self.reaper.reaped, 24)
+        self.data_layer.delete_expired.assert_called_with(10)
+
+    def test_sweeps_periodically(self):
+        self.data_layer.delete_expired.return_value = 0
+        self.reaper.start()
+        self.clock.pump([1.0] * 3)
+        self.assertEqual(self.data_layer.delete_expired.call_count, 3)
+        self.reaper.stop()
+
+    def test_failures_do_not_stop_the_reaper(self):
+        self.data_layer.delete_expired.side_effect = IOError("disk full")
+        self.reaper.start()
+        self.clock.pump([1.0] * 2)
+        self.assertEqual(self.data_layer.delete_expired.call_count, 2)
+        self.reaper.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
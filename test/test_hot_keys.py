@@ -0,0 +1,73 @@
+import itertools
+import unittest
+from hot_keys import CountMinSketch, HotKeys, TopKeys
+from memcache_receiver import AdminError
+from stats import Stats
+
+
+class CountMinSketchTestCase(unittest.TestCase):
+    def test_estimates_are_never_too_low(self):
+        sketch = CountMinSketch(64, 4)
+        counts = {"k%d" % i: i % 7 + 1 for i in range(500)}
+        for key, count in counts.items():
+            for _ in range(count):
+                sketch.add(key)
+        errors = [sketch.estimate(key) - count
+                  for key, count in counts.items()]
+        self.assertGreaterEqual(min(errors), 0)
+        # Within 2.7 * N / width for most keys
+        bound = 2.7 * sum(counts.values()) / 64
+        self.assertLess(sum(error > bound for error in errors), 25)
+
+
+class TopKeysTestCase(unittest.TestCase):
+    def test_heavy_hitters(self):
+        top = TopKeys(3, 256, 4)
+        # A few hot keys among many cold ones, arriving last
+        for i in range(2000):
+            top.add("cold%d" % i)
+        for key, count in (("a", 50), ("b", 40), ("c", 30), ("d", 5)):
+            for _ in range(count):
+                top.add(key)
+        self.assertEqual([key for key, _ in top.top()], ["a", "b", "c"])
+        self.assertEqual(top.total, 2125)
+
+
+class HotKeysTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats = Stats()
+        self.hot_keys = HotKeys(self.stats, size=2, width=256)
+
+    def test_command(self):
+        self.assertEqual(self.hot_keys.command([]), [b"END"])
+        self.assertEqual(self.hot_keys.command(["start"]), [b"OK"])
+        self.assertIs(self.stats.key_tracker, self.hot_keys)
+        self.hot_keys.record(["a", "b", "a", "c", "a", "b"])
+        self.hot_keys.record(["\udcff"] * 3, True)
+        self.assertEqual(self.hot_keys.command(["stop"]), [b"OK"])
+        self.assertIsNone(self.stats.key_tracker)
+        # The counts are kept once stopped
+        self.assertEqual(self.hot_keys.command([]), [
+            b"READ a 3", b"READ b 2", b"WRITE \xff 3", b"END"
+        ])
+        self.assertEqual(self.hot_keys.stats()["reads"], 6)
+        self.hot_keys.command(["reset"])
+        self.assertEqual(self.hot_keys.command([]), [b"END"])
+        for args in (["start", "x"], ["start", "0"], ["start", "2"],
+                     ["stop", "now"], ["stats"]):
+            with self.assertRaises(AdminError):
+                self.hot_keys.command(args)
+
+    def test_sampling(self):
+        draws = itertools.cycle([0.1, 0.9])
+        self.hot_keys.random = lambda: next(draws)
+        self.hot_keys.command(["start", "0.5"])
+        self.hot_keys.record(["a"] * 10)
+        self.assertEqual(self.hot_keys.reads.total, 5)
+        # Counts are reported scaled back up
+        self.assertEqual(self.hot_keys.report(), [b"READ a 10", b"END"])
+        self.assertEqual(self.hot_keys.stats()["sample_rate"], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import tempfile
+import unittest
+from data_layer import DataLayer
+from key_filter import CountingBloomFilter, KeyFilter
+from schema import create_schema
+from twisted.internet import defer, task
+from unittest import mock
+
+
+class CountingBloomFilterTestCase(unittest.TestCase):
+    def test_error_rate(self):
+        bloom = CountingBloomFilter(10000, 0.01)
+        for i in range(10000):
+            bloom.add("k%d" % i)
+        self.assertTrue(all("k%d" % i in bloom for i in range(10000)))
+        false_positives = sum("x%d" % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(bloom.error_rate(), 0.01, delta=0.002)
+
+    def test_remove(self):
+        bloom = CountingBloomFilter(100, 0.01)
+        bloom.add("a")
+        bloom.add("b")
+        bloom.remove("a")
+        self.assertNotIn("a", bloom)
+        self.assertIn("b", bloom)
+        self.assertEqual(bloom.count, 1)
+
+    def test_memory_cap(self):
+        bloom = CountingBloomFilter(100000, 0.01, max_bytes=50000)
+        self.assertEqual(len(bloom.counters), 50000)
+        for i in range(100000):
+            bloom.add("k%d" % i)
+        self.assertGreater(bloom.error_rate(), 0.01)
+
+    def test_saturated_counters_stay(self):
+        bloom = CountingBloomFilter(1, 0.5)
+        bloom.hashes = 1
+        for _ in range(300):
+            bloom.add("a")
+        for _ in range(300):
+            bloom.remove("a")
+        self.assertIn("a", bloom)
+
+
+class KeyFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.files = [tempfile.NamedTemporaryFile() for _ in range(2)]
+        self.shards = []
+        for f in self.files:
+            create_schema(f.name)
+            self.shards.append(DataLayer(f.name))
+        for i in range(300):
+            self.shards[i % 2].set_value("k%d" % i, b"v", 0)
+        # Requests all go to the first shard, which is enough here
+        self.data_layer = mock.Mock(wraps=self.shards[0])
+        self.data_layer.READ_YOUR_WRITES = False
+        self.clock = task.Clock()
+        self.key_filter = KeyFilter(
+            self.data_layer, self.shards, batch_size=100, clock=self.clock
+        )
+
+    def tearDown(self):
+        for shard in self.shards:
+            shard.close()
+        for f in self.files:
+            f.close()
+
+    def result(self, value):
+        results = []
+        defer.maybeDeferred(lambda: value).addCallback(results.append)
+        return results[0]
+
+    def build(self, d=None):
+        done = []
+        if d is None:
+            d = self.key_filter.rebuild()
+        d.addCallback(done.append)
+        while not done:
+            self.clock.advance(0)
+
+    def test_keys_ruled_out_are_not_looked_up(self):
+        # Until built, every key is looked up
+        self.assertEqual(self.result(self.key_filter.get_values(["x"])), [])
+        self.assertEqual(self.data_layer.get_values.call_count, 1)
+        self.build()
+        self.assertEqual(self.key_filter.filter.count, 300)
+        self.assertEqual(self.key_filter.builds, 1)
+
+        self.data_layer.get_values.reset_mock()
+        self.assertEqual(self.result(self.key_filter.get_values(["x"])), [])
+        self.data_layer.get_values.assert_not_called()
+        rows = self.result(self.key_filter.get_values(["k0", "x", "y"]))
+        self.assertEqual([row["key"] for row in rows], ["k0"])
+        self.data_layer.get_values.assert_called_once_with(["k0"], False)
+        stats = self.key_filter.stats()
+        self.assertEqual(stats["saved_queries"], 1)
+        self.assertEqual(stats["saved_keys"], 3)
+
+    def test_writes_keep_the_filter_up_to_date(self):
+        self.build()
+        self.result(self.key_filter.set_value("new", b"v", 0))
+        self.assertEqual(
+            len(self.result(self.key_filter.get_values(["new"]))), 1
+        )
+        self.assertTrue(self.result(self.key_filter.delete_value("new")))
+        self.assertNotIn("new", self.key_filter.filter)
+        # Deleting a key which does not exist leaves the filter alone
+        # k1 is held by the other shard
+        self.assertFalse(self.result(self.key_filter.delete_value("k1")))
+        self.assertIn("k1", self.key_filter.filter)
+
+    def test_writes_during_a_build(self):
+        self.build()
+        # A set issued before the build which completes after it
+        written = defer.Deferred()
+        self.data_layer.set_value = lambda *args: written
+        self.key_filter.set_value("early", b"v", 0)
+
+        # The build waits for the first keys of the second shard
+        scanned = defer.Deferred()
+        pages = [scanned]
+        scan_keys = self.shards[1].scan_keys
+        self.shards[1].scan_keys = \
+            lambda after, limit: pages.pop() if pages else scan_keys(
+                after, limit
+            )
+        d = self.key_filter.rebuild()
+        self.clock.advance(0)
+        self.assertIsNotNone(self.key_filter.next_filter)
+        self.key_filter.set_value("during", b"v", 0)
+        # k1 is deleted before the build reads it, so it must not be
+        # removed from the new filter
+        self.data_layer.delete_value = self.shards[1].delete_value
+        self.assertTrue(self.result(self.key_filter.delete_value("k1")))
+        self.assertNotIn("k1", self.key_filter.filter)
+        scanned.callback(scan_keys(None, 100))
+        self.build(d)
+        written.callback(True)
+
+        for key in ("early", "during"):
+            self.assertIn(key, self.key_filter.filter)
+        self.assertEqual(self.key_filter.filter.count, 301)
+        self.assertEqual(self.key_filter.builds, 2)
+        self.assertEqual(self.key_filter.in_flight, {})
+
+    @mock.patch.object(KeyFilter, "MIN_CAPACITY", 10)
+    def test_rebuilt_early_once_full(self):
+        empty_file = tempfile.NamedTemporaryFile()
+        self.files.append(empty_file)
+        create_schema(empty_file.name)
+        empty = DataLayer(empty_file.name)
+        self.shards.append(empty)
+        key_filter = KeyFilter(empty, [empty], clock=self.clock)
+        self.key_filter = key_filter
+        self.build()
+        self.assertEqual(key_filter.filter.capacity, 10)
+
+        for i in range(400):
+            self.result(key_filter.set_value("n%d" % i, b"v", 0))
+        missing = ["m%d" % i for i in range(20)]
+        # Far more keys than it was sized for lets most misses through
+        self.assertGreater(
+            sum(key in key_filter.filter for key in missing), 10
+        )
+        self.assertEqual(key_filter.builds, 1)
+        self.assertIsNotNone(key_filter.early_rebuild)
+
+        while key_filter.builds < 2 or key_filter.building:
+            self.clock.advance(0)
+        self.assertIsNone(key_filter.early_rebuild)
+        self.assertEqual(key_filter.filter.capacity, 800)
+        with mock.patch.object(empty, "get_values") as get_values:
+            self.assertEqual(self.result(key_filter.get_values(missing)), [])
+            get_values.assert_not_called()
+        # Nor is it rebuilt for the keys it was sized for
+        key_filter.set_value("n400", b"v", 0)
+        self.assertIsNone(key_filter.early_rebuild)
+
+    def test_replicated_keys_are_added(self):
+        self.build()
+        self.key_filter.changed(["replicated"])
+        self.key_filter.changed(None)
+        self.assertIn("replicated", self.key_filter.filter)
+
+
+if __name__ == '__main__':
+    unittest.main()
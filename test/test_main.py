@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+import main
+
+
+class ServeTestCase(unittest.TestCase):
+    @mock.patch("main.run_server")
+    @mock.patch("main.supervise")
+    def test_per_process_caches_refuse_workers(self, supervise, run_server):
+        for options in ({"read_cache_size": 1000}, {"key_filter": True}):
+            with self.assertRaises(RuntimeError):
+                main.serve("db", workers=2, port=0, **options)
+            # A single process sees all the writes
+            main.serve("db", workers=1, port=0, **options)
+        supervise.assert_not_called()
+        self.assertEqual(run_server.call_count, 2)
+        main.serve("db", workers=2, port=0, read_cache_size=0)
+        supervise.assert_called_once()
+
+    @mock.patch("main.reactor")
+    @mock.patch("main.listening_socket")
+    @mock.patch("main.Supervisor")
+    def test_replica_workers_refuse_writes(self, supervisor, *mocks):
+        parser = main.build_parser()
+        options = vars(parser.parse_args(
+            ["serve", "db", "--workers", "2", "--replica-of", "host:1"]
+        ))
+        main.supervise(options.pop("db"), options.pop("workers"), {
+            name: value for name, value in options.items()
+            if name in ("port", "replica_of", "replication_port")
+        })
+        worker_argv = supervisor.call_args[0][1]
+        first, other = (
+            vars(parser.parse_args(worker_argv(index)[2:]))
+            for index in (0, 1)
+        )
+        self.assertEqual(first["replica_of"], ("host", 1))
+        # The others don't follow the primary, but don't take writes either
+        self.assertIsNone(other["replica_of"])
+        self.assertTrue(other["read_only"])
+
+        main.supervise("db", 2, {"port": 0, "replica_of": None})
+        worker_argv = supervisor.call_args[0][1]
+        self.assertFalse(
+            vars(parser.parse_args(worker_argv(1)[2:]))["read_only"]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
-from memcache_receiver import MemcacheFactory
+from data_layer import NonNumericValue, decode_key
+from memcache_receiver import AdminError, MemcacheFactory
+from twisted.internet import defer
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 from unittest import mock
+import zlib
 
 
 class MemcacheReceiverTestCase(unittest.TestCase):
@@ -27,7 +30,9 @@ class MemcacheReceiverTestCase(unittest.TestCase):
         command = "set %s %d %d %d\r\n" % (key, flags, 0, len(value))
         command += "%s\r\n" % value.decode('ascii')
         self._test_ascii_command(command, b"STORED\r\n")
-        self.data_layer.set_value.assert_called_once_with(key, value, flags)
+        self.data_layer.set_value.assert_called_once_with(
+            key, value, flags, 0
+        )
 
     def test_set_binary(self):
         key = "foo"
@@ -39,7 +44,9 @@ class MemcacheReceiverTestCase(unittest.TestCase):
             (key.encode('ascii'), flags, 0, len(value))
         command += b"%s\r\n" % value
         self._test_binary_command(command, b"STORED\r\n")
-        self.data_layer.set_value.assert_called_once_with(key, value, flags)
+        self.data_layer.set_value.assert_called_once_with(
+            key, value, flags, 0
+        )
 
     def test_set_noreply(self):
         key = "foo"
@@ -48,7 +55,54 @@ class MemcacheReceiverTestCase(unittest.TestCase):
         command = "set %s %d %d %d noreply\r\n" % (key, flags, 0, len(value))
         command += "%s\r\n" % value.decode('ascii')
         self._test_ascii_command(command, b"")
-        self.data_layer.set_value.assert_called_once_with(key, value, flags)
+        self.data_layer.set_value.assert_called_once_with(
+            key, value, flags, 0
+        )
+
+    def test_set_exptime(self):
+        command = "set foo 1 3600 5\r\nHello\r\n"
+        self._test_ascii_command(command, b"STORED\r\n")
+        self.data_layer.set_value.assert_called_once_with(
+            "foo", b"Hello", 1, 3600
+        )
+
+    def test_set_in_pieces(self):
+        value = bytes(range(256)) * 4
+        command = b"set foo 0 0 %d\r\n" % len(value)
+        command += value + b"\r\nget bar\r\n"
+        self.data_layer.get_values.return_value = []
+        for i in range(0, len(command), 100):
+            self.proto.dataReceived(command[i:i + 100])
+        self.assertEqual(self.tr.value(), b"STORED\r\nEND\r\n")
+        self.data_layer.set_value.assert_called_once_with(
+            "foo", value, 0, 0
+        )
+
+    def test_set_split_across_delimiter(self):
+        self.data_layer.get_values.return_value = []
+        for data in [b"set foo 0 0 3\r", b"\nbar\r", b"\nget", b" foo\r\n"]:
+            self.proto.dataReceived(data)
+        self.assertEqual(self.tr.value(), b"STORED\r\nEND\r\n")
+        self.data_layer.set_value.assert_called_once_with(
+            "foo", b"bar", 0, 0
+        )
+
+    def test_set_too_large(self):
+        self.proto.max_item_size = 10
+        command = b"set foo 0 0 11\r\nHello World\r\ndelete foo\r\n"
+        self.data_layer.delete_value.return_value = False
+        self._test_binary_command(
+            command,
+            b"SERVER_ERROR object too large for cache\r\nNOT_FOUND\r\n"
+        )
+        self.data_layer.set_value.assert_not_called()
+
+    def test_set_bad_data_chunk(self):
+        self._test_ascii_command(
+            "set foo 0 0 5\r\nHello!!\r\n",
+            "CLIENT_ERROR bad data chunk\r\nERROR\r\n".encode("ascii")
+        )
+        self.data_layer.set_value.assert_not_called()
 
     def test_set_too_few_arguments(self):
         self._test_ascii_command(
@@ -68,6 +122,11 @@ class MemcacheReceiverTestCase(unittest.TestCase):
             b"CLIENT_ERROR Invalid last argument - expected 'noreply'\r\n"
         )
 
+    def test_line_too_long(self):
+        self.proto.dataReceived(b"get " + b"k" * 20000)
+        self.assertTrue(self.tr.disconnecting)
+        self.data_layer.get_values.assert_not_called()
+
     def test_unrecognized_command(self):
         self._test_ascii_command("blink foo bar\r\n", b"ERROR\r\n")
 
@@ -103,6 +162,17 @@ class MemcacheReceiverTestCase(unittest.TestCase):
         self._test_ascii_command(command, expected_response)
         self.data_layer.get_values.assert_called_once_with([key])
 
+    def test_get_non_utf8_key(self):
+        key = b"caf\xe9"
+        self.data_layer.get_values.return_value = [
+            {"key": decode_key(key), "value": b"1", "flags": 0}
+        ]
+        self._test_binary_command(
+            b"get " + key + b"\r\n",
+            b"VALUE " + key + b" 0 1\r\n1\r\nEND\r\n"
+        )
+        self.data_layer.get_values.assert_called_once_with([decode_key(key)])
+
     # TODO: make this test more robust by making it key-order independent
     def test_get_multiple_values_when_only_one_exists(self):
         key1, key2 = "foo", "bar"
@@ -137,6 +207,58 @@ class MemcacheReceiverTestCase(unittest.TestCase):
         self._test_ascii_command(command, expected_response)
         self.data_layer.get_values.assert_called_once_with(keys)
 
+    def test_get_response_is_written_at_once(self):
+        self.data_layer.get_values.return_value = [
+            {"key": "key%d" % i, "value": b"value", "flags": 0}
+            for i in range(3)
+        ]
+        self.tr.write = mock.Mock(wraps=self.tr.write)
+        self.tr.writeSequence = mock.Mock(wraps=self.tr.writeSequence)
+        self.proto.dataReceived(b"get key0 key1 key2\r\n")
+        self.tr.write.assert_not_called()
+        self.assertEqual(self.tr.writeSequence.call_count, 1)
+        self.assertEqual(self.tr.value().count(b"VALUE"), 3)
+
+    def test_pipelined_commands_are_written_at_once(self):
+        self.data_layer.get_values.return_value = []
+        self.data_layer.delete_value.return_value = True
+        self.tr.write = mock.Mock(wraps=self.tr.write)
+        self.tr.writeSequence = mock.Mock(wraps=self.tr.writeSequence)
+        self.proto.dataReceived(
+            b"set foo 0 0 1\r\na\r\nget foo\r\ndelete foo\r\nblink\r\n"
+        )
+        self.tr.write.assert_not_called()
+        self.assertEqual(self.tr.writeSequence.call_count, 1)
+        self.assertEqual(
+            self.tr.value(), b"STORED\r\nEND\r\nDELETED\r\nERROR\r\n"
+        )
+
+    def test_consecutive_gets_are_looked_up_together(self):
+        self.data_layer.get_values.return_value = [
+            {"key": "foo", "value": b"1", "flags": 0},
+            {"key": "bar", "value": b"22", "flags": 0},
+        ]
+        self.proto.dataReceived(b"get foo\r\nget bar baz foo\r\nget baz\r\n")
+        self.data_layer.get_values.assert_called_once_with(
+            ["foo", "bar", "baz"]
+        )
+        self.assertEqual(
+            self.tr.value(),
+            b"VALUE foo 0 1\r\n1\r\nEND\r\n"
+            b"VALUE bar 0 2\r\n22\r\nVALUE foo 0 1\r\n1\r\nEND\r\n"
+            b"END\r\n"
+        )
+
+    def test_gets_are_not_merged_across_other_commands(self):
+        self.data_layer.get_values.return_value = []
+        self.data_layer.delete_value.return_value = False
+        self.proto.dataReceived(b"get foo\r\ndelete foo\r\nget foo\r\n")
+        self.assertEqual(self.data_layer.get_values.call_count, 2)
+        self.assertEqual(
+            [c[0] for c in self.data_layer.mock_calls],
+            ["get_values", "delete_value", "get_values"]
+        )
+
     def test_delete_when_value_exists(self):
         self._test_delete("foo", True, b"DELETED\r\n")
 
@@ -167,3 +289,325 @@ class MemcacheReceiverTestCase(unittest.TestCase):
             "delete foo noreplytypo\r\n",
             b"CLIENT_ERROR Invalid last argument - expected 'noreply'\r\n"
         )
+
+    def test_deferred_responses_keep_command_order(self):
+        get_result = defer.Deferred()
+        self.data_layer.get_values.return_value = get_result
+        self.data_layer.delete_value.return_value = True
+        self.proto.dataReceived(b"get foo\r\ndelete foo\r\n")
+
+        # The delete must wait for the get to complete
+        self.assertEqual(self.tr.value(), b"")
+        self.data_layer.delete_value.assert_not_called()
+
+        get_result.callback(
+            [{"key": "foo", "value": b"bar", "flags": 0}]
+        )
+        self.assertEqual(
+            self.tr.value(),
+            b"VALUE foo 0 3\r\nbar\r\nEND\r\nDELETED\r\n"
+        )
+
+    def test_data_layer_failure(self):
+        self.data_layer.delete_value.return_value = \
+            defer.fail(IOError("disk full"))
+        self.data_layer.get_values.return_value = []
+        self.proto.dataReceived(b"delete foo\r\nget foo\r\n")
+        self.assertEqual(
+            self.tr.value(),
+            b"SERVER_ERROR OSError('disk full')\r\nEND\r\n"
+        )
+
+    def test_errors_wait_for_earlier_responses(self):
+        get_result = defer.Deferred()
+        self.data_layer.get_values.return_value = get_result
+        self.proto.dataReceived(b"get foo\r\nblink\r\n")
+        self.assertEqual(self.tr.value(), b"")
+        get_result.callback([])
+        self.assertEqual(self.tr.value(), b"END\r\nERROR\r\n")
+
+    def test_read_your_writes_data_layer_is_called_right_away(self):
+        self.data_layer.READ_YOUR_WRITES = True
+        get_result = defer.Deferred()
+        self.data_layer.get_values.return_value = get_result
+        self.data_layer.delete_value.return_value = True
+        self.proto.dataReceived(b"get foo\r\ndelete foo\r\n")
+        self.data_layer.delete_value.assert_called_once_with("foo")
+        self.assertEqual(self.tr.value(), b"")
+        get_result.callback([])
+        self.assertEqual(self.tr.value(), b"END\r\nDELETED\r\n")
+
+    def test_set_flags_out_of_range(self):
+        # The data block is skipped, even if it looks like a command
+        self.data_layer.delete_value.return_value = True
+        self._test_ascii_command(
+            "set foo 4294967296 0 10\r\ndelete foo\r\ndelete bar\r\n",
+            b"CLIENT_ERROR bad command line format\r\nDELETED\r\n"
+        )
+        self.data_layer.set_value.assert_not_called()
+        self.data_layer.delete_value.assert_called_once_with("bar")
+
+    def test_get_compressed_value(self):
+        self.data_layer.get_values.return_value = [{
+            "key": "foo", "value": zlib.compress(b"bar"), "flags": 1,
+            "compressed": True,
+        }]
+        self._test_ascii_command(
+            "get foo\r\n", b"VALUE foo 1 3\r\nbar\r\nEND\r\n"
+        )
+
+    def test_compressed_values_passed_through(self):
+        value = zlib.compress(b"bar")
+        self.data_layer.get_values.return_value = [{
+            "key": "foo", "value": value, "flags": 1, "compressed": True,
+        }]
+        self._test_ascii_command("compressed_flag 8\r\n", b"OK\r\n")
+        self.tr.clear()
+        self._test_binary_command(
+            b"get foo\r\n",
+            b"VALUE foo 9 %d\r\n%s\r\nEND\r\n" % (len(value), value)
+        )
+
+    def test_add(self):
+        self.data_layer.add_value.return_value = False
+        self._test_ascii_command(
+            "add foo 3 60 3\r\nbar\r\n", b"NOT_STORED\r\n"
+        )
+        self.data_layer.add_value.assert_called_once_with(
+            "foo", b"bar", 3, 60
+        )
+
+    def test_replace(self):
+        self.data_layer.replace_value.return_value = True
+        self._test_ascii_command(
+            "replace foo 3 0 3\r\nbar\r\n", b"STORED\r\n"
+        )
+
+    def test_append_and_prepend(self):
+        self.data_layer.append_value.return_value = True
+        self.data_layer.prepend_value.return_value = False
+        self._test_ascii_command(
+            "append foo 0 0 1\r\na\r\nprepend foo 0 0 1 noreply\r\nb\r\n"
+            "prepend bar 0 0 1\r\nc\r\n",
+            b"STORED\r\nNOT_STORED\r\n"
+        )
+        self.data_layer.append_value.assert_called_once_with("foo", b"a")
+        self.assertEqual(self.data_layer.prepend_value.call_count, 2)
+
+    def test_incr_and_decr(self):
+        self.data_layer.incr_value.side_effect = [43, None, 0]
+        self._test_ascii_command(
+            "incr foo 1\r\nincr bar 1\r\ndecr foo 100\r\n",
+            b"43\r\nNOT_FOUND\r\n0\r\n"
+        )
+        self.assertEqual(self.data_layer.incr_value.call_args_list, [
+            mock.call("foo", 1), mock.call("bar", 1), mock.call("foo", -100)
+        ])
+        stats = self._stats(b"stats\r\n")
+        self.assertEqual(stats[b"incr_hits"], b"1")
+        self.assertEqual(stats[b"incr_misses"], b"1")
+        self.assertEqual(stats[b"decr_hits"], b"1")
+
+    def test_incr_non_numeric_value(self):
+        self.data_layer.incr_value.return_value = \
+            defer.fail(NonNumericValue("foo"))
+        self.data_layer.get_values.return_value = []
+        self._test_ascii_command(
+            "incr foo 1\r\nget foo\r\n",
+            b"CLIENT_ERROR cannot increment or decrement non-numeric value"
+            b"\r\nEND\r\n"
+        )
+
+    def test_incr_invalid_delta(self):
+        self._test_ascii_command(
+            "incr foo -1\r\nincr foo 18446744073709551616\r\n",
+            b"CLIENT_ERROR invalid numeric delta argument\r\n" * 2
+        )
+        self.data_layer.incr_value.assert_not_called()
+
+    def test_touch(self):
+        self.data_layer.touch_value.side_effect = [True, False, True]
+        self._test_ascii_command(
+            "touch foo 60\r\ntouch bar 60\r\ntouch foo 60 noreply\r\n"
+            "touch foo\r\n",
+            b"TOUCHED\r\nNOT_FOUND\r\n"
+            b"CLIENT_ERROR Incorrect number of arguments\r\n"
+        )
+        self.data_layer.touch_value.assert_any_call("foo", 60)
+
+    def test_gets(self):
+        self.data_layer.get_values.return_value = [
+            {"key": "foo", "value": b"bar", "flags": 1, "cas": 42}
+        ]
+        self._test_ascii_command(
+            "get foo\r\ngets foo\r\n",
+            b"VALUE foo 1 3\r\nbar\r\nEND\r\n"
+            b"VALUE foo 1 3 42\r\nbar\r\nEND\r\n"
+        )
+        self.data_layer.get_values.assert_called_once_with(["foo"], True)
+
+    def test_cas(self):
+        self.data_layer.cas_value.side_effect = [True, False, None]
+        self._test_ascii_command(
+            "cas foo 1 0 1 42\r\na\r\ncas foo 1 0 1 42\r\nb\r\n"
+            "cas bar 1 0 1 7\r\nc\r\ncas foo 1 0 1\r\n",
+            b"STORED\r\nEXISTS\r\nNOT_FOUND\r\n"
+            b"CLIENT_ERROR Incorrect number of arguments\r\n"
+        )
+        self.data_layer.cas_value.assert_any_call("foo", b"a", 1, 0, 42)
+        stats = self._stats(b"stats\r\n")
+        self.assertEqual(stats[b"cas_hits"], b"1")
+        self.assertEqual(stats[b"cas_badval"], b"1")
+        self.assertEqual(stats[b"cas_misses"], b"1")
+
+    def _stats(self, command):
+        self.tr.clear()
+        self.proto.dataReceived(command)
+        lines = self.tr.value().split(b"\r\n")
+        self.assertEqual(lines[-2:], [b"END", b""])
+        return dict(line.split(b" ")[1:] for line in lines[:-2])
+
+    def test_stats_counts_commands(self):
+        self.data_layer.get_values.return_value = [
+            {"key": "foo", "value": b"bar", "flags": 0}
+        ]
+        self.data_layer.delete_value.return_value = False
+        self.proto.dataReceived(
+            b"set foo 0 0 3\r\nbar\r\nget foo baz\r\ndelete baz\r\n"
+        )
+        stats = self._stats(b"stats\r\n")
+        self.assertEqual(stats[b"curr_connections"], b"1")
+        self.assertEqual(stats[b"cmd_set"], b"1")
+        self.assertEqual(stats[b"cmd_get"], b"2")
+        self.assertEqual(stats[b"get_hits"], b"1")
+        self.assertEqual(stats[b"get_misses"], b"1")
+        self.assertEqual(stats[b"delete_misses"], b"1")
+        self.assertEqual(stats[b"bytes_read"], b"52")
+
+    def test_stats_latency(self):
+        self.data_layer.get_values.return_value = []
+        self.proto.dataReceived(b"get foo\r\nget bar\r\nset a 0 0 1\r\nb\r\n")
+        stats = self._stats(b"stats latency\r\n")
+        self.assertEqual(stats[b"get:count"], b"2")
+        self.assertEqual(stats[b"set:count"], b"1")
+        self.assertIn(b"set:p99_us", stats)
+
+        stats = self._stats(b"stats datalayer\r\n")
+        self.assertEqual(stats[b"get_values:count"], b"1")
+        self.assertEqual(stats[b"set_value:count"], b"1")
+
+    def test_stats_unknown_report(self):
+        self._test_ascii_command("stats blink\r\n", b"ERROR\r\n")
+
+    def test_admin_commands(self):
+        result = defer.Deferred()
+
+        def refuse(args):
+            raise AdminError("no " + args[0])
+
+        self.proto.admin_commands = {
+            "echo": lambda args: [arg.encode() for arg in args],
+            "slow": lambda args: result,
+            "refuse": refuse,
+        }
+        self._test_ascii_command("echo a b\r\n", b"a\r\nb\r\n")
+        self.tr.clear()
+        self._test_ascii_command("refuse x\r\n", b"CLIENT_ERROR no x\r\n")
+        self.tr.clear()
+        # Later commands are answered after the admin command
+        self.data_layer.delete_value.return_value = True
+        self._test_ascii_command("slow\r\ndelete foo\r\n", b"")
+        result.callback([b"OK"])
+        self.assertEqual(self.tr.value(), b"OK\r\nDELETED\r\n")
+        self.tr.clear()
+        self._test_ascii_command("snapshot x\r\n", b"ERROR\r\n")
+
+    def test_keys_are_noted_while_tracked(self):
+        tracker = mock.Mock()
+        self.data_layer.get_values.return_value = []
+        self.data_layer.delete_value.return_value = True
+        self.proto.dataReceived(b"get a\r\n")
+        self.proto.stats.key_tracker = tracker
+        self.proto.dataReceived(
+            b"get a b\r\nget a\r\nset c 0 0 1\r\nx\r\ndelete d\r\n"
+            b"incr e 1\r\ntouch f 0\r\n"
+        )
+        calls = [
+            (list(call[0][0]), call[0][1])
+            for call in tracker.record.call_args_list
+        ]
+        self.assertEqual(calls, [
+            (["a", "b", "a"], False), (["c"], True), (["d"], True),
+            (["e"], True), (["f"], True),
+        ])
+
+    def _stream_rows(self, keys, with_cas=False):
+        return [
+            {"key": key, "value": b"x" * 10, "flags": 0}
+            for key in keys if key != "missing"
+        ]
+
+    def test_large_get_is_streamed(self):
+        self.proto.max_response_bytes = 100
+        self.data_layer.get_values.side_effect = self._stream_rows
+        keys = ["k%d" % i for i in range(40)] + ["missing", "k0"]
+        self.proto.dataReceived(b"get %s\r\n" % " ".join(keys).encode())
+        # The first chunk has the default size, the next ones hold about
+        # max_response_bytes bytes of values
+        self.assertEqual(
+            [len(c[0][0]) for c in self.data_layer.get_values.call_args_list],
+            [16, 10, 10, 5]
+        )
+        self.assertEqual(
+            self.tr.value(),
+            b"".join(
+                b"VALUE k%d 0 10\r\nxxxxxxxxxx\r\n" % i for i in range(40)
+            ) + b"END\r\n"
+        )
+        self.assertEqual(self.proto.stats.counters["get_hits"], 40)
+        self.assertEqual(self.proto.stats.counters["get_misses"], 2)
+
+    def test_streaming_waits_for_the_transport_to_drain(self):
+        def get_values(keys):
+            # The first chunk fills the transport up
+            self.proto.pauseResponses()
+            return self._stream_rows(keys)
+
+        self.data_layer.get_values.side_effect = get_values
+        self.data_layer.delete_value.return_value = True
+        keys = " ".join("k%d" % i for i in range(20)).encode()
+        self.proto.dataReceived(b"get %s\r\ndelete k0\r\n" % keys)
+        self.assertEqual(self.data_layer.get_values.call_count, 1)
+        self.assertEqual(self.tr.value().count(b"VALUE"), 16)
+        # Neither rows nor further commands are read meanwhile
+        self.data_layer.delete_value.assert_not_called()
+        self.data_layer.get_values.side_effect = self._stream_rows
+        self.proto.resumeResponses()
+        self.assertEqual(self.data_layer.get_values.call_count, 2)
+        self.assertTrue(self.tr.value().endswith(b"END\r\nDELETED\r\n"))
+        self.assertEqual(self.proto.stats.counters["response_pauses"], 1)
+
+    def test_commands_after_a_streamed_get_wait_for_it(self):
+        self.data_layer.READ_YOUR_WRITES = True
+        result = defer.Deferred()
+        self.data_layer.get_values.return_value = result
+        self.data_layer.delete_value.return_value = True
+        keys = " ".join("k%d" % i for i in range(20)).encode()
+        self.proto.dataReceived(b"get %s\r\ndelete k19\r\n" % keys)
+        self.data_layer.delete_value.assert_not_called()
+        self.data_layer.get_values.return_value = []
+        result.callback([])
+        self.assertEqual(
+            [c[0] for c in self.data_layer.mock_calls],
+            ["get_values", "get_values", "delete_value"]
+        )
+        self.assertEqual(self.tr.value(), b"END\r\nDELETED\r\n")
+
+    def test_transport_pauses_responses(self):
+        self.assertEqual(self.tr.bufferSize, self.proto.high_water)
+        self.tr.producer.pauseProducing()
+        self.assertTrue(self.proto.responses_paused)
+        self.assertEqual(self.tr.producerState, "paused")
+        self.tr.producer.resumeProducing()
+        self.assertFalse(self.proto.responses_paused)
+        self.assertEqual(self.tr.producerState, "producing")
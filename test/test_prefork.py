@@ -0,0 +1,77 @@
+import unittest
+from unittest import mock
+from prefork import Supervisor, WORKER_LISTEN_FD
+from twisted.internet import task
+from twisted.python.failure import Failure
+from twisted.internet.error import ProcessTerminated
+
+
+class FakeReactor(task.Clock):
+    def __init__(self):
+        super().__init__()
+        self.processes = []
+        self.triggers = []
+
+    def spawnProcess(self, process_protocol, executable, args, env, childFDs):
+        process = mock.Mock(pid=len(self.processes) + 100)
+        process.protocol = process_protocol
+        process.args = args
+        process.childFDs = childFDs
+        self.processes.append(process)
+        return process
+
+    def addSystemEventTrigger(self, phase, event, f):
+        self.triggers.append((phase, event, f))
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.supervisor = Supervisor(
+            7, lambda index: ["worker", str(index)], 3,
+            restart_delay=1.0, stop_timeout=5.0, reactor=self.reactor
+        )
+        self.supervisor.start()
+
+    def end(self, process):
+        process.protocol.processEnded(Failure(ProcessTerminated(signal=9)))
+
+    def test_starts_workers_sharing_the_socket(self):
+        self.assertEqual(
+            [p.args for p in self.reactor.processes],
+            [["worker", "0"], ["worker", "1"], ["worker", "2"]]
+        )
+        for process in self.reactor.processes:
+            self.assertEqual(process.childFDs[WORKER_LISTEN_FD], 7)
+
+    def test_restarts_crashed_workers(self):
+        self.end(self.reactor.processes[1])
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.reactor.advance(1.0)
+        self.assertEqual(len(self.reactor.processes), 4)
+        self.assertEqual(self.reactor.processes[3].args, ["worker", "1"])
+        self.assertEqual(self.supervisor.restarts, 1)
+
+    def test_stop(self):
+        stopped = []
+        self.supervisor.stop().addCallback(stopped.append)
+        for process in self.reactor.processes:
+            process.signalProcess.assert_called_once_with("TERM")
+
+        self.end(self.reactor.processes[0])
+        self.end(self.reactor.processes[1])
+        self.assertEqual(stopped, [])
+
+        # The last worker ignores TERM and gets killed
+        self.reactor.advance(5.0)
+        self.reactor.processes[2].signalProcess.assert_called_with("KILL")
+        self.end(self.reactor.processes[2])
+        self.assertEqual(stopped, [None])
+
+        # Nothing gets restarted
+        self.reactor.advance(1.0)
+        self.assertEqual(len(self.reactor.processes), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
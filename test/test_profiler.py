@@ -0,0 +1,86 @@
+import os
+import tempfile
+import time
+import unittest
+from memcache_receiver import AdminError
+from profiler import SamplingProfiler
+from twisted.internet import task
+
+
+def spin(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.clock = task.Clock()
+        self.profiler = SamplingProfiler(
+            self.dir.name, interval=0.001, max_seconds=10, clock=self.clock
+        )
+
+    def tearDown(self):
+        if self.profiler.running:
+            self.profiler.stop()
+        self.dir.cleanup()
+
+    def read(self, name):
+        with open(name) as f:
+            return [line.rsplit(" ", 1) for line in f.read().splitlines()]
+
+    def test_profile(self):
+        self.assertEqual(self.profiler.command(["start"]), [b"OK"])
+        with self.assertRaises(AdminError):
+            self.profiler.command(["start"])
+        spin(0.2)
+        response, = self.profiler.command(["stop"])
+        name = os.fsdecode(response[len(b"OK "):])
+        self.assertEqual(os.path.dirname(name), self.dir.name)
+
+        stacks = self.read(name)
+        counts = [int(count) for _, count in stacks]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        # Stacks run from the outermost function to the innermost
+        spinning = sum(
+            int(count) for stack, count in stacks
+            if stack.split(";")[-1].startswith("spin (test_profiler.py:")
+            and "test_profile (" in stack
+        )
+        self.assertGreater(spinning, 10)
+        stats = self.profiler.stats()
+        self.assertEqual(stats["running"], 0)
+        self.assertEqual(stats["profiles"], 1)
+        self.assertEqual(stats["samples"], sum(counts))
+        with self.assertRaises(AdminError):
+            self.profiler.command(["stop"])
+
+    def test_time_limit(self):
+        self.profiler.command(["start", "5"])
+        self.clock.advance(4)
+        self.assertTrue(self.profiler.running)
+        self.clock.advance(1)
+        self.assertFalse(self.profiler.running)
+        self.assertEqual(len(os.listdir(self.dir.name)), 1)
+        # No longer than max_seconds
+        self.profiler.start(60)
+        self.clock.advance(10)
+        self.assertFalse(self.profiler.running)
+
+    def test_toggle(self):
+        self.profiler.toggle()
+        self.assertTrue(self.profiler.running)
+        self.profiler.toggle()
+        self.assertFalse(self.profiler.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_bad_commands(self):
+        for args in ([], ["start", "x"], ["start", "0"], ["stop", "x"]):
+            with self.assertRaises(AdminError):
+                self.profiler.command(args)
+        self.assertFalse(self.profiler.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+from read_cache import ReadCache
+from twisted.internet import defer
+
+
+class ReadCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_layer = mock.Mock()
+        self.data_layer.get_values.side_effect = self.get_values
+        self.rows = {}
+        self.cache = ReadCache(self.data_layer, 1000)
+
+    def get_values(self, keys, with_cas=False):
+        return [self.rows[key] for key in keys if key in self.rows]
+
+    def add_row(self, key, value):
+        self.rows[key] = {"key": key, "value": value, "flags": 0}
+
+    def result(self, value):
+        results = []
+        defer.maybeDeferred(lambda: value).addCallback(results.append)
+        return results[0]
+
+    def test_only_missing_keys_are_fetched(self):
+        self.add_row("foo", b"1")
+        self.add_row("bar", b"2")
+        self.result(self.cache.get_values(["foo"]))
+        rows = self.result(self.cache.get_values(["foo", "bar", "baz"]))
+        self.assertEqual(
+            [row["key"] for row in rows], ["foo", "bar"]
+        )
+        self.data_layer.get_values.assert_called_with(["bar", "baz"])
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 3)
+
+    def test_writes_invalidate(self):
+        self.add_row("foo", b"1")
+        self.add_row("bar", b"2")
+        self.result(self.cache.get_values(["foo", "bar"]))
+        self.cache.set_value("foo", b"3", 0)
+        self.cache.delete_value("bar")
+        self.assertEqual(list(self.cache.rows), [])
+        self.data_layer.set_value.assert_called_once_with("foo", b"3", 0, 0)
+        self.data_layer.delete_value.assert_called_once_with("bar")
+
+    def test_conditional_writes_invalidate(self):
+        self.add_row("foo", b"1")
+        self.result(self.cache.get_values(["foo"]))
+        self.cache.incr_value("foo", 1)
+        self.assertEqual(list(self.cache.rows), [])
+        self.data_layer.incr_value.assert_called_once_with("foo", 1)
+
+    def test_reads_with_cas_bypass_the_cache(self):
+        self.add_row("foo", b"1")
+        self.result(self.cache.get_values(["foo"], with_cas=True))
+        self.assertEqual(list(self.cache.rows), [])
+        self.data_layer.get_values.assert_called_once_with(["foo"], True)
+
+    def test_read_racing_a_write_is_not_cached(self):
+        self.add_row("foo", b"1")
+        pending = defer.Deferred()
+        self.data_layer.get_values.side_effect = None
+        self.data_layer.get_values.return_value = pending
+        d = self.cache.get_values(["foo"])
+        self.cache.set_value("foo", b"2", 0)
+        pending.callback([self.rows["foo"]])
+        self.assertEqual(len(self.result(d)), 1)
+        self.assertEqual(list(self.cache.rows), [])
+
+    def test_least_recently_used_is_evicted(self):
+        for i in range(4):
+            self.add_row("key%d" % i, b"x" * 100)
+        self.result(self.cache.get_values(["key0", "key1", "key2"]))
+        self.result(self.cache.get_values(["key0"]))
+        self.result(self.cache.get_values(["key3"]))
+        self.assertEqual(list(self.cache.rows), ["key2", "key0", "key3"])
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertLessEqual(self.cache.bytes, self.cache.max_bytes)
+
+    def test_expired_rows_are_not_served(self):
+        self.add_row("foo", b"1")
+        self.rows["foo"]["expires_at"] = 1
+        self.result(self.cache.get_values(["foo"]))
+        self.result(self.cache.get_values(["foo"]))
+        self.assertEqual(self.cache.hits, 0)
+        self.assertEqual(self.data_layer.get_values.call_count, 2)
+
+    def test_values_larger_than_the_cache_are_not_cached(self):
+        self.add_row("foo", b"x" * 1000)
+        self.result(self.cache.get_values(["foo"]))
+        self.assertEqual(self.cache.bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
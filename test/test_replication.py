@@ -0,0 +1,211 @@
+import tempfile
+import unittest
+from data_layer import DataLayer, COMPRESSED_FLAG
+from replication import (
+    ChangeReceiver, ReadOnlyReplica, ReadOnlyStore, Replica,
+    ReplicationSource, decode_changes, encode_changes
+)
+from schema import create_schema
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from unittest import mock
+
+
+class ReplicationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.files = [tempfile.NamedTemporaryFile() for _ in range(2)]
+        for f in self.files:
+            create_schema(f.name)
+        self.primary = DataLayer(self.files[0].name)
+        self.primary.enable_change_log()
+        self.replica_store = DataLayer(self.files[1].name)
+        self.clock = task.Clock()
+        self.source = ReplicationSource(
+            [self.primary], batch_size=2, interval=0.1, clock=self.clock
+        )
+        self.replica = Replica(
+            [self.replica_store], "primary", 11212, reactor=self.clock
+        )
+        self.changed = []
+        self.replica.listeners.append(self.changed.append)
+
+    def tearDown(self):
+        self.primary.close()
+        self.replica_store.close()
+        for f in self.files:
+            f.close()
+
+    def connect(self):
+        sender = self.source.buildProtocol(None)
+        receiver = ChangeReceiver(self.replica, 0)
+        sender.makeConnection(proto_helpers.StringTransport())
+        receiver.makeConnection(proto_helpers.StringTransport())
+        self.exchange(sender, receiver)
+        return sender, receiver
+
+    def exchange(self, sender, receiver):
+        """
+        Passes data both ways until neither side has anything more to say.
+        """
+        while True:
+            self.clock.advance(0)
+            moved = False
+            for transport, protocol in [
+                (receiver.transport, sender), (sender.transport, receiver)
+            ]:
+                data = transport.value()
+                if data:
+                    transport.clear()
+                    protocol.dataReceived(data)
+                    moved = True
+            if not moved:
+                return
+
+    def disconnect(self, sender, receiver):
+        for protocol in (sender, receiver):
+            protocol.connectionLost(None)
+
+    def replica_items(self):
+        return {
+            row["key"]: (row["value"], row["flags"])
+            for row in self.replica_store.scan()
+        }
+
+    def test_copies_then_follows_the_log(self):
+        for i in range(5):
+            self.primary.set_value("k%d" % i, b"v%d" % i, i)
+        self.primary.delete_value("k4")
+        sender, receiver = self.connect()
+        self.assertEqual(self.source.snapshots, 1)
+        self.assertEqual(
+            self.replica_items(),
+            {"k%d" % i: (b"v%d" % i, i) for i in range(4)}
+        )
+
+        self.primary.set_value("k0", b"new", 7)
+        self.primary.delete_value("k1")
+        self.primary.apply_batch([("k5", (b"v5", COMPRESSED_FLAG, 0))])
+        self.clock.advance(0.1)
+        self.exchange(sender, receiver)
+        items = self.replica_items()
+        self.assertEqual(items["k0"], (b"new", 7))
+        self.assertNotIn("k1", items)
+        # Rows are copied with the flags they are stored with
+        self.assertEqual(
+            self.replica_store.get_values(["k5"]),
+            [{"key": "k5", "value": b"v5", "flags": 0, "expires_at": 0,
+              "compressed": True}]
+        )
+        self.assertEqual(self.changed[0], None)
+        self.assertEqual(self.changed[-1], ["k5"])
+
+        log_id, head = self.primary.log_position()
+        self.assertEqual(self.replica_store.replica_state(), (log_id, head))
+        stats = self.replica.stats()
+        self.assertEqual(stats["lag"], 0)
+        self.assertEqual(stats["lag_seconds"], 0)
+        self.assertEqual(stats["connected_shards"], 1)
+        self.assertEqual(self.source.stats()["replicas"], 1)
+
+        self.disconnect(sender, receiver)
+        self.clock.advance(5)
+        self.assertEqual(self.replica.stats()["lag_seconds"], 5)
+        self.assertEqual(self.source.stats()["replicas"], 0)
+
+    def test_resumes_from_its_position(self):
+        self.primary.set_value("a", b"1", 0)
+        self.disconnect(*self.connect())
+        self.primary.set_value("b", b"2", 0)
+        self.primary.set_value("b", b"3", 0)
+        sender, receiver = self.connect()
+        self.assertEqual(self.source.snapshots, 1)
+        self.assertEqual(
+            self.replica_items(), {"a": (b"1", 0), "b": (b"3", 0)}
+        )
+        self.disconnect(sender, receiver)
+
+        # A replica restarted while nothing changed is caught up
+        self.clock.advance(3)
+        self.replica = Replica(
+            [self.replica_store], "primary", 11212, reactor=self.clock
+        )
+        self.connect()
+        self.assertEqual(self.replica.stats()["lag_seconds"], 0)
+
+    def test_copies_again_once_the_log_has_moved_on(self):
+        self.primary.set_value("a", b"1", 0)
+        self.disconnect(*self.connect())
+        self.primary.enable_change_log(retention=2)
+        self.replica_store.apply_changes([("stale", (b"x", 0, 0))])
+        for key in "bcd":
+            self.primary.set_value(key, b"2", 0)
+        self.assertIsNone(self.primary.changes(1, 10))
+        self.connect()
+        self.assertEqual(self.source.snapshots, 2)
+        self.assertEqual(sorted(self.replica_items()), ["a", "b", "c", "d"])
+
+    def test_accesses_are_not_changes(self):
+        self.primary.track_access = True
+        self.primary.set_value("a", b"1", 0)
+        _, head = self.primary.log_position()
+        self.primary.get_values(["a"])
+        self.primary.record_accesses(now=10 ** 10)
+        self.assertEqual(self.primary.log_position()[1], head)
+        changes = self.primary.changes(head - 1, 10)
+        self.assertEqual(changes["writes"], [("a", (b"1", 0, 0))])
+        self.assertEqual(changes["position"], head)
+
+    def test_sending_pauses_while_the_replica_is_slow(self):
+        for i in range(5):
+            self.primary.set_value("k%d" % i, b"v%d" % i, i)
+        sender = self.source.buildProtocol(None)
+        sender.makeConnection(proto_helpers.StringTransport())
+        receiver = ChangeReceiver(self.replica, 0)
+        receiver.makeConnection(proto_helpers.StringTransport())
+        # Pausing the sender's transport leaves its reading alone
+        sender.transport.producer.pauseProducing()
+        self.exchange(sender, receiver)
+        self.assertEqual(self.source.sent_changes, 0)
+        self.assertFalse(sender.paused)
+
+        sender.transport.producer.resumeProducing()
+        self.exchange(sender, receiver)
+        self.assertEqual(self.source.sent_changes, 5)
+        self.assertEqual(len(self.replica_items()), 5)
+        self.disconnect(sender, receiver)
+
+    def test_refuses_unknown_shards(self):
+        sender = self.source.buildProtocol(None)
+        sender.makeConnection(proto_helpers.StringTransport())
+        sender.dataReceived(b"SYNC 1 - -\r\n")
+        self.assertEqual(sender.transport.value(), b"ERROR no shard 1\r\n")
+        self.assertTrue(sender.transport.disconnecting)
+
+
+class ChangesTestCase(unittest.TestCase):
+    def test_encode_and_decode(self):
+        writes = [
+            ("caf\xe9", (b"\x00value", COMPRESSED_FLAG | 5, 1234)),
+            ("gone", None),
+            ("empty", (b"", 0, 0)),
+        ]
+        self.assertEqual(decode_changes(encode_changes(writes)), writes)
+        for end in (-1, -5):
+            with self.assertRaises(ValueError):
+                decode_changes(encode_changes(writes)[:end])
+
+    def test_read_only_store(self):
+        data_layer = mock.Mock()
+        data_layer.get_values.return_value = []
+        store = ReadOnlyStore(data_layer)
+        self.assertEqual(store.get_values(["a"]), [])
+        failures = []
+        defer.maybeDeferred(store.set_value, "a", b"1", 0).addErrback(
+            failures.append
+        )
+        failures[0].trap(ReadOnlyReplica)
+        data_layer.set_value.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
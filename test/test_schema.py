@@ -0,0 +1,171 @@
+import sqlite3
+import tempfile
+import unittest
+from contextlib import closing
+from unittest import mock
+from data_layer import DataLayer
+from schema import (
+    LEGACY_VERSION, SCHEMA_VERSION, SQLiteVersionError, SchemaVersionError,
+    create_schema, drop_legacy_table, migrate_schema, schema_version
+)
+
+
+class SchemaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile()
+
+    def tearDown(self):
+        self.file.close()
+
+    def execute(self, statement, params=()):
+        with closing(sqlite3.connect(self.file.name)) as con:
+            with con:
+                return con.execute(statement, params).fetchall()
+
+    def version(self):
+        with closing(sqlite3.connect(self.file.name)) as con:
+            return schema_version(con)
+
+    def create_first_version(self):
+        self.execute("""
+            CREATE TABLE KEY_VALUE_PAIRS(
+                KEY TEXT PRIMARY KEY, VALUE BLOB, FLAGS INTEGER
+            )"""
+                     )
+        for row in [("foo", b"1", 1), ("bar", b"2", 2), ("caf\xe9", b"3", 3)]:
+            self.execute("INSERT INTO KEY_VALUE_PAIRS VALUES (?, ?, ?)", row)
+
+    def test_create_schema(self):
+        self.assertEqual(self.version(), 0)
+        create_schema(self.file.name)
+        create_schema(self.file.name)
+        self.assertEqual(self.version(), SCHEMA_VERSION)
+        self.assertEqual(
+            self.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'ITEMS'"
+            )[0][0].rstrip()[-13:],
+            "WITHOUT ROWID"
+        )
+
+    def test_data_layer_checks_the_version(self):
+        with self.assertRaisesRegex(SchemaVersionError, "install"):
+            DataLayer(self.file.name)
+        self.create_first_version()
+        # The first version is left for migrate_schema to upgrade
+        create_schema(self.file.name)
+        self.assertEqual(self.version(), LEGACY_VERSION)
+        with self.assertRaisesRegex(SchemaVersionError, "migrate"):
+            DataLayer(self.file.name)
+        self.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION + 1))
+        with self.assertRaisesRegex(SchemaVersionError, "newer"):
+            DataLayer(self.file.name)
+
+    @mock.patch("sqlite3.sqlite_version", "3.34.1")
+    @mock.patch("sqlite3.sqlite_version_info", (3, 34, 1))
+    def test_old_sqlite_is_refused(self):
+        for function in create_schema, migrate_schema, DataLayer:
+            with self.assertRaisesRegex(
+                SQLiteVersionError, r"3\.35\.0 or newer.*3\.34\.1"
+            ):
+                function(self.file.name)
+        self.assertEqual(self.version(), 0)
+
+    def test_migrate_while_the_old_schema_is_written(self):
+        self.create_first_version()
+
+        def legacy_writes(copied):
+            # A server using the first schema keeps writing in between the
+            # batches, before and after the keys being copied
+            if copied == 1:
+                self.execute("DELETE FROM KEY_VALUE_PAIRS WHERE KEY = 'bar'")
+                self.execute(
+                    "UPDATE KEY_VALUE_PAIRS SET VALUE = x'3131', CAS = 10 "
+                    "WHERE KEY = 'foo'"
+                )
+                self.execute(
+                    "INSERT INTO KEY_VALUE_PAIRS (KEY, VALUE, FLAGS, CAS) "
+                    "VALUES ('zoo', x'34', 4, 11)"
+                )
+
+        copied = []
+        self.assertEqual(migrate_schema(
+            self.file.name, batch_size=1,
+            progress=lambda count: (copied.append(count),
+                                    legacy_writes(count))
+        ), 2)
+        # foo and zoo were mirrored by the triggers before their batches
+        self.assertEqual(copied, [1, 2, 2, 2])
+        self.assertEqual(self.version(), SCHEMA_VERSION)
+        self.assertIsNone(migrate_schema(self.file.name))
+
+        # Servers still on the first schema keep working until restarted
+        self.execute(
+            "INSERT INTO KEY_VALUE_PAIRS (KEY, VALUE, FLAGS, CAS) "
+            "VALUES ('late', x'35', 5, 12)"
+        )
+        data_layer = DataLayer(self.file.name)
+        try:
+            rows = data_layer.get_values(
+                ["foo", "bar", "caf\xe9", "zoo", "late"], with_cas=True
+            )
+            self.assertEqual(
+                sorted((row["key"], row["value"]) for row in rows),
+                [("caf\xe9", b"3"), ("foo", b"11"), ("late", b"5"),
+                 ("zoo", b"4")]
+            )
+            self.assertEqual(len({row["cas"] for row in rows}), 4)
+            # Sizes count the bytes of the keys
+            self.assertEqual(
+                data_layer.usage(), {"items": 4, "bytes": 20}
+            )
+            data_layer.set_value("baz", b"3", 3)
+            baz, = data_layer.get_values(["baz"], with_cas=True)
+            self.assertGreater(baz["cas"], max(row["cas"] for row in rows))
+
+            self.assertTrue(drop_legacy_table(self.file.name))
+            self.assertFalse(drop_legacy_table(self.file.name))
+            self.assertEqual(len(data_layer.get_values(["foo", "baz"])), 2)
+            self.assertEqual(
+                data_layer.usage(), {"items": 5, "bytes": 24}
+            )
+        finally:
+            data_layer.close()
+
+    def test_upgrade_the_second_version(self):
+        create_schema(self.file.name)
+        # The second version had no CAS sequence, and an index to find the
+        # largest CAS value
+        self.execute("DROP TABLE CAS_SEQUENCE")
+        self.execute("DROP TRIGGER ITEMS_CAS_INSERT")
+        self.execute("DROP TRIGGER ITEMS_CAS_UPDATE")
+        self.execute("CREATE INDEX ITEMS_CAS ON ITEMS(CAS)")
+        self.execute(
+            "INSERT INTO ITEMS (KEY, VALUE, CAS) VALUES (x'61', x'31', 7)"
+        )
+        self.execute("PRAGMA user_version = 2")
+        with self.assertRaisesRegex(SchemaVersionError, "migrate"):
+            DataLayer(self.file.name)
+
+        self.assertEqual(migrate_schema(self.file.name), 0)
+        self.assertEqual(self.version(), SCHEMA_VERSION)
+        self.assertEqual(
+            self.execute("SELECT VALUE FROM CAS_SEQUENCE"), [(7,)]
+        )
+        self.assertEqual(
+            self.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'ITEMS_CAS'"
+            ),
+            []
+        )
+        data_layer = DataLayer(self.file.name)
+        try:
+            data_layer.delete_value("a")
+            data_layer.set_value("a", b"2", 0)
+            row, = data_layer.get_values(["a"], with_cas=True)
+            self.assertEqual(row["cas"], 8)
+        finally:
+            data_layer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
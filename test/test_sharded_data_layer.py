@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from data_layer import DataLayer
+from schema import create_schema
+from sharded_data_layer import ShardedDataLayer, reshard, shard_files, \
+    shard_index
+from twisted.internet import defer
+
+
+class ShardedDataLayerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.dir, "test.db")
+        self.data_layer = self.open(4)
+
+    def tearDown(self):
+        self.data_layer.close()
+        shutil.rmtree(self.dir)
+
+    def open(self, num_shards):
+        names = shard_files(self.db_name, num_shards)
+        for name in names:
+            create_schema(name)
+        return ShardedDataLayer([DataLayer(name) for name in names])
+
+    def insert_records(self, n):
+        for i in range(n):
+            self.data_layer.set_value("key%d" % i, b"val%d" % i, i)
+
+    def test_shard_files(self):
+        self.assertEqual(shard_files("foo", 1), ["foo"])
+        self.assertEqual(shard_files("foo", 2), ["foo.shard0", "foo.shard1"])
+
+    def test_keys_are_spread_over_shards(self):
+        self.insert_records(40)
+        for index, shard in enumerate(self.data_layer.shards):
+            keys = [row["key"] for row in shard.get_all_values()]
+            self.assertGreater(len(keys), 0)
+            for key in keys:
+                self.assertEqual(shard_index(key, 4), index)
+
+    def test_get_values_from_several_shards(self):
+        self.insert_records(20)
+        values = self.data_layer.get_values(["key3", "key17", "foo", "key8"])
+        self.assertEqual(
+            sorted(row["flags"] for row in values), [3, 8, 17]
+        )
+        self.assertEqual(len(list(self.data_layer.get_all_values())), 20)
+
+    def test_scan_merges_shards_in_key_order(self):
+        self.insert_records(12)
+        keys = [row["key"] for row in self.data_layer.scan(start="key1")]
+        self.assertEqual(keys, sorted("key%d" % i for i in range(1, 12)))
+        rows = list(self.data_layer.scan(after="key1", limit=2))
+        self.assertEqual([row["key"] for row in rows], ["key10", "key11"])
+
+    def test_apply_batch_and_delete(self):
+        self.insert_records(10)
+        existed = self.data_layer.apply_batch(
+            [("key1", None), ("key20", (b"", 0, 0)), ("key2", (b"", 0, 0))]
+        )
+        self.assertEqual(existed, {"key1": True, "key20": False, "key2": True})
+        self.assertTrue(self.data_layer.delete_value("key3"))
+        self.assertFalse(self.data_layer.delete_value("key3"))
+        self.assertEqual(len(list(self.data_layer.get_all_values())), 9)
+
+    def test_conditional_writes_go_to_the_key_shard(self):
+        self.insert_records(10)
+        self.assertTrue(self.data_layer.add_value("new", b"1", 0))
+        self.assertEqual(self.data_layer.incr_value("new", 2), 3)
+        self.assertTrue(self.data_layer.append_value("key4", b"!"))
+        self.assertFalse(self.data_layer.replace_value("key40", b"", 0))
+        self.assertEqual(
+            self.data_layer.get_values(["key4"])[0]["value"], b"val4!"
+        )
+
+    def test_asynchronous_shards(self):
+        keys = ["key%d" % i for i in range(6)]
+        keys.sort(key=lambda key: shard_index(key, 2))
+        self.assertNotEqual(shard_index(keys[0], 2), shard_index(keys[-1], 2))
+        shards = [mock.Mock(), mock.Mock()]
+        shards[0].get_values.return_value = defer.succeed([{"key": keys[0]}])
+        shards[1].get_values.return_value = [{"key": keys[-1]}]
+        data_layer = ShardedDataLayer(shards)
+        results = []
+        data_layer.get_values(keys).addCallback(results.append)
+        self.assertEqual(
+            sorted(r["key"] for r in results[0]), sorted([keys[0], keys[-1]])
+        )
+
+    def test_reshard(self):
+        self.insert_records(30)
+        self.data_layer.close()
+        self.assertEqual(reshard(self.db_name, 4, 3), 30)
+        self.assertEqual(
+            sorted(os.listdir(self.dir)),
+            ["test.db.shard0", "test.db.shard1", "test.db.shard2"]
+        )
+        self.data_layer = self.open(3)
+        self.assertEqual(len(self.data_layer.get_values(["key29"])), 1)
+        self.assertEqual(len(list(self.data_layer.get_all_values())), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+from stats import Histogram, Stats
+import unittest
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_small_values_have_exact_buckets(self):
+        for micros in range(Histogram.SUB_BUCKETS):
+            self.assertEqual(Histogram.bucket(micros), micros)
+            self.assertEqual(Histogram.bucket_limit(micros), micros)
+
+    def test_bucket_limits_bound_their_values(self):
+        for micros in [8, 9, 15, 16, 17, 100, 1000, 123456, 10 ** 8]:
+            index = Histogram.bucket(micros)
+            self.assertGreaterEqual(Histogram.bucket_limit(index), micros)
+            self.assertLess(Histogram.bucket_limit(index - 1), micros)
+            self.assertLessEqual(
+                Histogram.bucket_limit(index) - micros,
+                micros // Histogram.SUB_BUCKETS
+            )
+
+    def test_huge_values_go_in_the_last_bucket(self):
+        histogram = Histogram()
+        histogram.record(10 ** 6)
+        self.assertEqual(histogram.counts[-1], 1)
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for micros in range(1, 1001):
+            histogram.record(micros / 1000000)
+        p50 = histogram.percentile(0.5)
+        p99 = histogram.percentile(0.99)
+        self.assertTrue(500 <= p50 <= 500 * 9 // 8, p50)
+        self.assertTrue(990 <= p99 <= 990 * 9 // 8, p99)
+        self.assertEqual(dict(histogram.summary())["count"], 1000)
+
+    def test_empty_histogram(self):
+        self.assertEqual(
+            dict(Histogram().summary()),
+            {"count": 0, "mean_us": 0, "p50_us": 0, "p99_us": 0, "p999_us": 0}
+        )
+
+
+class StatsTestCase(unittest.TestCase):
+    def test_general_report_includes_sources(self):
+        stats = Stats()
+        stats.incr("cmd_get", 3)
+        stats.add_source("cache_", lambda: {"hits": 2})
+        report = dict(stats.general())
+        self.assertEqual(report["cmd_get"], 3)
+        self.assertEqual(report["cache_hits"], 2)
+
+    def test_latency_report(self):
+        stats = Stats()
+        stats.record_command("set", 0.001)
+        stats.record_operation("set_value", 0.0005)
+        self.assertEqual(dict(stats.latency())["set:count"], 1)
+        self.assertEqual(dict(stats.data_layer())["set_value:count"], 1)
@@ -0,0 +1,149 @@
+import tempfile
+import unittest
+from unittest import mock
+from data_layer import DataLayer
+from schema import create_schema
+from twisted.internet import defer, task
+from write_batcher import WriteBatcher
+
+
+class WriteBatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.NamedTemporaryFile()
+        create_schema(self.file.name)
+        self.data_layer = DataLayer(self.file.name)
+        self.apply_batch = mock.Mock(wraps=self.data_layer.apply_batch)
+        self.data_layer.apply_batch = self.apply_batch
+        self.clock = task.Clock()
+        self.batcher = WriteBatcher(
+            self.data_layer, window=0.01, max_batch=3, clock=self.clock
+        )
+
+    def tearDown(self):
+        self.data_layer.close()
+        self.file.close()
+
+    def results(self, deferreds):
+        results = []
+        for d in deferreds:
+            d.addCallback(results.append)
+        return results
+
+    def test_writes_commit_together_after_window(self):
+        results = self.results([
+            self.batcher.set_value("foo", b"1", 1),
+            self.batcher.set_value("bar", b"2", 2),
+        ])
+        self.assertEqual(results, [])
+        self.assertEqual(self.data_layer.get_values(["foo", "bar"]), [])
+
+        self.clock.advance(0.01)
+        self.assertEqual(len(results), 2)
+        self.apply_batch.assert_called_once_with(
+            [("foo", (b"1", 1, 0)), ("bar", (b"2", 2, 0))]
+        )
+        self.assertEqual(len(self.data_layer.get_values(["foo", "bar"])), 2)
+
+    def test_repeated_writes_collapse(self):
+        self.batcher.set_value("foo", b"1", 1)
+        self.batcher.set_value("foo", b"2", 2)
+        self.batcher.flush()
+        self.apply_batch.assert_called_once_with([("foo", (b"2", 2, 0))])
+
+    def test_full_batch_commits_without_waiting(self):
+        for i in range(3):
+            self.batcher.set_value("key%d" % i, b"v", 0)
+        self.assertEqual(self.apply_batch.call_count, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_reads_see_queued_writes(self):
+        self.data_layer.set_value("foo", b"old", 1)
+        self.data_layer.set_value("bar", b"old", 1)
+        self.data_layer.set_value("baz", b"old", 1)
+        self.batcher.set_value("foo", b"new", 2)
+        self.batcher.delete_value("bar")
+        values = self.batcher.get_values(["foo", "bar", "baz"])
+        values = self.results([values])[0]
+        self.assertEqual(values, [
+            {"key": "baz", "value": b"old", "flags": 1, "expires_at": 0},
+            {"key": "foo", "value": b"new", "flags": 2, "expires_at": 0},
+        ])
+
+    def test_queued_buffers_are_read_as_bytes(self):
+        self.batcher.set_value("foo", bytearray(b"new"), 2)
+        values = self.batcher.get_values(["foo"])
+        self.assertIs(type(values[0]["value"]), bytes)
+
+    def test_delete_results(self):
+        self.data_layer.set_value("foo", b"1", 1)
+        results = self.results([
+            self.batcher.delete_value("foo"),
+            self.batcher.delete_value("bar"),
+            self.batcher.delete_value("foo"),
+        ])
+        self.clock.advance(0.01)
+        self.assertEqual(results, [True, False, False])
+
+    def test_conditional_writes_apply_in_order(self):
+        self.batcher.set_value("n", b"1", 0)
+        incremented = self.results([self.batcher.incr_value("n", 5)])
+        self.assertEqual(incremented, [6])
+        self.assertEqual(self.apply_batch.call_count, 1)
+
+        self.batcher.set_value("n", b"100", 0)
+        added = self.results([self.batcher.add_value("n", b"", 0)])
+        self.assertEqual(added, [False])
+        self.assertEqual(self.apply_batch.call_count, 2)
+        self.assertEqual(
+            self.data_layer.get_values(["n"])[0]["value"], b"100"
+        )
+
+    def test_reads_wait_for_conditional_writes(self):
+        pending = defer.Deferred()
+        self.data_layer.touch_value = mock.Mock(return_value=pending)
+        self.data_layer.set_value("foo", b"1", 0)
+        self.apply_batch.reset_mock()
+        touched = self.results([self.batcher.touch_value("foo", 60)])
+        self.batcher.set_value("bar", b"2", 0)
+        self.batcher.flush()
+        values = self.results([self.batcher.get_values(["foo", "bar"])])
+        self.assertEqual(values, [])
+        self.apply_batch.assert_not_called()
+
+        pending.callback(True)
+        self.assertEqual(touched, [True])
+        self.apply_batch.assert_called_once_with([("bar", (b"2", 0, 0))])
+        self.assertEqual(
+            sorted(row["value"] for row in values[0]), [b"1", b"2"]
+        )
+
+    def test_gets_reads_committed_writes(self):
+        self.data_layer.set_value("bar", b"old", 0)
+        self.batcher.set_value("foo", b"new", 0)
+        rows = self.results([self.batcher.get_values(["foo"], True)])[0]
+        self.assertEqual(rows[0]["value"], b"new")
+        self.assertIn("cas", rows[0])
+        rows = self.batcher.get_values(["bar"], True)
+        self.assertIn("cas", rows[0])
+
+    def test_relaxed_durability(self):
+        self.batcher.relaxed = True
+        self.assertIsNone(self.batcher.set_value("foo", b"1", 1))
+        self.assertTrue(self.batcher.delete_value("foo"))
+        self.clock.advance(0.01)
+        self.assertEqual(self.data_layer.get_values(["foo"]), [])
+
+    def test_relaxed_delete_of_a_stored_key(self):
+        # The batch is committed before the delete could read the key
+        self.data_layer.set_value("foo", b"1", 1)
+        self.batcher.relaxed = True
+        self.batcher.max_batch = 1
+        results = self.results([self.batcher.delete_value("foo")])
+        self.assertEqual(results, [True])
+        self.assertEqual(self.data_layer.get_values(["foo"]), [])
+        results = self.results([self.batcher.delete_value("foo")])
+        self.assertEqual(results, [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,335 @@
+from collections import deque
+from data_layer import expires_at, is_expired
+from twisted.internet import defer
+from twisted.internet import reactor as global_reactor
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _Commit:
+    """
+    A batch of writes, or a single conditional write, waiting in the
+    WriteBatcher's backlog to be applied to the data layer.
+    """
+
+    def __init__(self, writes=None, waiters=(), mutation=None):
+        # The batch's writes, mapping keys to rows like WriteBatcher.queued,
+        # and the waiters of its writes
+        self.writes = writes
+        self.waiters = waiters
+        # (key, method, args, Deferred) of a conditional write
+        self.mutation = mutation
+        # Deferreds to fire once the commit has been applied
+        self.done = []
+
+
+class WriteBatcher:
+    """
+    Write-behind queue in front of a data layer.
+
+    Sets and deletes are queued and committed together in one transaction
+    (group commit) once 'window' seconds have passed since the first queued
+    write or once 'max_batch' distinct keys are queued. Repeated writes to the
+    same key within a batch collapse into the last one.
+
+    By default set_value and delete_value return Deferreds that fire once the
+    batch holding the write has been committed. In relaxed durability mode
+    they return as soon as the write is queued, so a crash may lose the
+    writes of the last window. Deletes of keys without a pending write
+    still wait for their batch, which finds out whether the key existed.
+
+    Reads always see queued writes, whether or not they have been committed.
+
+    Conditional writes (add, replace, append, prepend, incr, decr and touch)
+    depend on what is stored, so they are not batched: each closes the batch
+    being collected and is applied on its own once every write queued before
+    it has been committed, ahead of the writes queued after it. Their
+    Deferreds fire with their result, even in relaxed durability mode, and
+    reads of their key wait for them.
+    """
+
+    # Every call is answered as if all calls issued before it had completed,
+    # even while their Deferreds are still pending.
+    READ_YOUR_WRITES = True
+
+    def __init__(self, data_layer, window=0.002, max_batch=256,
+                 relaxed=False, clock=global_reactor):
+        """
+            :param data_layer: the data layer (synchronous or asynchronous)
+            the batches are applied to
+            :param window: maximum time in seconds a write waits for others
+            to join its batch
+            :param max_batch: number of distinct keys that triggers a commit
+            without waiting for the window to end
+            :param relaxed: whether to acknowledge writes before they are
+            committed
+            :param clock: provider of callLater used for the batch window
+        """
+        self.data_layer = data_layer
+        self.window = window
+        self.max_batch = max_batch
+        self.relaxed = relaxed
+        self.clock = clock
+
+        # Writes waiting for the next batch. Maps each key to a
+        # (value, flags, expires_at) tuple or to None when the key is to be
+        # deleted.
+        self.queued = {}
+        # (Deferred, key, result) for every queued write waiting for its
+        # batch to commit. A result of None means the reply depends on
+        # whether the key existed in the database.
+        self.waiters = []
+        # Closed batches and conditional writes waiting to be applied, in
+        # order, after the one currently being applied
+        self.backlog = deque()
+        self.current = None
+        self.flush_call = None
+
+    def _lookup(self, key):
+        """
+        :return: the pending (value, flags, expires_at) or None (deleted) for
+        'key', or the _Commit of a conditional write of 'key' if that is the
+        latest pending write. Raises KeyError if there is no pending write
+        for it.
+        """
+        if key in self.queued:
+            return self.queued[key]
+        commits = list(self.backlog)
+        if self.current is not None:
+            commits.insert(0, self.current)
+        for commit in reversed(commits):
+            if commit.mutation is not None:
+                if commit.mutation[0] == key:
+                    return commit
+            elif key in commit.writes:
+                return commit.writes[key]
+        raise KeyError(key)
+
+    def _enqueue(self, key, row, result):
+        self.queued[key] = row
+        d = None
+        # A result of None is only known once the batch is applied
+        if not self.relaxed or result is None and row is None:
+            d = defer.Deferred()
+            self.waiters.append((d, key, result))
+
+        if len(self.queued) >= self.max_batch:
+            self.flush()
+        elif self.flush_call is None and self.current is None:
+            self.flush_call = self.clock.callLater(self.window, self.flush)
+        return d
+
+    def set_value(self, key, value, flags, exptime=0):
+        return self._enqueue(key, (value, flags, expires_at(exptime)), None)
+
+    def _mutate(self, key, method, *args):
+        """
+        Queues a conditional write of 'key', to be applied by calling
+        'method' with 'args' once everything queued before it is committed.
+        A 'key' of None queues a read that has to see committed data.
+
+        :return: a Deferred firing with the result of 'method'
+        """
+        self._close_batch()
+        d = defer.Deferred()
+        self.backlog.append(_Commit(mutation=(key, method, args, d)))
+        self._apply_next()
+        return d
+
+    def add_value(self, key, value, flags, exptime=0):
+        return self._mutate(
+            key, self.data_layer.add_value, key, value, flags, exptime
+        )
+
+    def replace_value(self, key, value, flags, exptime=0):
+        return self._mutate(
+            key, self.data_layer.replace_value, key, value, flags, exptime
+        )
+
+    def cas_value(self, key, value, flags, exptime, cas):
+        return self._mutate(
+            key, self.data_layer.cas_value, key, value, flags, exptime, cas
+        )
+
+    def append_value(self, key, value):
+        return self._mutate(key, self.data_layer.append_value, key, value)
+
+    def prepend_value(self, key, value):
+        return self._mutate(key, self.data_layer.prepend_value, key, value)
+
+    def incr_value(self, key, delta):
+        return self._mutate(key, self.data_layer.incr_value, key, delta)
+
+    def touch_value(self, key, exptime):
+        return self._mutate(key, self.data_layer.touch_value, key, exptime)
+
+    @staticmethod
+    def _row_to_dict(key, row):
+        value, flags, expiry = row
+        # Pending values may be the receiver's buffers, while rows returned
+        # by data layers always hold bytes
+        return {
+            "key": key, "value": bytes(value), "flags": flags,
+            "expires_at": expiry,
+        }
+
+    def delete_value(self, key):
+        try:
+            # If the key has a pending write we already know the answer
+            row = self._lookup(key)
+            if isinstance(row, _Commit):
+                existed = None
+            else:
+                existed = row is not None and \
+                    not is_expired(self._row_to_dict(key, row))
+        except KeyError:
+            existed = None
+
+        d = self._enqueue(key, None, existed)
+        return existed if d is None else d
+
+    def get_values(self, keys, with_cas=False):
+        if with_cas:
+            return self._get_values_with_cas(keys)
+
+        pending_rows = []
+        db_keys = []
+        for key in keys:
+            try:
+                row = self._lookup(key)
+            except KeyError:
+                db_keys.append(key)
+                continue
+            if isinstance(row, _Commit):
+                # The key's value is only known once the conditional write
+                # has been applied; read all keys again then
+                d = defer.Deferred()
+                row.done.append(d)
+                d.addCallback(lambda _: self.get_values(keys))
+                return d
+            if row is not None:
+                row = self._row_to_dict(key, row)
+                if not is_expired(row):
+                    pending_rows.append(row)
+
+        if not db_keys:
+            return pending_rows
+
+        d = defer.maybeDeferred(self.data_layer.get_values, db_keys)
+        d.addCallback(lambda rows: list(rows) + pending_rows)
+        return d
+
+    def _get_values_with_cas(self, keys):
+        """
+        Reads 'keys' with their CAS values, which only committed writes have.
+        If any of them has a pending write the read waits its turn behind it.
+        """
+        for key in keys:
+            try:
+                self._lookup(key)
+            except KeyError:
+                continue
+            return self._mutate(
+                None, self.data_layer.get_values, keys, True
+            )
+        return self.data_layer.get_values(keys, True)
+
+    def get_all_values(self):
+        def merge(rows):
+            pending = {}
+            commits = list(self.backlog)
+            if self.current is not None:
+                commits.insert(0, self.current)
+            for commit in commits:
+                if commit.writes is not None:
+                    pending.update(commit.writes)
+            pending.update(self.queued)
+            merged = [row for row in rows if row["key"] not in pending]
+            for key, row in pending.items():
+                if row is not None:
+                    row = self._row_to_dict(key, row)
+                    if not is_expired(row):
+                        merged.append(row)
+            return merged
+
+        d = defer.maybeDeferred(self.data_layer.get_all_values)
+        d.addCallback(merge)
+        return d
+
+    def note_accesses(self, keys):
+        self.data_layer.note_accesses(keys)
+
+    def _close_batch(self):
+        """
+        Moves the queued writes into the backlog as a batch of their own, so
+        that later writes go into the next one.
+        """
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+
+        if self.queued:
+            self.backlog.append(_Commit(self.queued, self.waiters))
+            self.queued, self.waiters = {}, []
+
+    def flush(self):
+        """
+        Commits the queued writes now.
+
+        :return: a Deferred firing once every write queued so far has been
+        committed.
+        """
+        self._close_batch()
+        last = self.backlog[-1] if self.backlog else self.current
+        if last is None:
+            return defer.succeed(None)
+
+        # Hand out a separate Deferred so that callers can't interfere with
+        # the commit's own callback chain
+        d = defer.Deferred()
+        last.done.append(d)
+        self._apply_next()
+        return d
+
+    def _apply_next(self):
+        """
+        Applies the oldest commit of the backlog, unless one is being applied
+        already. Only one is applied at a time, so they take effect in order.
+        """
+        if self.current is not None or not self.backlog:
+            return
+
+        commit = self.current = self.backlog.popleft()
+        if commit.mutation is not None:
+            key, method, args, result = commit.mutation
+            applying = defer.maybeDeferred(method, *args)
+            applying.addCallbacks(result.callback, result.errback)
+        else:
+            def committed(existed):
+                for d, key, result in commit.waiters:
+                    d.callback(existed[key] if result is None else result)
+
+            def failed(failure):
+                logger.error(failure.getTraceback())
+                for d, _, _ in commit.waiters:
+                    d.errback(failure)
+
+            applying = defer.maybeDeferred(
+                self.data_layer.apply_batch, list(commit.writes.items())
+            )
+            applying.addCallbacks(committed, failed)
+
+        def done(_):
+            self.current = None
+            self._apply_next()
+            for d in commit.done:
+                d.callback(None)
+            if self.current is None and self.queued and \
+                    self.flush_call is None:
+                self.flush_call = self.clock.callLater(
+                    self.window, self.flush
+                )
+
+        applying.addBoth(done)